@@ -2,18 +2,22 @@
 # ----------------------------- adapterscan.py ---------------------------- #
 # This script is designed to scan the system for all network adapters,      #
 # Where we can get the IP addresses and input them into a list to prevent   #
-# duplicates, where we can then create a random IP address without          #
-# overriding the existing adapters.                                         #
+# duplicates, where we can then allocate tunnel addresses and subnets       #
+# without overriding the existing adapters.                                 #
 #                                                                           #
 # This script is part of the PhaethonVPN project.          v0.0.2           #
 # --------------------------------- s3B-a --------------------------------- #
 
-import psutil
+import bisect
+import heapq
 import ipaddress
-import random
+
+POOL = '10.0.0.0/8' # Private range tunnel addresses are allocated from
+TUNNEL_PREFIX = 24  # Size of the subnet set aside for each tunnel
 
 # Retrieves all local networks by scanning the system's network adapters
 def getLocalNetworks():
+    import psutil # slow to import, deferred until a tunnel address is needed
     networks = set()
     for interface, addrs in psutil.net_if_addrs().items():
         for addr in addrs:
@@ -25,13 +29,173 @@ def getLocalNetworks():
                     continue
     return networks
 
-# Generates a random IP address that doesn't conflict with existing local networks
+# Returns the networks as sorted, merged (first, last) address intervals
+# Networks of another IP version than the pool's are ignored
+def usedIntervals(networks, version=4):
+    intervals = sorted((int(net.network_address), int(net.broadcast_address))
+                       for net in networks if net.version == version)
+    merged = []
+    for first, last in intervals:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+# Hands out non-conflicting subnets of a pool, lowest address first
+# Free space is kept as aligned blocks in one heap per prefix length, the way a
+# buddy allocator does, so allocating takes the smallest free block that fits and
+# splits it in O(log n) while releasing merges a block back with its free buddy
+class AddressAllocator:
+    def __init__(self, pool=POOL, networks=()):
+        self.pool = ipaddress.ip_network(pool)
+        self.bits = self.pool.max_prefixlen
+        self.heaps = [[] for _ in range(self.bits + 1)] # prefix length -> heap of block starts
+        self.free = [set() for _ in range(self.bits + 1)] # the same blocks, for buddy lookups
+        self.used = usedIntervals(networks, self.pool.version)
+        self.used_starts = [first for first, _ in self.used]
+
+        # Every gap between the used intervals inside the pool becomes free blocks
+        pool_first = int(self.pool.network_address)
+        pool_last = int(self.pool.broadcast_address)
+        cursor = pool_first
+        for first, last in self.used + [(pool_last + 1, pool_last + 1)]:
+            if last < pool_first:
+                continue
+            if first > cursor:
+                self.addRange(cursor, min(first - 1, pool_last))
+            cursor = max(cursor, last + 1)
+            if cursor > pool_last:
+                break
+
+    # Adds the free addresses first..last as the largest aligned blocks covering them
+    def addRange(self, first, last):
+        address = ipaddress.ip_address
+        for block in ipaddress.summarize_address_range(address(first), address(last)):
+            self.push(int(block.network_address), block.prefixlen)
+
+    def push(self, start, prefixlen):
+        heapq.heappush(self.heaps[prefixlen], start)
+        self.free[prefixlen].add(start)
+
+    # Removes and returns the lowest free block of a prefix length, or None
+    # Blocks merged away by release() are left in the heap and skipped here
+    def pop(self, prefixlen):
+        heap = self.heaps[prefixlen]
+        free = self.free[prefixlen]
+        while heap:
+            start = heapq.heappop(heap)
+            if start in free:
+                free.remove(start)
+                return start
+        return None
+
+    # Returns True if an address falls in one of the local networks
+    def conflicts(self, address):
+        address = int(ipaddress.ip_address(address))
+        i = bisect.bisect_right(self.used_starts, address) - 1
+        return i >= 0 and address <= self.used[i][1]
+
+    # Allocates a subnet of the given prefix length, or returns None when the pool is full
+    def allocate(self, prefixlen=TUNNEL_PREFIX):
+        if not self.pool.prefixlen <= prefixlen <= self.bits:
+            raise ValueError(f"/{prefixlen} doesn't fit in {self.pool}")
+
+        size = prefixlen
+        start = self.pop(size)
+        while start is None and size > self.pool.prefixlen:
+            size -= 1
+            start = self.pop(size)
+        if start is None:
+            return None
+
+        # Split the block, keeping the lower half and freeing the upper one each time
+        while size < prefixlen:
+            size += 1
+            self.push(start + (1 << (self.bits - size)), size)
+        return ipaddress.ip_network((start, prefixlen))
+
+    # Returns True if the block at start is free, on its own or as part of a larger free block
+    def isFree(self, start, prefixlen):
+        for size in range(prefixlen, self.pool.prefixlen - 1, -1):
+            if start & ~((1 << (self.bits - size)) - 1) in self.free[size]:
+                return True
+        return False
+
+    # Returns a subnet handed out by allocate() to the pool
+    # Raises ValueError for a subnet outside the pool or one that is already free
+    def release(self, subnet):
+        subnet = ipaddress.ip_network(subnet)
+        if not subnet.subnet_of(self.pool):
+            raise ValueError(f"{subnet} isn't part of {self.pool}")
+        start = int(subnet.network_address)
+        size = subnet.prefixlen
+        if self.isFree(start, size):
+            raise ValueError(f"{subnet} is already free")
+        while size > self.pool.prefixlen:
+            buddy = start ^ (1 << (self.bits - size))
+            if buddy not in self.free[size]:
+                break
+            self.free[size].remove(buddy)
+            start = min(start, buddy)
+            size -= 1
+        self.push(start, size)
+
+# Hands out single client addresses from a subnet, reusing released ones first
+# The network and broadcast addresses of the subnet are never handed out
+class AddressPool:
+    def __init__(self, subnet):
+        self.subnet = ipaddress.ip_network(subnet)
+        first = int(self.subnet.network_address)
+        last = int(self.subnet.broadcast_address)
+        if self.subnet.num_addresses > 2:
+            first, last = first + 1, last - 1
+        self.first = first
+        self.next = first
+        self.last = last
+        self.released = [] # heap of released addresses, lowest handed out again first
+        self.free = set() # the same addresses, to catch a double release
+
+    # Returns a free address, or None when every address is in use
+    def allocate(self):
+        if self.released:
+            address = heapq.heappop(self.released)
+            self.free.remove(address)
+            return ipaddress.ip_address(address)
+        if self.next > self.last:
+            return None
+        address = self.next
+        self.next += 1
+        return ipaddress.ip_address(address)
+
+    # Returns an address handed out by allocate()
+    # Raises ValueError for an address never handed out or already released
+    def release(self, address):
+        address = ipaddress.ip_address(address)
+        value = int(address)
+        if value in self.free or not self.first <= value < self.next:
+            raise ValueError(f"{address} isn't in use")
+        heapq.heappush(self.released, value)
+        self.free.add(value)
+
+# Returns an allocator over the pool that avoids every local network
+# The first skip_first subnets of the pool are left alone too, since small
+# networks elsewhere (home routers, VPNs, containers) tend to number from there
+def localAllocator(pool=POOL, skip_first=0, prefixlen=TUNNEL_PREFIX):
+    networks = set(getLocalNetworks())
+    pool_net = ipaddress.ip_network(pool)
+    if skip_first:
+        first = int(pool_net.network_address)
+        last = min(first + (skip_first << (pool_net.max_prefixlen - prefixlen)) - 1, int(pool_net.broadcast_address))
+        networks.update(ipaddress.summarize_address_range(ipaddress.ip_address(first), ipaddress.ip_address(last)))
+    return AddressAllocator(pool, networks)
+
+# Returns an IP address that doesn't conflict with existing local networks
+# The address is the first host of a free subnet, so the lowest free subnet
+# past the first skip_first is picked every time and nothing is left to chance
 def generateNonConflictingIP(skip_first=100):
-    local_networks = getLocalNetworks()
-
-    while True:
-        a, b, c = random.randint(0, 255), random.randint(0, 255), random.randint(1, 254)
-        ip_str = f"10.{a}.{b}.{c}"
-        ip_obj = ipaddress.IPv4Address(ip_str)
-        if not any(ip_obj in net for net in local_networks):
-            return ip_str
\ No newline at end of file
+    subnet = localAllocator(skip_first=skip_first).allocate(TUNNEL_PREFIX)
+    if subnet is None:
+        raise RuntimeError(f"No free /{TUNNEL_PREFIX} left in {POOL} for the tunnel")
+    return str(subnet.network_address + 1)
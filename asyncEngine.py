@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# ------------------------------ asyncEngine.py --------------------------- #
+# This script is designed to run the tunnel datapath on a single asyncio    #
+# event loop. The TUN device and the UDP socket are registered as readers   #
+# so packets are moved as soon as they arrive, with no polling threads,     #
+# no timed wakeups while idle, and shutdown through task cancellation.      #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import asyncio
+import bufferPool
+import capture
+import framing
+import metrics
+import os
+import signal
+import time
+
+DRAIN_LIMIT = 64    # Packets moved per readiness callback before yielding
+
+# Moves packets between a TUN device and a UDP socket from event loop callbacks
+class AsyncTunnel:
+    def __init__(self, tun, sock, pipeline, pool=None):
+        self.tun = tun
+        self.sock = sock
+        self.pipeline = pipeline
+        self.pool = pool or bufferPool.get_pool()
+        self.tunBuffer = self.pool.acquire()
+        self.sockBuffer = self.pool.acquire()
+        self.loop = None
+        self.done = None
+        self.pending = None # Packet waiting for room in the socket send buffer
+        self.signals = []
+        self.outbound = None # metrics.Counters of each direction, taken on the loop's thread
+        self.inbound = None
+
+    # Registers the readers and runs until stop() is called or the task is cancelled
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        self.outbound = metrics.counters('outbound')
+        self.inbound = metrics.counters('inbound')
+
+        os.set_blocking(self.tun, False)
+        self.sock.setblocking(False)
+
+        self.loop.add_reader(self.tun, self.onTunReadable)
+        self.loop.add_reader(self.sock, self.onSocketReadable)
+        # Signal handlers can only be installed from the main thread
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+                self.signals.append(sig)
+            except (RuntimeError, ValueError):
+                break
+
+        try:
+            await self.done
+        finally:
+            for sig in self.signals:
+                self.loop.remove_signal_handler(sig)
+            self.signals.clear()
+            self.loop.remove_reader(self.tun)
+            self.loop.remove_reader(self.sock)
+            self.loop.remove_writer(self.sock)
+            self.pool.release(self.tunBuffer)
+            self.pool.release(self.sockBuffer)
+
+    # Resolves the run() future so the engine shuts down
+    def stop(self):
+        if self.done is not None and not self.done.done():
+            self.done.set_result(None)
+
+    # Sends one packet, sealed when the pipeline has a cipher, pausing the TUN reader
+    # if the socket send buffer is full
+    def send(self, packet, destination=None):
+        stats = self.outbound
+        size = len(packet)
+        if destination is None:
+            destination = self.pipeline.route(packet)
+            if self.pipeline.cipher is not None:
+                packet = self.pipeline.cipher.seal(packet)
+        try:
+            start = time.perf_counter_ns()
+            self.sock.sendto(packet, destination)
+            stats.send.observe(time.perf_counter_ns() - start)
+            stats.packets += 1
+            stats.bytes += size
+            return True
+        except BlockingIOError:
+            # The buffer is reused by the next read, so the held datagram needs its own copy
+            self.pending = (bytes(packet), destination)
+            stats.queue_depth = 1
+            self.loop.remove_reader(self.tun)
+            self.loop.add_writer(self.sock, self.onSocketWritable)
+            return False
+
+    # Drains packets from the TUN device and forwards them to the server
+    def onTunReadable(self):
+        view = self.tunBuffer.view
+        stats = self.outbound
+        for _ in range(DRAIN_LIMIT):
+            start = time.perf_counter_ns()
+            try:
+                packet = view[:os.readv(self.tun, [view])]
+            except BlockingIOError:
+                return
+            except OSError as e:
+                stats.errors += 1
+                print(f"Error reading from TUN device: {e}")
+                return
+            stats.recv.observe(time.perf_counter_ns() - start)
+
+            packet = self.pipeline.processOutbound(packet)
+            if packet is None:
+                stats.drops += 1
+                continue
+            if self.pipeline.capture is not None:
+                self.pipeline.capture.record(packet, capture.OUTBOUND)
+            try:
+                if not self.send(packet):
+                    return
+            except OSError as e:
+                stats.errors += 1
+                print(f"Error sending to server: {e}")
+
+    # Flushes the packet held back by a full send buffer and resumes reading the TUN device
+    def onSocketWritable(self):
+        pending, self.pending = self.pending, None
+        self.outbound.queue_depth = 0
+        self.loop.remove_writer(self.sock)
+        self.loop.add_reader(self.tun, self.onTunReadable)
+        if pending is not None:
+            try:
+                self.send(*pending) # already sealed
+            except OSError as e:
+                self.outbound.errors += 1
+                print(f"Error sending to server: {e}")
+
+    # Drains datagrams from the server and injects them into the TUN device
+    def onSocketReadable(self):
+        view = self.sockBuffer.view
+        stats = self.inbound
+        for _ in range(DRAIN_LIMIT):
+            start = time.perf_counter_ns()
+            try:
+                data = view[:self.sock.recv_into(view)]
+            except BlockingIOError:
+                return
+            except OSError as e:
+                stats.errors += 1
+                print(f"Error receiving data: {e}")
+                return
+            stats.recv.observe(time.perf_counter_ns() - start)
+
+            if self.pipeline.cipher is not None:
+                data = self.pipeline.cipher.open(data)
+                if data is None: # forged, replayed or not sealed at all
+                    stats.drops += 1
+                    continue
+            if framing.isFramed(data):
+                if self.pipeline.framer is not None:
+                    self.pipeline.framer.observe()
+                for packet in framing.unpack(data):
+                    self.inject(packet)
+            else:
+                self.inject(data)
+
+    # Runs a packet from the server through the inbound stages and writes it to the TUN device
+    def inject(self, packet):
+        stats = self.inbound
+        packet = self.pipeline.processInbound(packet)
+        if packet is None:
+            stats.drops += 1
+            return
+        if self.pipeline.capture is not None:
+            self.pipeline.capture.record(packet, capture.INBOUND)
+        try:
+            start = time.perf_counter_ns()
+            os.write(self.tun, packet)
+            stats.send.observe(time.perf_counter_ns() - start)
+            stats.packets += 1
+            stats.bytes += len(packet)
+        except BlockingIOError:
+            stats.drops += 1
+        except OSError as e:
+            stats.errors += 1
+            print(f"Error writing to TUN device: {e}")
+
+# Runs an AsyncTunnel on a fresh event loop until interrupted
+def runTunnel(tun, sock, pipeline):
+    tunnel = AsyncTunnel(tun, sock, pipeline)
+    asyncio.run(tunnel.run())
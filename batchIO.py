@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# ------------------------------- batchIO.py ------------------------------ #
+# This script is designed to move packets in bulk between the TUN device    #
+# and the UDP socket. It wraps the Linux sendmmsg/recvmmsg system calls     #
+# through ctypes so a whole burst of datagrams crosses the kernel boundary  #
+# in a single call, falling back to per-packet calls when unavailable.      #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+
+MSG_DONTWAIT = 0x40 # Non-blocking operation for a single call
+BUFFER_SIZE = 9216  # Size of each packet slot in a batch, above the largest TUN MTU used
+BATCH_SIZE     = 64     # Maximum packets moved per wakeup in batch mode
+FLUSH_DEADLINE = 0.0005 # Seconds a partial batch may wait for more packets
+
+# struct iovec from <sys/uio.h>
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t)
+    ]
+
+# struct msghdr from <sys/socket.h>
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)
+    ]
+
+# struct mmsghdr from <sys/socket.h>
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint)
+    ]
+
+# Loads sendmmsg/recvmmsg from libc, leaving them as None if they are missing
+def loadLibc():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None, None
+
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return sendmmsg, recvmmsg
+
+sendmmsg, recvmmsg = loadLibc()
+
+# A fixed set of packet slots backed by one preallocated slab, with the
+# mmsghdr/iovec arrays built once so a batch can be reused without allocating
+class PacketBatch:
+    def __init__(self, capacity, buffer_size=BUFFER_SIZE):
+        self.capacity = capacity
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.lengths = [0] * capacity
+        self.destination = None
+        self.targets = [None] * capacity # Per-packet destination overriding the default
+        self.names = {}                  # Destination -> packed sockaddr_in
+
+        self.slab = bytearray(capacity * buffer_size)
+        view = memoryview(self.slab)
+        self.slots = [view[i * buffer_size:(i + 1) * buffer_size] for i in range(capacity)]
+
+        base = ctypes.addressof((ctypes.c_char * len(self.slab)).from_buffer(self.slab))
+        self.iovecs = (iovec * capacity)()
+        self.msgs = (mmsghdr * capacity)()
+        self.name = ctypes.create_string_buffer(16)
+        for i in range(capacity):
+            self.iovecs[i].iov_base = base + i * buffer_size
+            self.iovecs[i].iov_len = buffer_size
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    # Returns the address of the i-th mmsghdr so partial batches can be resumed
+    def msgsAddress(self, i):
+        return ctypes.addressof(self.msgs) + i * ctypes.sizeof(mmsghdr)
+
+    # Returns a packed sockaddr_in for an (ip, port) pair, reusing earlier ones
+    def sockaddr(self, destination):
+        name = self.names.get(destination)
+        if name is None:
+            ip, port = destination
+            name = ctypes.create_string_buffer(
+                struct.pack('=H2s4s8x', socket.AF_INET, port.to_bytes(2, 'big'), socket.inet_aton(ip)), 16)
+            self.names[destination] = name
+        return name
+
+    # Sets the IPv4 address every packet in the batch is sent to
+    def setDestination(self, ip, port):
+        self.destination = (ip, port)
+        self.name = self.sockaddr(self.destination)
+
+    # Sends the i-th packet somewhere other than the batch's destination
+    def setTarget(self, i, destination):
+        self.targets[i] = destination
+
+    # Returns True when no more packets fit in the batch
+    def full(self):
+        return self.count >= self.capacity
+
+    # Empties the batch so its slots can be refilled
+    def clear(self):
+        for i in range(self.count):
+            self.targets[i] = None
+        self.count = 0
+
+    # Returns a view of the i-th packet in the batch
+    def packet(self, i):
+        return self.slots[i][:self.lengths[i]]
+
+    # Stores a rewritten packet in the i-th slot, returns False, leaving the slot as it
+    # was, if the packet is larger than a slot
+    def store(self, i, packet):
+        n = len(packet)
+        if n > self.buffer_size:
+            return False
+        self.slots[i][:n] = packet
+        self.lengths[i] = n
+        return True
+
+    # Moves the i-th packet down to position j by swapping slots, so no data is copied
+    def move(self, i, j):
+        if i == j:
+            return
+        self.slots[i], self.slots[j] = self.slots[j], self.slots[i]
+        base = self.iovecs[i].iov_base
+        self.iovecs[i].iov_base = self.iovecs[j].iov_base
+        self.iovecs[j].iov_base = base
+        self.lengths[j] = self.lengths[i]
+        self.targets[j] = self.targets[i]
+        self.targets[i] = None
+
+    # Reads a single packet from the TUN device into the next free slot
+    def readFromTun(self, tun):
+        n = os.readv(tun, [self.slots[self.count]])
+        self.lengths[self.count] = n
+        self.count += 1
+        return n
+
+    # Writes every packet in the batch to the TUN device
+    def writeToTun(self, tun):
+        for i in range(self.count):
+            os.write(tun, self.packet(i))
+
+    # Sends every packet in the batch to the destination and returns the amount sent
+    def send(self, sock):
+        if self.count == 0:
+            return 0
+        if sendmmsg is None:
+            for i in range(self.count):
+                sock.sendto(self.packet(i), self.targets[i] or self.destination)
+            return self.count
+
+        for i in range(self.count):
+            hdr = self.msgs[i].msg_hdr
+            target = self.targets[i]
+            hdr.msg_name = ctypes.addressof(self.name if target is None else self.sockaddr(target))
+            hdr.msg_namelen = 16
+            self.iovecs[i].iov_len = self.lengths[i]
+
+        sent = 0
+        fd = sock.fileno()
+        while sent < self.count:
+            n = sendmmsg(fd, self.msgsAddress(sent), self.count - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EAGAIN: # the send buffer is full, wait for room
+                    select.select([], [fd], [], 1)
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += n
+        return sent
+
+    # Receives as many datagrams as are queued on the socket into the free slots
+    # without blocking, returning the number of new packets
+    def receive(self, sock):
+        if self.full():
+            return 0
+        if recvmmsg is None:
+            received = 0
+            while not self.full():
+                try:
+                    n = sock.recv_into(self.slots[self.count], self.buffer_size, MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                self.lengths[self.count] = n
+                self.count += 1
+                received += 1
+            return received
+
+        start = self.count
+        for i in range(start, self.capacity):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = None
+            hdr.msg_namelen = 0
+            self.iovecs[i].iov_len = self.buffer_size
+
+        n = recvmmsg(sock.fileno(), self.msgsAddress(start), self.capacity - start, MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EAGAIN: # nothing queued
+                return 0
+            raise OSError(err, os.strerror(err))
+        for i in range(start, start + n):
+            self.lengths[i] = self.msgs[i].msg_len
+        self.count += n
+        return n
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# ------------------------------ benchmark.py ----------------------------- #
+# This script is designed to measure the tunnel datapath on one machine,    #
+# without root, a TUN device or a real relay. A SOCK_SEQPACKET socketpair   #
+# stands in for the TUN device, a local UDP echo server stands in for the   #
+# relay, and a traffic generator sends timestamped IPv4/UDP packets of the  #
+# chosen sizes across the chosen number of flows. Each packet goes out      #
+# through the engine, is echoed by the relay and comes back in through it,  #
+# so the report covers both directions: packets per second, Gbit/s, p50     #
+# and p99 round trip latency and the engine's CPU time per packet, next to  #
+# the load of the harness and relay so a saturated stand-in is easy to spot.#
+# Each Linux engine can also run sealed with every cipher of tunnelCrypto,  #
+# against a relay that opens and re-seals what it echoes, and the report    #
+# then gives the cost of encryption per packet next to the plaintext run.   #
+#                                                                           #
+# The Linux engines (packet, batch, async) run tunLinux.runLoops as they    #
+# are. The Windows engine runs the tunWindows loops against a fake Wintun   #
+# library backed by the same socketpair, so both can be compared here.      #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import argparse
+import ctypes
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import tunnelCrypto
+import types
+
+ENGINES  = ('packet', 'batch', 'async', 'windows')
+SIZES    = (64, 512, 1400) # IP packet sizes the generator cycles through
+FLOWS    = 16              # Distinct UDP flows, told apart by source port
+DURATION = 3.0             # Seconds of traffic per engine
+WINDOW   = 256             # Packets allowed in flight before the generator waits
+DRAIN    = 0.5             # Seconds to wait for stragglers after the generator stops
+SOCKET_BUFFER = 4 * 1024 * 1024
+HEADER = struct.Struct('!BBHHHBBH4s4sHHHH') # IPv4 header followed by a UDP header
+STAMP = struct.Struct('!QI') # send time in ns and sequence number, at the start of the payload
+PLAINTEXT = 'none'           # Cipher name of the unencrypted runs
+
+# Returns the IPv4 header checksum
+def checksum(header):
+    total = sum(struct.unpack(f'!{len(header) // 2}H', header))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+# Returns a template IPv4/UDP packet of the given size for a flow, the stamp is filled in per send
+def buildPacket(size, flow):
+    size = max(size, HEADER.size + STAMP.size)
+    header = bytearray(HEADER.pack(0x45, 0, size, 0, 0x4000, 64, 17, 0,
+                                   socket.inet_aton('10.0.100.1'), socket.inet_aton('10.250.0.1'),
+                                   20000 + flow, 9, size - 20, 0))
+    header[10:12] = struct.pack('!H', checksum(bytes(header[:20])))
+    return header + bytes(size - HEADER.size)
+
+# Echoes every datagram back to its sender until killed, the stand-in relay
+# With a psk it opens each datagram and seals it again, as a relay would
+def echoRelay(ready, psk=None, cipher=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    sock.bind(('127.0.0.1', 0))
+    ready.send(sock.getsockname()[1])
+    buffer = bytearray(65535)
+    view = memoryview(buffer)
+    ciphers = {} # session id -> responder SessionCipher
+    while True:
+        n, address = sock.recvfrom_into(buffer)
+        if psk is None:
+            sock.sendto(view[:n], address)
+            continue
+        session = tunnelCrypto.sessionOf(view[:n])
+        if session is None:
+            continue
+        responder = ciphers.get(session)
+        if responder is None:
+            responder = ciphers[session] = tunnelCrypto.SessionCipher(psk, session, initiator=False, cipher=cipher)
+        datagram = responder.open(view[:n])
+        if datagram is not None:
+            sock.sendto(responder.seal(datagram), address)
+
+# A stand-in for the Wintun library, moving packets through a socketpair end
+# Receive and send packets are ctypes buffers whose addresses play the ring slots
+class FakeWintun:
+    WAIT_OBJECT_0 = 0
+    WAIT_TIMEOUT = 258
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.receiveSlot = ctypes.create_string_buffer(65535)
+        self.sendSlot = ctypes.create_string_buffer(65535)
+        self.sendSize = 0
+        self.sendLock = threading.Lock()
+        os.set_blocking(fd, False)
+
+    def WintunGetReadWaitEvent(self, session):
+        return self.fd
+
+    def WaitForSingleObject(self, event, milliseconds):
+        readable, _, _ = select.select([event], [], [], milliseconds / 1000)
+        return self.WAIT_OBJECT_0 if readable else self.WAIT_TIMEOUT
+
+    def WintunReceivePacket(self, session, size_pointer):
+        try:
+            n = os.readv(self.fd, [memoryview(self.receiveSlot)])
+        except BlockingIOError:
+            return None
+        size_pointer._obj.value = n
+        return ctypes.addressof(self.receiveSlot)
+
+    def WintunReleaseReceivePacket(self, session, packet):
+        pass
+
+    def WintunAllocateSendPacket(self, session, size):
+        self.sendLock.acquire()
+        self.sendSize = size
+        return ctypes.addressof(self.sendSlot)
+
+    def WintunSendPacket(self, session, packet):
+        try:
+            os.write(self.fd, memoryview(self.sendSlot)[:self.sendSize])
+        except BlockingIOError:
+            pass # a full ring drops the packet, as Wintun does
+        finally:
+            self.sendLock.release()
+
+# Runs one engine over the stand-in TUN end until killed, sealing with cipher when given a psk
+def runEngine(engine, tun, relay, batch_size, psk=None, cipher=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    sock.settimeout(1)
+    stop_event = threading.Event()
+
+    if engine == 'windows':
+        wintun = FakeWintun(tun)
+        sys.modules['wintunLoader'] = types.SimpleNamespace(get_wintun=lambda: wintun)
+        ctypes.windll = types.SimpleNamespace(kernel32=wintun)
+        import tunWindows
+        threads = [threading.Thread(target=tunWindows.readPackets, args=(None, sock, relay[0], relay[1], stop_event)),
+                   threading.Thread(target=tunWindows.receiveFromServerAndInject, args=(sock, None, stop_event))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return
+
+    import batchIO
+    import mssClamp
+    import tunLinux
+    from pipeline import Pipeline
+    pipeline = Pipeline(relay)
+    pipeline.mtu = 1500
+    clamp = mssClamp.MSSClamp(pipeline) # the stage every real tunnel runs
+    pipeline.addOutbound(clamp)
+    pipeline.addInbound(clamp)
+    if psk is not None:
+        pipeline.cipher = tunnelCrypto.SessionCipher(psk, cipher=cipher)
+    tunLinux.runLoops(tun, sock, pipeline, stop_event, engine, batch_size, batchIO.FLUSH_DEADLINE)
+
+# Returns the user plus system CPU seconds a process has used so far (Linux /proc)
+def cpuSeconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+# Returns the value at a fraction of a sorted list
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Drives one engine with generated traffic and returns its results
+# cipher, other than PLAINTEXT, seals the traffic between the engine and the relay
+def benchmark(engine, sizes=SIZES, flows=FLOWS, duration=DURATION, window=WINDOW, rate=0, batch_size=64, cipher=PLAINTEXT):
+    psk = os.urandom(tunnelCrypto.KEY_SIZE) if cipher != PLAINTEXT else None
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    relay_process = context.Process(target=echoRelay, args=(sender, psk, cipher), daemon=True)
+    relay_process.start()
+    relay = ('127.0.0.1', receiver.recv())
+
+    kernel, tun = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    for end in (kernel, tun):
+        end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        end.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    engine_process = context.Process(target=runEngine, args=(engine, tun.fileno(), relay, batch_size, psk, cipher), daemon=True)
+    engine_process.start()
+    tun.close()
+
+    templates = [buildPacket(sizes[i % len(sizes)], i % flows) for i in range(len(sizes) * flows)]
+    in_flight = threading.Semaphore(window)
+    latencies = []
+    received = [0, 0] # packets, bytes
+    sent = [0, 0]
+    stop_sink = threading.Event()
+
+    def sink():
+        kernel_fd = kernel.fileno()
+        buffer = bytearray(65535)
+        view = memoryview(buffer)
+        while not stop_sink.is_set():
+            readable, _, _ = select.select([kernel_fd], [], [], 0.1)
+            if not readable:
+                continue
+            n = os.readv(kernel_fd, [view])
+            now = time.perf_counter_ns()
+            if n >= HEADER.size + STAMP.size:
+                stamp, _ = STAMP.unpack_from(buffer, HEADER.size)
+                latencies.append(now - stamp)
+            received[0] += 1
+            received[1] += n
+            in_flight.release()
+
+    sink_thread = threading.Thread(target=sink, daemon=True)
+    sink_thread.start()
+    time.sleep(0.2) # let the engine reach its loop
+
+    kernel_fd = kernel.fileno()
+    interval = 1 / rate if rate else 0
+    cpu_start = cpuSeconds(engine_process.pid)
+    harness_start = cpuSeconds(os.getpid())
+    relay_start = cpuSeconds(relay_process.pid)
+    start = time.perf_counter()
+    end = start + duration
+    next_send = start
+    sequence = 0
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if interval:
+            if now < next_send:
+                time.sleep(next_send - now)
+            next_send += interval
+        in_flight.acquire(timeout=0.05) # a lost packet frees its slot after a short wait
+        packet = templates[sequence % len(templates)]
+        STAMP.pack_into(packet, HEADER.size, time.perf_counter_ns(), sequence)
+        os.write(kernel_fd, packet)
+        sent[0] += 1
+        sent[1] += len(packet)
+        sequence += 1
+
+    time.sleep(DRAIN)
+    elapsed = time.perf_counter() - start - DRAIN
+    cpu = cpuSeconds(engine_process.pid) - cpu_start
+    harness = cpuSeconds(os.getpid()) - harness_start
+    relay_cpu = cpuSeconds(relay_process.pid) - relay_start
+    stop_sink.set()
+    sink_thread.join()
+    for process in (engine_process, relay_process):
+        process.kill()
+        process.join()
+    kernel.close()
+
+    latencies.sort()
+    packets = received[0]
+    return {
+        'engine': engine,
+        'cipher': cipher,
+        'sent': sent[0],
+        'received': packets,
+        'loss': 1 - packets / sent[0] if sent[0] else 0.0,
+        'pps': packets / elapsed,
+        'gbps': received[1] * 8 / elapsed / 1e9,
+        'p50_us': percentile(latencies, 0.50) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'cpu_us_per_packet': cpu / packets * 1e6 if packets else 0.0,
+        # Loads of the generator and sink and of the echo relay, near 100% means they are the limit
+        'harness_cpu': harness / elapsed,
+        'relay_cpu': relay_cpu / elapsed,
+    }
+
+# Prints the results of every engine as a table, then what encryption cost each
+# engine per packet, its CPU time sealing and opening both ways over the plaintext run
+def report(results):
+    print(f"{'engine':<8} {'cipher':<8} {'sent':>9} {'received':>9} {'loss':>6} {'pps':>10} {'Gbit/s':>7} {'p50 us':>8} {'p99 us':>8} {'CPU us/pkt':>10} {'harness':>8} {'relay':>6}")
+    for r in results:
+        print(f"{r['engine']:<8} {r['cipher']:<8} {r['sent']:>9} {r['received']:>9} {r['loss'] * 100:>5.1f}% {r['pps']:>10.0f} {r['gbps']:>7.3f} "
+              f"{r['p50_us']:>8.1f} {r['p99_us']:>8.1f} {r['cpu_us_per_packet']:>10.2f} {r['harness_cpu'] * 100:>7.0f}% {r['relay_cpu'] * 100:>5.0f}%")
+
+    plaintext = {r['engine']: r for r in results if r['cipher'] == PLAINTEXT}
+    sealed = [r for r in results if r['cipher'] != PLAINTEXT and r['engine'] in plaintext]
+    if sealed:
+        print()
+    for r in sealed:
+        base = plaintext[r['engine']]
+        cost = r['cpu_us_per_packet'] - base['cpu_us_per_packet']
+        share = cost / base['cpu_us_per_packet'] * 100 if base['cpu_us_per_packet'] else 0.0
+        print(f"{r['engine']:<8} {r['cipher']:<8} adds {cost:.2f} us of CPU per packet ({share:+.0f}%), "
+              f"{r['pps'] / base['pps'] * 100 if base['pps'] else 0.0:.0f}% of the plaintext rate")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tunnel datapath over loopback stand-ins.")
+    parser.add_argument('--engines', default=','.join(ENGINES), help="Comma separated engines out of " + ', '.join(ENGINES))
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help="Comma separated IP packet sizes to cycle through")
+    parser.add_argument('--flows', type=int, default=FLOWS)
+    parser.add_argument('--duration', type=float, default=DURATION, help="Seconds of traffic per engine")
+    parser.add_argument('--window', type=int, default=WINDOW, help="Packets in flight before the generator waits")
+    parser.add_argument('--rate', type=float, default=0, help="Packets per second to send, 0 sends as fast as the window allows")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=64)
+    parser.add_argument('--ciphers', default=PLAINTEXT,
+                        help=f"Comma separated ciphers to run each engine with out of {PLAINTEXT}, {', '.join(tunnelCrypto.CIPHERS)}")
+    args = parser.parse_args()
+
+    engines = [engine.strip() for engine in args.engines.split(',') if engine.strip()]
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error(f"unknown engine {engine}")
+    ciphers = [cipher.strip() for cipher in args.ciphers.split(',') if cipher.strip()]
+    for cipher in ciphers:
+        if cipher != PLAINTEXT and cipher not in tunnelCrypto.CIPHERS:
+            parser.error(f"unknown cipher {cipher}")
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    results = []
+    for engine in engines:
+        for cipher in ciphers:
+            if cipher != PLAINTEXT and engine == 'windows':
+                print(f"Skipping windows with {cipher}, its loops don't seal")
+                continue
+            results.append(benchmark(engine, sizes, args.flows, args.duration, args.window, args.rate, args.batch_size, cipher))
+    report(results)
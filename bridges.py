@@ -8,17 +8,21 @@
 # This script is part of the PhaethonVPN project.          v0.0.2           #
 # --------------------------------- s3B-a --------------------------------- #
 
-import concurrent.futures
 import os
 import platform
-import subprocess
+import relayCache
+import relayIndex
+import relayWatcher
 import sys
-from time import sleep
+import threading
 
 choosenCountry = None
 country_relays = {}
 csv = "./servers/tor_relays_by_country.csv"
 fastest = None
+FLAG_WEIGHTS = {'Running': 0.5, 'Fast': 0.25, 'Stable': 0.25} # Score bonus for each flag
+RTT_SCALE = 0.1       # Seconds of RTT that halve a relay's score
+REFRESH_TOP_K = 8     # Best cached relays reprobed in the background after a cached pick
 list_of_country_codes = ['ad', 'ae', 'af', 'ag', 'ai', 'al', 'am', 'ao', 'ar', 
                          'at', 'au', 'aw', 'az', 'ba', 'bb', 'bd', 'be', 'bf', 
                          'bg', 'bh', 'bi', 'bj', 'bn', 'bo', 'br', 'bs', 'bt', 
@@ -52,36 +56,44 @@ def determineOS():
     else:
         return os_name
 
-# Writes to country_relays, a dictionary of all countries and their associated relays
-def determineRelays():
-    with open(csv, 'r') as file:
-        next(file)
-        for line in file:
-            parts = line.strip().split(",")
-            ip = parts[0]
-            country = parts[1]
-            port = parts[2]
-            
-            country_relays.setdefault(country, []).append((ip, port))
-
 # Determines the country and returns the dictionary of relays associated with that country
+# The relays come from the memory-mapped index compiled from the CSV, which is only
+# rebuilt when the CSV changes, falling back to an in-memory index if it can't be written
 def loadDictionary():
+    global country_relays
     if not os.path.exists(csv):
         print(f"CSV file not found: {csv}")
         return None
-        
-    with open(csv, 'r') as file:
-        lines = file.readlines()
 
-        if not lines:
-            print("CSV file is empty.")
-            return None
+    try:
+        country_relays = relayIndex.load(csv)
+    except (OSError, ValueError) as e:
+        print(f"Relay index file unavailable ({e}), compiling it in memory instead.")
+        country_relays = relayIndex.loadInMemory(csv)
 
-        relays = determineRelays()
-        
-        print("Dictionary Loaded!")
+    if not country_relays:
+        print("CSV file is empty.")
+        return None
 
-# Returns the IP address of the fastest and most reliable relay for a given country code
+    print("Dictionary Loaded!")
+
+# Makes a reloaded relay index live and forgets the cached RTTs of relays no longer listed
+# Assigning the module global is atomic, so lookups already under way finish on the old index
+def applyReload(index, diff):
+    global country_relays
+    country_relays = index
+    if diff.removed:
+        relayCache.get_cache().forget((ip, port) for _, ip, port in diff.removed)
+
+# Returns a relayWatcher.RelayWatcher that, once started, keeps country_relays in step
+# with the csv and any other csv dropped beside it, checking every interval seconds
+# It learns the csv straight away, so made before loadDictionary an edit made while the
+# relays load is still picked up
+def watchRelays(interval=relayWatcher.INTERVAL):
+    return relayWatcher.RelayWatcher(csv, applyReload, interval).seed()
+
+# Returns the IP address, country code and port of the fastest and most reliable relay
+# for a country code the user picks, the port being the one the relay was probed on
 def returnIP():
     fastest = None
     while(True):
@@ -100,111 +112,137 @@ def returnIP():
             for ip in country_relays[choosenCountry]:
                 print(ip)
             print("finding fastest and most reliable relay...")
-            sleep(2)
             fastest = findFastestRelay(choosenCountry)
         else:
             print(f"No relays found for country code: {choosenCountry}")
-        print("Fastest relay found:", fastest if fastest else "No reachable relays found.")
-        return [fastest, choosenCountry]
+        if fastest is None:
+            print("Fastest relay found: No reachable relays found.")
+            return [None, choosenCountry, None]
+        print(f"Fastest relay found: {fastest[0]}:{fastest[1]}")
+        return [fastest[0], choosenCountry, fastest[1]]
 
-# Returns the port number for the relay
+# Returns the port of a relay given only by its IP, the first one listed if it has several
 def returnPort(country, ip):
     if country in country_relays:
-        for relay in country_relays[country]:
-            if relay[0] == ip:
-                return relay[1]
+        return country_relays.port(country, ip)
     return None
 
-# Iterates through all the diffrent relays and pings them to find the one that responds the fastest
-def findFastestRelay(country_code):
-    ips = country_relays.get(country_code, [])
-    if not ips:
+# Returns a relay's score from its bandwidth, flags and measured RTT, higher is better
+def scoreRelay(relay, rtt=None):
+    score = relay.bandwidth + 0.01
+    for flag, weight in FLAG_WEIGHTS.items():
+        if relay.has(flag):
+            score *= 1 + weight
+    if rtt is not None:
+        score /= 1 + rtt / RTT_SCALE
+    return score
+
+# Returns the relays of a country best first, keeping only those that pass the filters
+# stable_only keeps relays flagged Stable, min_bandwidth is in MiB/s,
+# rtts maps relay (ip, port) addresses to measured RTTs in seconds
+def rankRelays(country_code, stable_only=False, min_bandwidth=0.0, rtts=None):
+    rtts = rtts or {}
+    ranked = []
+    for relay in country_relays.relays(country_code):
+        if stable_only and not relay.has('Stable'):
+            continue
+        if relay.bandwidth < min_bandwidth:
+            continue
+        ranked.append((scoreRelay(relay, rtts.get(relay.address)), relay))
+    ranked.sort(key=lambda entry: entry[0], reverse=True)
+    return [relay for _, relay in ranked]
+
+# Returns the relay with the best score among those with a known RTT, or None
+def bestRelay(candidates, rtts):
+    reachable = [relay for relay in candidates if relay.address in rtts]
+    if not reachable:
+        return None
+    return max(reachable, key=lambda relay: scoreRelay(relay, rtts[relay.address]))
+
+# Probes the given relays, folds the samples into the latency cache and saves it
+# Returns a dictionary of (ip, port) -> median RTT for the relays that answered
+def probeAndCache(relays):
+    import relayProber # pulls in asyncio, only needed once relays are probed
+    cache = relayCache.get_cache()
+    samples = relayProber.probeRelays(relay.address for relay in relays)
+    cache.recordSweep(samples)
+    cache.save()
+
+    rtts = {}
+    for address, results in samples.items():
+        rtt = relayProber.summarize(results)
+        if rtt is not None:
+            rtts[address] = rtt
+    return rtts
+
+# Picks the best relay of a country that passes the filters and returns its (ip, port)
+# Fresh RTTs from the latency cache are used straight away, with stale relays and the
+# best cached ones reprobed in the background; with nothing cached the whole country
+# is probed with timed TCP connects to each relay's ORPort
+def findFastestRelay(country_code, stable_only=False, min_bandwidth=0.0):
+    candidates = []
+    seen = set()
+    for relay in rankRelays(country_code, stable_only, min_bandwidth):
+        if relay.address not in seen: # a relay listed twice is probed once
+            seen.add(relay.address)
+            candidates.append(relay)
+
+    if not candidates:
         print("No IPs found for this country.")
         return None
 
-    # Use ThreadPoolExecutor to ping relays concurrently
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(relayCheck, ip_port[0]): ip_port for ip_port in ips}
+    cache = relayCache.get_cache()
+    cached = {}
+    for relay in candidates:
+        rtt = cache.rtt(*relay.address)
+        if rtt is not None:
+            cached[relay.address] = rtt
+
+    best = bestRelay(candidates, cached)
+    if best is not None:
+        ranked = sorted((relay for relay in candidates if relay.address in cached),
+                        key=lambda relay: scoreRelay(relay, cached[relay.address]), reverse=True)
+        refresh = ranked[:REFRESH_TOP_K] + [relay for relay in candidates if cache.isStale(*relay.address)]
+        threading.Thread(target=probeAndCache, args=(refresh,), daemon=True).start()
+        print(f"Best cached relay: {best.nickname} {best.ip}:{best.port} ({best.bandwidth:.2f} MiB/s, {cached[best.address] * 1000:.1f} ms)")
+        return best.address
+
+    rtts = probeAndCache(candidates)
+    print(f"{len(rtts)} of {len(candidates)} relays reachable.")
+
+    best = bestRelay(candidates, rtts)
+    if best is None:
+        print("No reachable relays found.")
+        return None
 
-        for future in concurrent.futures.as_completed(futures):
-            ip, success = future.result()
-            if success:
-                print(f"Found working relay: {ip}")
-                return ip
-    print("No reachable relays found.")
-    return None
+    print(f"Best relay: {best.nickname} {best.ip}:{best.port} ({best.bandwidth:.2f} MiB/s, {rtts[best.address] * 1000:.1f} ms)")
+    return best.address
 
-# Pings the server to check if it's reachable on Windows
-def pingServerWindows(ip):
-    try:
-        result = subprocess.run(
-            ["ping", "-n", "1", ip],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True
-        )
-        print(result.stdout.decode(errors='ignore'))
-        print(f"Relay {ip} is reachable.")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(e.stdout.decode(errors='ignore'))
-        print(f"Relay {ip} is not reachable.")
-        return False
-
-# Pings the server to check if it's reachable on Linux
-def pingServerLinux(ip):
-    try:
-        result = subprocess.run(
-            ["ping", "-c", "1", ip],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True
-        )
-        print(result.stdout.decode(errors='ignore'))
-        print(f"Relay {ip} is reachable.")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(e.stdout.decode(errors='ignore'))
-        print(f"Relay {ip} is not reachable.")
-        return False
-
-# Pings the server to check if it's reachable on Mac
-def pingServerMac(ip):
-    try:
-        result = subprocess.run(
-            ["ping", "-c", "1", ip],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True
-        )
-        print(result.stdout.decode(errors='ignore'))
-        print(f"Relay {ip} is reachable.")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(e.stdout.decode(errors='ignore'))
-        print(f"Relay {ip} is not reachable.")
-        return False
-
-# Checks if a relay is reachable by pinging it
-def relayCheck(ip):
-    try:
-        if platform.system() == "Windows":
-            success = pingServerWindows(ip)
-        elif platform.system() == "Linux":
-            success = pingServerLinux(ip)
-        elif platform.system() == "Darwin":
-            success = pingServerMac(ip)
-        else:
-            print(f"Unsupported OS for {ip}")
-            return (ip, False)
-        return (ip, success)
-    except Exception as e:
-        print(f"Relay {ip} check failed with error: {e}")
-        return (ip, False)
+# Returns the (ip, port) of a relay of a country without prompting, for headless starts
+# policy = 'fastest' picks by measured RTT like returnIP, 'ranked' takes the best
+# scored relay from bandwidth, flags and any cached RTT without probing
+def chooseRelay(country_code, policy='fastest', stable_only=False, min_bandwidth=0.0):
+    if country_code not in country_relays:
+        print(f"No relays found for country code: {country_code}")
+        return None
+    if policy == 'fastest':
+        return findFastestRelay(country_code, stable_only, min_bandwidth)
+
+    cache = relayCache.get_cache()
+    best = None
+    best_score = None
+    for relay in rankRelays(country_code, stable_only, min_bandwidth):
+        score = scoreRelay(relay, cache.rtt(*relay.address))
+        if best is None or score > best_score:
+            best, best_score = relay, score
+    if best is None:
+        print("No relays pass the filters for this country.")
+        return None
+    print(f"Best ranked relay: {best.nickname} {best.ip}:{best.port} ({best.bandwidth:.2f} MiB/s)")
+    return best.address
 
 # debugging
 if __name__ == "__main__":
     loadDictionary()
     total = returnIP()
-    print(total)
-    print(returnPort(total[1], total[0]))
\ No newline at end of file
+    print(total)
\ No newline at end of file
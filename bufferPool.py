@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# ------------------------------ bufferPool.py ---------------------------- #
+# This script is designed to hand out reusable packet buffers carved from   #
+# one preallocated slab. The packet loops fill these buffers in place with  #
+# readv/recv_into instead of allocating a new bytes object per packet, so   #
+# the steady state of the datapath does not churn the allocator or the GC.  #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import ctypes
+from collections import deque
+
+BUFFER_SIZE  = 65535 # Size of a single packet buffer, large enough for any datagram
+BUFFER_COUNT = 32    # Buffers in the default pool
+
+# A single slot of the slab, exposed both as a memoryview for Python I/O
+# and as a raw address for ctypes copies
+class PacketBuffer:
+    __slots__ = ('view', 'address', 'size')
+
+    def __init__(self, view, address, size):
+        self.view = view
+        self.address = address
+        self.size = size
+
+# A fixed number of equally sized buffers that are acquired and released
+# instead of allocated, deque append/pop keep it safe across threads
+class BufferPool:
+    def __init__(self, count=BUFFER_COUNT, size=BUFFER_SIZE):
+        self.size = size
+        self.slab = bytearray(count * size)
+        self.base = ctypes.addressof((ctypes.c_char * len(self.slab)).from_buffer(self.slab))
+
+        view = memoryview(self.slab)
+        self.buffers = [
+            PacketBuffer(view[i * size:(i + 1) * size], self.base + i * size, size)
+            for i in range(count)
+        ]
+        self.free = deque(self.buffers)
+
+    # Returns a free buffer, or a standalone one if the pool is exhausted
+    def acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            spare = bytearray(self.size)
+            address = ctypes.addressof((ctypes.c_char * self.size).from_buffer(spare))
+            return PacketBuffer(memoryview(spare), address, self.size)
+
+    # Returns a buffer to the pool, standalone buffers are left to the GC
+    def release(self, buffer):
+        if self.base <= buffer.address < self.base + len(self.slab):
+            self.free.append(buffer)
+
+    # Returns the number of buffers currently available
+    def available(self):
+        return len(self.free)
+
+pool = None
+
+# Returns the shared pool, creating it on first use
+def get_pool():
+    global pool
+    if pool is None:
+        pool = BufferPool()
+    return pool
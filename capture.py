@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# ------------------------------- capture.py ------------------------------ #
+# This script is designed to record packets crossing the tunnel without     #
+# tcpdump. Packets picked by 1-in-N sampling or a filter are copied into a  #
+# fixed ring of preallocated slots, overwriting the oldest, and the ring    #
+# can be written out as a pcap file (raw IP link type) on demand or when    #
+# the process receives SIGUSR1. The packet loops only look at it when       #
+# Pipeline.capture is set, so with capture off it costs one branch.         #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import ipaddress
+import itertools
+import os
+import signal
+import struct
+import time
+from array import array
+
+SLOTS   = 4096 # Packets the ring holds
+SNAPLEN = 256  # Bytes kept of each packet, enough for the headers
+SAMPLE  = 1    # Record one packet in every SAMPLE that pass the filter
+CAPTURE_DIR = '.'
+
+OUTBOUND = 0 # TUN -> relay
+INBOUND  = 1 # relay -> TUN
+
+LINKTYPE_RAW = 101 # Packets start directly with the IPv4 or IPv6 header
+PCAP_HEADER = struct.Struct('<IHHiIII') # magic, version, zone, sigfigs, snaplen, link type
+PCAP_RECORD = struct.Struct('<IIII')    # seconds, microseconds, captured length, original length
+PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17, 'icmpv6': 58}
+
+# Returns a filter matching packets by protocol, host and port, any of which may be None
+# host matches either address, port either TCP/UDP port; a packet too short to hold the
+# headers the filter looks at doesn't match
+def makeFilter(protocol=None, host=None, port=None):
+    number = PROTOCOLS.get(protocol, protocol) if protocol is not None else None
+    packed = ipaddress.ip_address(host).packed if host is not None else None
+
+    def match(packet):
+        if not packet:
+            return False
+        version = packet[0] >> 4
+        if version == 4:
+            if len(packet) < 20:
+                return False
+            header = (packet[0] & 0x0F) * 4
+            proto = packet[9]
+            source, destination = packet[12:16], packet[16:20]
+        elif version == 6:
+            if len(packet) < 40:
+                return False
+            header = 40
+            proto = packet[6]
+            source, destination = packet[8:24], packet[24:40]
+        else:
+            return False
+        if number is not None and proto != number:
+            return False
+        if packed is not None and source != packed and destination != packed:
+            return False
+        if port is not None:
+            if proto not in (6, 17) or len(packet) < header + 4:
+                return False
+            ports = struct.unpack_from('!HH', packet, header)
+            if port not in ports:
+                return False
+        return True
+    return match
+
+# Parses a filter written as 'udp', 'tcp port 443', 'host 1.2.3.4 port 53' and so on
+def parseFilter(text):
+    words = text.split()
+    options = {}
+    i = 0
+    while i < len(words):
+        word = words[i].lower()
+        if word in PROTOCOLS:
+            options['protocol'] = word
+            i += 1
+        elif word in ('host', 'port') and i + 1 < len(words):
+            options[word] = int(words[i + 1]) if word == 'port' else words[i + 1]
+            i += 2
+        else:
+            raise ValueError(f"Can't parse capture filter: {text}")
+    return makeFilter(**options)
+
+# A ring of preallocated packet slots, recorded into by the packet loops
+# Writers claim slots from an itertools.count, whose next() is atomic, so the
+# inbound and outbound threads share the ring without a lock
+class CaptureRing:
+    def __init__(self, slots=SLOTS, snaplen=SNAPLEN, sample=SAMPLE, filter=None):
+        self.slots = slots
+        self.snaplen = snaplen
+        self.sample = max(1, sample)
+        self.filter = filter
+        self.buffer = bytearray(slots * snaplen)
+        self.view = memoryview(self.buffer)
+        self.lengths = array('I', bytes(4 * slots))   # original length of each packet
+        self.captured = array('H', bytes(2 * slots))  # bytes kept of each packet
+        self.times = array('d', bytes(8 * slots))
+        self.directions = array('B', bytes(slots))
+        self.counter = itertools.count()
+        self.written = 0   # slots written so far, capped at slots by dump()
+        self.countdown = self.sample
+
+    # Records a packet if it passes the filter and the sampling
+    def record(self, packet, direction):
+        if self.filter is not None and not self.filter(packet):
+            return
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.sample
+
+        index = next(self.counter)
+        slot = index % self.slots
+        size = len(packet)
+        kept = min(size, self.snaplen)
+        start = slot * self.snaplen
+        self.view[start:start + kept] = packet[:kept]
+        self.lengths[slot] = size
+        self.captured[slot] = kept
+        self.times[slot] = time.time()
+        self.directions[slot] = direction
+        self.written = index + 1
+
+    # Returns the slots holding packets, oldest first
+    def order(self):
+        written = self.written
+        if written <= self.slots:
+            return range(written)
+        first = written % self.slots
+        return itertools.chain(range(first, self.slots), range(first))
+
+    # Writes the ring to a pcap file, returns how many packets were written
+    def dump(self, path):
+        slots = list(self.order())
+        with open(path + '.tmp', 'wb') as f:
+            f.write(PCAP_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, self.snaplen, LINKTYPE_RAW))
+            for slot in slots:
+                seconds = self.times[slot]
+                kept = self.captured[slot]
+                start = slot * self.snaplen
+                f.write(PCAP_RECORD.pack(int(seconds), int(seconds % 1 * 1e6), kept, self.lengths[slot]))
+                f.write(self.view[start:start + kept])
+        os.replace(path + '.tmp', path)
+        return len(slots)
+
+    # Writes the ring to a new timestamped file in a directory, returns its path
+    def dumpTo(self, directory=CAPTURE_DIR):
+        path = os.path.join(directory, f"phaethon-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.pcap")
+        count = self.dump(path)
+        print(f"Wrote {count} captured packets to {path}")
+        return path
+
+# Dumps the ring to a file in directory whenever the process receives SIGUSR1
+# Must be called from the main thread
+def installSignal(ring, directory=CAPTURE_DIR):
+    def onSignal(signum, frame):
+        try:
+            ring.dumpTo(directory)
+        except OSError as e:
+            print(f"Could not write the capture: {e}")
+    signal.signal(signal.SIGUSR1, onSignal)
+
+# Passes SIGUSR1 on to every process in pids, for a parent whose workers hold the rings
+# Each worker then writes its own file; pids may still be filled in after this is called
+# Must be called from the main thread
+def forwardSignal(pids):
+    def onSignal(signum, frame):
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGUSR1, onSignal)
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# ----------------------------- concentrator.py --------------------------- #
+# This script is designed to be the far end of the tunnel. It terminates    #
+# the UDP flows of many clients on one port, gives every client an address  #
+# of its own inside a private subnet and forwards packets between the       #
+# clients and its own TUN device, rewriting addresses on the way so clients #
+# that picked the same tunnel address never collide. With a pre-shared key  #
+# it opens sealed datagrams before any session is made for them and seals   #
+# its replies, and clients that coalesce packets into framed datagrams get  #
+# their replies framed the same way. It runs fine entirely on loopback,     #
+# next to a client, for testing.                                            #
+#                                                                           #
+# Reaching networks beyond this host also needs IP forwarding and NAT set   #
+# up for the subnet, e.g. sysctl net.ipv4.ip_forward=1 and a masquerade     #
+# rule, which are left to the administrator.                                #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import adapterscan
+import argparse
+import batchIO
+import bufferPool
+import framing
+import ipaddress
+import mssClamp
+import os
+import select
+import socket
+import threading
+import time
+import tunLinux
+from collections import OrderedDict
+import tunnelCrypto
+
+PORT          = 9001  # UDP port clients connect to
+SUBNET_PREFIX = 16    # Size of the subnet client addresses are handed out from
+IDLE_TIMEOUT  = 300   # Seconds of silence before a client's session is dropped
+SWEEP         = 10    # Seconds between sweeps for idle sessions
+MAX_CLIENTS   = 65000 # Sessions one process will hold
+SOCKET_BUFFER = 4 * 1024 * 1024 # Bytes of socket buffer absorbing bursts from many clients at once
+KEY_DERIVATIONS = 500 # Keys of unknown session ids derived per second at most, bounding what forged datagrams cost
+KEPT_KEYS     = 2 * MAX_CLIENTS # Session keys remembered, past their session's expiry so old datagrams stay replays
+TCP = 6
+UDP = 17
+
+# Replaces the IPv4 address at offset (12 for the source, 16 for the destination),
+# patching the IP header checksum and, for TCP and UDP, the transport checksum whose
+# pseudo-header covers it, with the RFC 1624 incremental update
+def rewriteAddress(packet, offset, address):
+    ihl = (packet[0] & 0x0F) * 4
+    checksums = [10]
+    udp = False
+    if not ((packet[6] & 0x1F) or packet[7]): # only the first fragment carries the transport header
+        protocol = packet[9]
+        if protocol == TCP and len(packet) >= ihl + 18:
+            checksums.append(ihl + 16)
+        elif protocol == UDP and len(packet) >= ihl + 8 and (packet[ihl + 6] or packet[ihl + 7]):
+            checksums.append(ihl + 6)
+            udp = True
+
+    for word in (0, 2):
+        old = (packet[offset + word] << 8) | packet[offset + word + 1]
+        new = (address[word] << 8) | address[word + 1]
+        if old == new:
+            continue
+        for position in checksums:
+            checksum = (packet[position] << 8) | packet[position + 1]
+            checksum = mssClamp.updateChecksum(checksum, old, new)
+            packet[position] = checksum >> 8
+            packet[position + 1] = checksum & 0xFF
+    if udp and not (packet[ihl + 6] or packet[ihl + 7]):
+        packet[ihl + 6] = packet[ihl + 7] = 0xFF # a computed UDP checksum of zero is sent as all ones
+    packet[offset:offset + 4] = address
+
+# One client of the concentrator
+# inner is the address it was given here, client_ip the address it uses on its own side
+# With encryption on, cipher is the responder tunnelCrypto.SessionCipher of the session id
+# the client seals under, which also seals the replies
+# framed is set once the client sends a framed datagram, and from then on its replies are
+# coalesced into framed datagrams too, which is what switches a client's 'auto' framing on
+class Session:
+    __slots__ = ('address', 'inner', 'client_ip', 'cipher', 'framed', 'packets_in', 'bytes_in', 'packets_out', 'bytes_out', 'last_seen')
+
+    def __init__(self, address, inner, now):
+        self.address = address
+        self.inner = inner
+        self.client_ip = None
+        self.cipher = None
+        self.framed = False
+        self.packets_in = 0  # packets from the client
+        self.bytes_in = 0
+        self.packets_out = 0 # packets to the client
+        self.bytes_out = 0
+        self.last_seen = now
+
+# The sessions of every client, found by the client's UDP address on the way in
+# and by its inner address on the way out, both with a single dict lookup
+class SessionTable:
+    def __init__(self, subnet, max_clients=MAX_CLIENTS, idle_timeout=IDLE_TIMEOUT):
+        self.subnet = ipaddress.ip_network(subnet)
+        self.addresses = adapterscan.AddressPool(self.subnet)
+        self.gateway = self.addresses.allocate() # the concentrator's own address on the TUN device
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.by_address = {}
+        self.by_inner = {}
+        self.lock = threading.Lock() # serializes adding and removing sessions
+        self.rejected = 0
+
+    # Returns the session of a client's UDP address, opening one for a new client
+    # Returns None if the table or the subnet is full
+    def session(self, address, now):
+        session = self.by_address.get(address)
+        if session is not None:
+            session.last_seen = now
+            return session
+
+        with self.lock:
+            inner = self.addresses.allocate() if len(self.by_address) < self.max_clients else None
+            if inner is None:
+                self.rejected += 1
+                return None
+            session = Session(address, inner.packed, now)
+            self.by_inner[session.inner] = session
+            self.by_address[address] = session
+        return session
+
+    # Drops the sessions of clients that went quiet, returns how many were dropped
+    def expire(self, now):
+        idle = [session for session in self.by_address.values() if now - session.last_seen > self.idle_timeout]
+        with self.lock:
+            for session in idle:
+                del self.by_address[session.address]
+                del self.by_inner[session.inner]
+                self.addresses.release(session.inner)
+        return len(idle)
+
+    def __len__(self):
+        return len(self.by_address)
+
+# Terminates client flows on a UDP socket and forwards them through a TUN device
+# psk, when given, is the key shared with the clients, whose datagrams must then be
+# sealed with cipher; anything else is dropped without opening a session
+# Each session id has one responder cipher, and so one replay window, bound to the first
+# client address a datagram under it authenticated from: the same datagram sent again from
+# another address is dropped rather than opening a session there
+class Concentrator:
+    def __init__(self, tun, sock, table, psk=None, cipher='aes-gcm', flush_deadline=batchIO.FLUSH_DEADLINE):
+        self.tun = tun
+        self.sock = sock
+        self.table = table
+        self.psk = psk
+        self.cipher = cipher
+        self.flush_deadline = flush_deadline # longest a framed reply is held back for more packets
+        self.stop_event = threading.Event()
+        self.dropped = 0  # packets that weren't IPv4 or had no session
+        self.rejected = 0 # datagrams that failed to open
+        self.keys = OrderedDict() # session id -> (bound client address, responder cipher), least recently used first
+        self.budget = KEY_DERIVATIONS # key derivations left, refilled at KEY_DERIVATIONS per second
+        self.budget_time = time.monotonic()
+        self.threads = []
+
+    # Returns a responder cipher for a session id not seen before, or None once this
+    # second's share of key derivations is spent, as it is for datagrams nobody sealed
+    def deriveCipher(self, sid, now):
+        self.budget = min(KEY_DERIVATIONS, self.budget + (now - self.budget_time) * KEY_DERIVATIONS)
+        self.budget_time = now
+        if self.budget < 1:
+            return None
+        self.budget -= 1
+        return tunnelCrypto.SessionCipher(self.psk, sid, initiator=False, cipher=self.cipher)
+
+    # Opens a client's sealed datagram into out, returning the responder cipher that
+    # opened it and the opened length, or (None, -1)
+    # Keys of a session id not seen before are only kept, bound to the address, once a
+    # datagram sealed under them authenticates
+    def unseal(self, address, datagram, out, now):
+        sid = tunnelCrypto.sessionOf(datagram)
+        if sid is None:
+            return None, -1
+        known = self.keys.get(sid)
+        if known is not None:
+            bound, cipher = known
+            if bound != address:
+                return None, -1
+        else:
+            cipher = self.deriveCipher(sid, now)
+            if cipher is None:
+                return None, -1
+        size = cipher.openInto(datagram, out)
+        if size < 0:
+            return None, -1
+        if known is None:
+            self.keys[sid] = (address, cipher)
+            if len(self.keys) > KEPT_KEYS:
+                self.keys.popitem(last=False)
+        else:
+            self.keys.move_to_end(sid)
+        return cipher, size
+
+    # Forwards one packet from a client into the TUN device
+    def fromClient(self, session, packet):
+        if len(packet) < 20 or packet[0] >> 4 != 4:
+            self.dropped += 1
+            return
+        session.client_ip = bytes(packet[12:16])
+        rewriteAddress(packet, 12, session.inner)
+        session.packets_in += 1
+        session.bytes_in += len(packet)
+        os.write(self.tun, packet)
+
+    # Receives client datagrams and injects the packets they carry into the TUN device
+    def clientLoop(self, pool=None):
+        pool = pool or bufferPool.get_pool()
+        buffer = pool.acquire()
+        view = buffer.view
+        opened = pool.acquire() if self.psk is not None else None
+        next_sweep = time.monotonic() + SWEEP
+
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    n, address = self.sock.recvfrom_into(view)
+                    now = time.monotonic()
+                    datagram = view[:n]
+                    if opened is not None:
+                        cipher, n = self.unseal(address, datagram, opened.view, now)
+                        if cipher is None:
+                            self.rejected += 1
+                            continue
+                        datagram = opened.view[:n]
+                    session = self.table.session(address, now)
+                    if session is None:
+                        self.dropped += 1
+                        continue
+                    if opened is not None:
+                        session.cipher = cipher # a restarted client seals under a new session id
+                    if framing.isFramed(datagram):
+                        session.framed = True
+                        for packet in framing.unpack(datagram):
+                            self.fromClient(session, packet)
+                    else:
+                        self.fromClient(session, datagram)
+                except socket.timeout:
+                    now = time.monotonic()
+                except Exception as e:
+                    print(f"Error receiving from client: {e}")
+                    continue
+
+                if now >= next_sweep:
+                    expired = self.table.expire(now)
+                    if expired:
+                        print(f"Dropped {expired} idle sessions, {len(self.table)} clients connected")
+                    next_sweep = now + SWEEP
+        finally:
+            pool.release(buffer)
+            if opened is not None:
+                pool.release(opened)
+
+    # Sends a datagram to a session's client, sealing it first with encryption on
+    def toClient(self, session, datagram, sealed):
+        if sealed is not None:
+            datagram = sealed.view[:session.cipher.sealInto(datagram, sealed.view)]
+        self.sock.sendto(datagram, session.address)
+
+    # Sends the framed replies started before cutoff, all of them with no cutoff
+    # pending holds them in the order they were started, so the oldest come first
+    def flushPending(self, pending, sealed, cutoff=None):
+        while pending:
+            session, (started, frame) = next(iter(pending.items()))
+            if cutoff is not None and started > cutoff:
+                return
+            del pending[session]
+            try:
+                self.toClient(session, frame, sealed)
+            except OSError as e:
+                print(f"Error forwarding to client: {e}")
+
+    # Reads packets from the TUN device and sends each to the client owning its destination
+    # Replies to clients that frame are held back while the TUN device has more packets
+    # ready, so a burst toward one client leaves in as few framed datagrams as fit, but
+    # never longer than flush_deadline, so a TUN device that is never idle can't stall them
+    def tunLoop(self, pool=None):
+        pool = pool or bufferPool.get_pool()
+        buffer = pool.acquire()
+        view = buffer.view
+        sealed = pool.acquire() if self.psk is not None else None
+        limit = framing.MAX_DATAGRAM - (tunnelCrypto.OVERHEAD if sealed is not None else 0)
+        pending = {} # session -> (when it was started, framed datagram being filled)
+
+        try:
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select([self.tun], [], [], 0 if pending else 1)
+                if not readable:
+                    self.flushPending(pending, sealed)
+                    continue
+                if pending:
+                    self.flushPending(pending, sealed, time.monotonic() - self.flush_deadline)
+                try:
+                    n = os.readv(self.tun, [view])
+                    packet = view[:n]
+                    session = self.table.by_inner.get(bytes(packet[16:20])) if n >= 20 and packet[0] >> 4 == 4 else None
+                    if session is None or session.client_ip is None:
+                        self.dropped += 1
+                        continue
+                    rewriteAddress(packet, 16, session.client_ip)
+                    session.packets_out += 1
+                    session.bytes_out += n
+                    if not session.framed or n + framing.LENGTH.size + 1 > limit:
+                        self.toClient(session, packet, sealed)
+                        continue
+                    started, frame = pending.get(session, (None, None))
+                    if frame is not None and len(frame) + framing.LENGTH.size + n > limit:
+                        del pending[session] # started again below, at the back
+                        self.toClient(session, frame, sealed)
+                        frame = None
+                    if frame is None:
+                        frame = bytearray([framing.FRAME_MAGIC])
+                        pending[session] = (time.monotonic(), frame)
+                    frame += framing.LENGTH.pack(n)
+                    frame += packet
+                except Exception as e:
+                    if not self.stop_event.is_set():
+                        print(f"Error forwarding to client: {e}")
+        finally:
+            pool.release(buffer)
+            if sealed is not None:
+                pool.release(sealed)
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.clientLoop, daemon=True),
+                        threading.Thread(target=self.tunLoop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    # Returns totals across every session
+    def stats(self):
+        sessions = list(self.table.by_address.values())
+        return {
+            'clients': len(sessions),
+            'packets_in': sum(session.packets_in for session in sessions),
+            'bytes_in': sum(session.bytes_in for session in sessions),
+            'packets_out': sum(session.packets_out for session in sessions),
+            'bytes_out': sum(session.bytes_out for session in sessions),
+            'dropped': self.dropped,
+            'rejected': self.table.rejected,
+            'unsealed_rejected': self.rejected,
+        }
+
+# Creates the TUN device and UDP socket and serves clients until interrupted
+# subnet defaults to the lowest free /16 of 10.0.0.0/8 not used by a local network
+# key_file holds the key shared with the clients, requiring their datagrams to be sealed
+def run(port=PORT, bind='0.0.0.0', subnet=None, tun_name='PhaethonSrv', idle_timeout=IDLE_TIMEOUT, max_clients=MAX_CLIENTS, report=60,
+        key_file=None, cipher='aes-gcm'):
+    psk = tunnelCrypto.loadKey(key_file) if key_file is not None else None
+    if subnet is None:
+        subnet = adapterscan.localAllocator(skip_first=100).allocate(SUBNET_PREFIX)
+    table = SessionTable(subnet, max_clients, idle_timeout)
+
+    tun = tunLinux.create_tun(tun_name)
+    tunLinux.configure_tun(tun_name, f"{table.gateway}/{table.subnet.prefixlen}")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    sock.bind((bind, port))
+    sock.settimeout(1)
+    print(f"Concentrator listening on {bind}:{port}, clients get addresses in {table.subnet} via {tun_name}")
+
+    concentrator = Concentrator(tun, sock, table, psk, cipher).start()
+    try:
+        while True:
+            time.sleep(report)
+            stats = concentrator.stats()
+            print(f"{stats['clients']} clients, {stats['packets_in']} packets in, {stats['packets_out']} packets out, {stats['dropped']} dropped, "
+                  f"{stats['unsealed_rejected']} failed to open")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        concentrator.stop()
+        os.close(tun)
+        sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a PhaethonVPN concentrator that clients can use as their relay.")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--bind', default='0.0.0.0', help="Address to listen on, 127.0.0.1 for loopback tests")
+    parser.add_argument('--subnet', help="Subnet client addresses are handed out from, e.g. 10.200.0.0/16")
+    parser.add_argument('--tun-name', dest='tun_name', default='PhaethonSrv')
+    parser.add_argument('--idle-timeout', dest='idle_timeout', type=float, default=IDLE_TIMEOUT)
+    parser.add_argument('--max-clients', dest='max_clients', type=int, default=MAX_CLIENTS)
+    parser.add_argument('--report', type=float, default=60, help="Seconds between traffic reports")
+    parser.add_argument('--key-file', dest='key_file', help="File holding the 32 byte key shared with the clients, requiring sealed datagrams")
+    parser.add_argument('--cipher', choices=tunnelCrypto.CIPHERS, default='aes-gcm')
+    args = parser.parse_args()
+    run(**vars(args))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# ------------------------------- dnsCache.py ----------------------------- #
+# This script is designed to answer repeated DNS lookups without a round    #
+# trip to the relay. Queries to port 53 read from the TUN device are looked #
+# up in an LRU cache and, on a hit, answered with a reply packet written    #
+# straight back into the TUN device, its TTLs counted down by the time the  #
+# answer spent in the cache. Misses go through the tunnel as usual and the  #
+# responses coming back fill the cache, including negative answers, and an  #
+# answer close to expiry is refreshed in the background before it runs out. #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import mssClamp
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE   = 4096  # Answers kept
+NEGATIVE_TTL = 60    # Seconds NXDOMAIN and empty answers are kept, 0 to not keep them
+PREFETCH     = 0.1   # Refresh an answer once this fraction of its TTL is left, 0 to never
+MAX_TTL      = 86400 # Longest any answer is kept, whatever its records say
+PENDING      = 4096  # Queries waiting for a response that are remembered
+
+DNS_PORT = 53
+UDP = 17
+OPT = 41 # EDNS pseudo-record, whose TTL field holds flags
+SOA = 6
+NOERROR = 0
+NXDOMAIN = 3
+HEADER = struct.Struct('!HHHHHH') # id, flags, questions, answers, authorities, additionals
+MIN_QUERY = 20 + 8 + HEADER.size + 5 # IPv4 and UDP headers, DNS header, root name and type/class
+
+# Folds a ones' complement sum down to 16 bits
+def fold(total):
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return total
+
+# Returns the ones' complement sum of data's 16 bit words in network order
+# Words are summed in native order and swapped once at the end (RFC 1071)
+def onesSum(data):
+    if len(data) % 2:
+        data = bytes(data) + b'\0'
+    total = fold(sum(memoryview(data).cast('H')))
+    if sys.byteorder == 'little':
+        total = ((total & 0xFF) << 8) | (total >> 8)
+    return total
+
+# Returns the offset just past the name starting at offset, following no pointers
+def skipName(message, offset):
+    while True:
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+        if length == 0:
+            return offset
+
+# Returns True if a packet is UDP to (at=2) or from (at=0) port 53, checked cheaply
+def isPort(packet, at):
+    if len(packet) < MIN_QUERY:
+        return False
+    if packet[0] >> 4 == 4:
+        header = (packet[0] & 0x0F) * 4 + at
+        return packet[9] == UDP and header + 1 < len(packet) and not packet[header] and packet[header + 1] == DNS_PORT
+    return packet[6] == UDP and not packet[40 + at] and packet[41 + at] == DNS_PORT
+
+# Returns the header offset, source port, destination port and IP version of a UDP packet, or None
+def udpPorts(packet):
+    version = packet[0] >> 4
+    if version == 4:
+        if packet[9] != UDP or (packet[6] & 0x3F) or packet[7]: # fragments carry no usable header
+            return None
+        header = (packet[0] & 0x0F) * 4
+    elif version == 6:
+        if packet[6] != UDP:
+            return None
+        header = 40
+    else:
+        return None
+    if len(packet) < header + 8 + HEADER.size:
+        return None
+    source, destination = struct.unpack_from('!HH', packet, header)
+    return header, source, destination, version
+
+# Returns the cache key of a DNS message with a single question, and where the question ends
+def questionKey(message):
+    end = skipName(message, 12)
+    if end + 4 > len(message):
+        raise ValueError("truncated question")
+    return bytes(message[12:end]).lower() + bytes(message[end:end + 4]), end + 4
+
+# Returns the records' (offset of the TTL, TTL) pairs and how long the message may be cached
+# An answer is kept for its shortest TTL, a negative one for its SOA's minimum, capped by negative_ttl
+def recordTTLs(message, start, negative_ttl):
+    _, flags, _, answers, authorities, additionals = HEADER.unpack_from(message)
+    offset = start
+    ttls = []
+    soa_ttl = None
+    for _ in range(answers + authorities + additionals):
+        offset = skipName(message, offset)
+        kind, _, ttl, length = struct.unpack_from('!HHIH', message, offset)
+        if kind != OPT:
+            ttls.append((offset + 4, ttl))
+            if kind == SOA:
+                # SOA data ends with five 32 bit fields, the last being the negative caching TTL
+                minimum = struct.unpack_from('!I', message, offset + 10 + length - 4)[0]
+                soa_ttl = min(ttl, minimum)
+        offset += 10 + length
+    if offset > len(message):
+        raise ValueError("truncated record")
+
+    if flags & 0x0F == NXDOMAIN or not answers:
+        lifetime = min(negative_ttl, soa_ttl if soa_ttl is not None else negative_ttl)
+    else:
+        lifetime = min(ttl for _, ttl in ttls[:answers]) if answers else 0
+    return ttls, min(lifetime, MAX_TTL)
+
+# One cached answer
+class Entry:
+    __slots__ = ('message', 'ttls', 'stored', 'lifetime', 'negative', 'prefetching')
+
+    def __init__(self, message, ttls, stored, lifetime, negative):
+        self.message = message  # the response, id and all
+        self.ttls = ttls        # (offset, TTL) of every record
+        self.stored = stored
+        self.lifetime = lifetime
+        self.negative = negative
+        self.prefetching = False
+
+# A DNS cache sitting in both directions of the pipeline
+# Only responses to queries seen going out are cached, matched by id, client port
+# and question, so nothing arriving unasked can end up in the cache
+# tun must be set to the TUN file descriptor replies are written to before packets flow
+class DNSCache:
+    def __init__(self, size=CACHE_SIZE, negative_ttl=NEGATIVE_TTL, prefetch=PREFETCH):
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.prefetch = prefetch
+        self.tun = None
+        self.entries = OrderedDict() # key -> Entry, least recently used first
+        self.pending = OrderedDict() # (id, client port) -> (key, prefetch)
+        self.lock = threading.Lock()  # the outbound and inbound stages run on different threads
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.prefetches = 0
+
+    # Returns the share of queries answered from the cache
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    # Remembers a query forwarded to the relay so its response can be cached
+    # Called with the lock held
+    def expect(self, ident, port, key, prefetch=False):
+        self.pending[(ident, port)] = (key, prefetch)
+        if len(self.pending) > PENDING:
+            self.pending.popitem(last=False)
+
+    # Outbound stage: answers a query from the cache or lets it through
+    def outbound(self, packet):
+        if not isPort(packet, 2): # most packets leave here
+            return packet
+        ports = udpPorts(packet)
+        if ports is None:
+            return packet
+        header, source, _, version = ports
+        message = packet[header + 8:]
+        try:
+            ident, flags, questions, _, _, _ = HEADER.unpack_from(message)
+            if flags & 0xF800 or questions != 1: # responses, other opcodes and odd queries pass untouched
+                return packet
+            key, end = questionKey(message)
+        except (IndexError, ValueError, struct.error):
+            return packet
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry.stored >= entry.lifetime:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                self.expect(ident, source, key)
+                return packet
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if entry.negative:
+                self.negative_hits += 1
+            # Close to expiry, the query also goes on under a new id to refresh the
+            # answer, and its response updates the cache and goes no further
+            fresh = None
+            if self.prefetch and not entry.prefetching and entry.lifetime - (now - entry.stored) < entry.lifetime * self.prefetch:
+                entry.prefetching = True
+                self.prefetches += 1
+                fresh = random.getrandbits(16)
+                self.expect(fresh, source, key, True)
+
+        self.reply(packet, header, version, message, end, entry, now)
+        if fresh is None:
+            return None
+        setIdent(packet, header, version, fresh)
+        return packet
+
+    # Inbound stage: caches responses to queries seen going out
+    def inbound(self, packet):
+        if not isPort(packet, 0):
+            return packet
+        ports = udpPorts(packet)
+        if ports is None:
+            return packet
+        header, _, destination, _ = ports
+        message = packet[header + 8:]
+        try:
+            ident, flags, questions, _, _, _ = HEADER.unpack_from(message)
+        except struct.error:
+            return packet
+        with self.lock:
+            pending = self.pending.pop((ident, destination), None)
+        if pending is None:
+            return packet
+        key, prefetch = pending
+
+        rcode = flags & 0x0F
+        try:
+            if not flags & 0x8000 or flags & 0x0200 or questions != 1 or rcode not in (NOERROR, NXDOMAIN):
+                raise ValueError("not cacheable") # queries, truncated answers and failures
+            answer_key, start = questionKey(message)
+            if answer_key != key:
+                raise ValueError("question mismatch")
+            ttls, lifetime = recordTTLs(message, start, self.negative_ttl)
+        except (IndexError, ValueError, struct.error):
+            return None if prefetch else packet
+
+        if lifetime > 0:
+            negative = rcode == NXDOMAIN or HEADER.unpack_from(message)[3] == 0
+            entry = Entry(bytes(message), ttls, time.monotonic(), lifetime, negative)
+            with self.lock:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return None if prefetch else packet
+
+    # Writes a reply to a query into the TUN device, built from a cached answer
+    def reply(self, query, header, version, question, end, entry, now):
+        message = bytearray(entry.message)
+        message[0:2] = question[0:2]       # the query's id
+        message[12:end] = question[12:end] # the question as asked, keeping its letter case
+        elapsed = int(now - entry.stored)
+        for offset, ttl in entry.ttls:
+            struct.pack_into('!I', message, offset, max(ttl - elapsed, 0))
+
+        source, destination = struct.unpack_from('!HH', query, header)
+        length = 8 + len(message)
+        if version == 4:
+            packet = bytearray(20 + length)
+            struct.pack_into('!BBHHHBBH4s4s', packet, 0, 0x45, 0, len(packet), 0, 0x4000, 64, UDP, 0,
+                             bytes(query[16:20]), bytes(query[12:16]))
+            struct.pack_into('!H', packet, 10, ~onesSum(packet[:20]) & 0xFFFF)
+            pseudo = onesSum(packet[12:20]) + UDP + length
+        else:
+            packet = bytearray(40 + length)
+            struct.pack_into('!IHBB16s16s', packet, 0, 0x60000000, length, UDP, 64,
+                             bytes(query[24:40]), bytes(query[8:24]))
+            pseudo = onesSum(packet[8:40]) + UDP + length
+        offset = len(packet) - length
+        struct.pack_into('!HHHH', packet, offset, destination, source, length, 0)
+        packet[offset + 8:] = message
+        checksum = ~fold(onesSum(packet[offset:]) + pseudo) & 0xFFFF
+        struct.pack_into('!H', packet, offset + 6, checksum or 0xFFFF)
+        os.write(self.tun, packet)
+
+# Changes the DNS id of a UDP packet in place, patching the UDP checksum
+def setIdent(packet, header, version, ident):
+    old = (packet[header + 8] << 8) | packet[header + 9]
+    packet[header + 8] = ident >> 8
+    packet[header + 9] = ident & 0xFF
+    checksum = (packet[header + 6] << 8) | packet[header + 7]
+    if checksum or version == 6: # an IPv4 checksum of zero means none was computed
+        checksum = mssClamp.updateChecksum(checksum, old, ident) or 0xFFFF
+        packet[header + 6] = checksum >> 8
+        packet[header + 7] = checksum & 0xFF
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# ----------------------------- flowBalancer.py --------------------------- #
+# This script is designed to spread a tunnel's traffic across several       #
+# relays. Every packet's IP 5-tuple is hashed into a fixed table of buckets #
+# that are shared out between the relays in proportion to their bandwidth,  #
+# so each flow always leaves through the same relay and TCP never sees its  #
+# segments reordered, while the flows as a whole use every relay.           #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import bridges
+import hashlib
+import math
+import relayCache
+import zlib
+
+BUCKETS  = 4096 # Size of the bucket table, a power of two
+PORTS    = (6, 17) # TCP and UDP carry ports right after the IP header
+MIN_WEIGHT = 0.01  # Weight given to relays reporting no bandwidth
+
+# Returns a 32 bit hash of the packet's flow: addresses, protocol and, for TCP/UDP, ports
+# Fragments are hashed on their addresses alone so every fragment of a datagram stays together
+def flowHash(packet):
+    version = packet[0] >> 4
+    if version == 4:
+        ihl = (packet[0] & 0x0F) * 4
+        protocol = packet[9]
+        flow = zlib.crc32(packet[12:20], protocol)
+        fragmented = (packet[6] & 0x3F) or packet[7]
+        if protocol in PORTS and not fragmented and len(packet) >= ihl + 4:
+            flow = zlib.crc32(packet[ihl:ihl + 4], flow)
+        return flow
+    if version == 6:
+        protocol = packet[6]
+        flow = zlib.crc32(packet[8:40], protocol)
+        if protocol in PORTS and len(packet) >= 44:
+            flow = zlib.crc32(packet[40:44], flow)
+        return flow
+    return zlib.crc32(packet[:20])
+
+# Returns a uniform value in (0, 1) for a bucket and relay pair
+def bucketDraw(bucket, destination):
+    digest = hashlib.blake2b(f"{bucket}|{destination[0]}|{destination[1]}".encode(), digest_size=8).digest()
+    return (int.from_bytes(digest, 'big') + 1) / (2 ** 64 + 1)
+
+# Assigns every bucket to a relay with weighted rendezvous hashing, so each relay's share of
+# buckets follows its weight and adding or removing a relay only moves that relay's buckets
+def buildTable(relays, buckets=BUCKETS):
+    table = []
+    for bucket in range(buckets):
+        best = max(relays, key=lambda relay: -relay[1] / math.log(bucketDraw(bucket, relay[0])))
+        table.append(best[0])
+    return table
+
+# Routes packets to one of several relays by the hash of their flow
+class FlowBalancer:
+    def __init__(self, relays, buckets=BUCKETS):
+        # relays is a list of ((ip, port), weight)
+        self.relays = [(destination, max(weight, MIN_WEIGHT)) for destination, weight in relays]
+        self.mask = buckets - 1
+        self.table = buildTable(self.relays, buckets)
+
+    # Swaps the relay old for new with the given weight; rendezvous hashing only moves
+    # the buckets old held or new wins, and the new table goes live in one assignment
+    def replace(self, old, new, weight):
+        relays = [(new, max(weight, MIN_WEIGHT)) if destination == old else (destination, w)
+                  for destination, w in self.relays]
+        self.table = buildTable(relays, len(self.table))
+        self.relays = relays
+
+    # Drops a relay, handing its buckets to the others while every other bucket stays put
+    # Returns False, leaving the relay in place, if it is the last one
+    def remove(self, destination):
+        relays = [(d, w) for d, w in self.relays if d != destination]
+        if not relays or len(relays) == len(self.relays):
+            return False
+        self.table = buildTable(relays, len(self.table))
+        self.relays = relays
+        return True
+
+    # Returns the relay a packet's flow is pinned to, usable as Pipeline.router
+    def route(self, packet):
+        return self.table[flowHash(packet) & self.mask]
+
+    # Returns the fraction of buckets held by each relay
+    def shares(self):
+        counts = {}
+        for destination in self.table:
+            counts[destination] = counts.get(destination, 0) + 1
+        return {destination: count / len(self.table) for destination, count in counts.items()}
+
+# Returns the primary relay plus the next best ranked relays of the country, count in total,
+# as ((ip, port), bandwidth) pairs ready for FlowBalancer
+# Relays are told apart by IP and port, but only one relay per IP is balanced across
+# since relays sharing a host share its uplink
+def selectRelays(country, count, primary):
+    cache = relayCache.get_cache()
+    primary = (primary[0], int(primary[1]))
+    chosen = [primary]
+    seen = {primary[0]}
+    weights = {}
+
+    ranked = []
+    for relay in bridges.rankRelays(country):
+        if relay.address == primary:
+            weights[primary] = relay.bandwidth
+        if relay.ip in seen:
+            continue
+        seen.add(relay.ip)
+        ranked.append(relay)
+
+    ranked.sort(key=lambda relay: bridges.scoreRelay(relay, cache.rtt(*relay.address)), reverse=True)
+    for relay in ranked[:count - 1]:
+        chosen.append(relay.address)
+        weights[relay.address] = relay.bandwidth
+
+    return [(destination, weights.get(destination, MIN_WEIGHT)) for destination in chosen]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# ------------------------------- framing.py ------------------------------ #
+# This script is designed to pack several small IP packets into a single    #
+# UDP datagram. A framed datagram starts with FRAME_MAGIC followed by each  #
+# packet prefixed with its 16 bit length. Raw IP packets always start with  #
+# version 4 or 6, so both kinds can share the wire and the receiving side   #
+# tells them apart from the first byte alone.                               #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import struct
+
+FRAME_MAGIC  = 0x01 # First byte of a framed datagram, never a valid IP version nibble
+LENGTH       = struct.Struct('!H')
+MAX_DATAGRAM = 1472 # UDP payload that fits a 1500 byte path MTU
+
+# Yields the IP packets carried in a framed datagram, stopping at a truncated entry
+def unpack(datagram):
+    offset = 1
+    end = len(datagram)
+    while offset + LENGTH.size <= end:
+        (length,) = LENGTH.unpack_from(datagram, offset)
+        offset += LENGTH.size
+        if offset + length > end:
+            return
+        yield datagram[offset:offset + length]
+        offset += length
+
+# Returns True if a datagram received from the server is framed
+def isFramed(datagram):
+    return len(datagram) > 0 and datagram[0] == FRAME_MAGIC
+
+# Decides whether outbound bursts are coalesced and does the packing
+# mode = 'on' always frames, 'off' never frames, 'auto' starts framing once the
+# peer has sent a framed datagram, proving it understands them
+class Framer:
+    def __init__(self, mode='auto', max_datagram=MAX_DATAGRAM):
+        self.mode = mode
+        self.enabled = mode == 'on'
+        self.max_datagram = max_datagram
+        self.packets = 0   # Packets handed to coalesce()
+        self.datagrams = 0 # Datagrams coalesce() produced from them
+
+    # Notes a framed datagram from the peer, switching framing on in auto mode
+    def observe(self):
+        if self.mode == 'auto' and not self.enabled:
+            self.enabled = True
+            print("Peer sends framed datagrams, enabling packet coalescing.")
+
+    # Packs the packets of a batchIO.PacketBatch into the slots of another one
+    # Packets headed to the same destination share datagrams up to max_datagram bytes,
+    # packets too large to frame are copied through as they are
+    def coalesce(self, batch, out):
+        out.clear()
+        if out.destination != batch.destination and batch.destination is not None:
+            out.setDestination(*batch.destination)
+
+        limit = min(self.max_datagram, out.buffer_size)
+        open_frames = {} # destination -> slot of the datagram still being filled
+        for i in range(batch.count):
+            packet = batch.packet(i)
+            size = len(packet)
+            target = batch.targets[i]
+
+            if size + LENGTH.size + 1 > limit:
+                slot = out.count
+                out.slots[slot][:size] = packet
+                out.lengths[slot] = size
+                out.targets[slot] = target
+                out.count += 1
+                continue
+
+            slot = open_frames.get(target)
+            if slot is None or out.lengths[slot] + LENGTH.size + size > limit:
+                slot = out.count
+                out.slots[slot][0] = FRAME_MAGIC
+                out.lengths[slot] = 1
+                out.targets[slot] = target
+                out.count += 1
+                open_frames[target] = slot
+
+            view = out.slots[slot]
+            offset = out.lengths[slot]
+            LENGTH.pack_into(view, offset, size)
+            offset += LENGTH.size
+            view[offset:offset + size] = packet
+            out.lengths[slot] = offset + size
+
+        self.packets += batch.count
+        self.datagrams += out.count
+        return out.count
+
+    # Returns how many packets each datagram carried on average
+    def ratio(self):
+        return self.packets / self.datagrams if self.datagrams else 1.0
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# ------------------------------- headless.py ----------------------------- #
+# This script is designed to start the tunnel without any prompts, for      #
+# servers and scripted deployments. The country, relay policy and tunnel    #
+# parameters come from command line arguments or a JSON config file, and    #
+# the time taken to bring the tunnel up and pass the first packet in each   #
+# direction is logged from process start.                                   #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import argparse
+import batchIO
+import json
+import time
+
+# Options accepted by tunLinux.run, with the values used when neither the
+# command line nor the config file sets them
+# None leaves an option of an optional stage to tunLinux.run, which takes it from the
+# stage's module only once the stage is on, so none of them is loaded here
+DEFAULTS = {
+    'country': None,
+    'relay': None,
+    'policy': 'fastest',
+    'stable_only': False,
+    'min_bandwidth': 0.0,
+    'mode': 'batch',
+    'batch_size': batchIO.BATCH_SIZE,
+    'flush_deadline': batchIO.FLUSH_DEADLINE,
+    'multi_queue': False,
+    'workers': None,
+    'failover': False,
+    'relays': 1,
+    'coalesce': 'off',
+    'mtu': 'auto',
+    'metrics_port': None,
+    'capture_sample': None,
+    'capture_filter': None,
+    'capture_dir': None,
+    'queuing': None,
+    'queue_drop': 'tail',
+    'queue_rate': None,
+    'split_include': None,
+    'split_exclude': None,
+    'dns_cache': None,
+    'dns_negative_ttl': None,
+    'dns_prefetch': None,
+    'key_file': None,
+    'cipher': None,
+    'relay_reload': None,
+}
+
+# Returns the options stored in a JSON config file, rejecting unknown keys
+def loadConfig(path):
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path}: expected a JSON object")
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"{path}: unknown options {', '.join(sorted(unknown))}")
+    return config
+
+# Returns an MTU argument, either 'auto', 'kernel' (None) or a number
+def mtuValue(value):
+    if value is None or value == 'kernel':
+        return None
+    if value == 'auto':
+        return value
+    return int(value)
+
+# Parses the headless command line, values given there override the config file
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog='main.py --headless', description="Start PhaethonVPN without prompts.")
+    parser.add_argument('--headless', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help="JSON file holding any of the options below")
+    parser.add_argument('--country', help="Country code to pick a relay from, e.g. 'de'")
+    parser.add_argument('--relay', help="Relay to use as IP or IP:PORT, skipping relay selection")
+    parser.add_argument('--policy', choices=('fastest', 'ranked'),
+                        help="'fastest' probes relays (or uses cached RTTs), 'ranked' takes the best scored relay without probing")
+    parser.add_argument('--stable-only', dest='stable_only', action='store_const', const=True, help="Only use relays flagged Stable")
+    parser.add_argument('--min-bandwidth', dest='min_bandwidth', type=float, help="Minimum relay bandwidth in MiB/s")
+    parser.add_argument('--mode', choices=('packet', 'batch', 'async'))
+    parser.add_argument('--batch-size', dest='batch_size', type=int)
+    parser.add_argument('--flush-deadline', dest='flush_deadline', type=float, help="Seconds before a partial burst is flushed")
+    parser.add_argument('--multi-queue', dest='multi_queue', action='store_const', const=True)
+    parser.add_argument('--workers', type=int, help="Queue worker processes with --multi-queue")
+    parser.add_argument('--failover', action='store_const', const=True)
+    parser.add_argument('--relays', type=int, help="Number of relays to balance flows across")
+    parser.add_argument('--coalesce', choices=('on', 'off', 'auto'))
+    parser.add_argument('--mtu', help="'auto', 'kernel' or a number")
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, help="Serve Prometheus metrics on this localhost port")
+    parser.add_argument('--capture-sample', dest='capture_sample', type=int, help="Capture 1 in N packets, SIGUSR1 writes them as pcap")
+    parser.add_argument('--capture-filter', dest='capture_filter', help="Capture only matching packets, e.g. 'tcp port 443' or 'host 1.2.3.4'")
+    parser.add_argument('--capture-dir', dest='capture_dir', help="Directory capture files are written to")
+    parser.add_argument('--queuing', choices=('strict', 'drr'), help="Queue outbound packets by class so interactive traffic goes first")
+    parser.add_argument('--queue-drop', dest='queue_drop', choices=('tail', 'head'), help="Which packet a full class queue drops")
+    parser.add_argument('--queue-rate', dest='queue_rate', type=float, help="Mbit/s to pace queued packets at, just below the relay's capacity")
+    parser.add_argument('--split-include', dest='split_include', action='append',
+                        help="Prefix, or file of prefixes, to send through the tunnel, repeatable; everything else bypasses it")
+    parser.add_argument('--split-exclude', dest='split_exclude', action='append',
+                        help="Prefix, or file of prefixes, to keep out of the tunnel, repeatable")
+    parser.add_argument('--dns-cache', dest='dns_cache', type=int, help="Answer repeated DNS queries from a cache of this many answers")
+    parser.add_argument('--dns-negative-ttl', dest='dns_negative_ttl', type=float, help="Seconds to keep NXDOMAIN and empty answers, 0 to not keep them")
+    parser.add_argument('--dns-prefetch', dest='dns_prefetch', type=float, help="Refresh cached answers with this fraction of their TTL left, 0 to never")
+    parser.add_argument('--key-file', dest='key_file', help="File holding the 32 byte key shared with the relay, sealing every datagram")
+    parser.add_argument('--cipher', help="AEAD cipher used with --key-file, 'aes-gcm' or 'chacha20'")
+    parser.add_argument('--relay-reload', dest='relay_reload', type=float,
+                        help="Seconds between checks of the relay csv for changes to pick up, 0 to never check")
+    args = parser.parse_args(argv)
+
+    options = dict(DEFAULTS)
+    if args.config:
+        try:
+            options.update(loadConfig(args.config))
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    for key in DEFAULTS:
+        value = getattr(args, key)
+        if value is not None:
+            options[key] = value
+    options['mtu'] = mtuValue(options['mtu'])
+    if options['capture_filter']:
+        import capture # only loaded with a capture filter to check
+        try:
+            capture.parseFilter(options['capture_filter'])
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options['key_file'] is not None:
+        import tunnelCrypto # only loaded with sealing on
+        if options['cipher'] is not None and options['cipher'] not in tunnelCrypto.CIPHERS:
+            parser.error(f"--cipher must be one of {', '.join(tunnelCrypto.CIPHERS)}")
+        try:
+            tunnelCrypto.loadKey(options['key_file'])
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+    if options['queuing'] is not None and options['mode'] == 'async':
+        parser.error("--queuing needs --mode packet or batch")
+
+    if options['country'] is None and options['relay'] is None:
+        parser.error("--country or --relay is required in headless mode")
+    if options['country'] is None and (options['failover'] or options['relays'] > 1):
+        parser.error("--failover and --relays need --country to choose standby relays from")
+    if options['country'] is not None:
+        options['country'] = options['country'].lower()
+    return options
+
+# Splits an 'IP' or 'IP:PORT' relay argument into its address and port (or None)
+def parseRelay(relay):
+    ip, _, port = relay.partition(':')
+    return ip, int(port) if port else None
+
+# A pipeline stage logging how long after start the first packet passed it
+# Afterwards it costs one attribute check per packet
+class FirstPacketTimer:
+    def __init__(self, started, label):
+        self.started = started
+        self.label = label
+        self.pending = True
+
+    def __call__(self, packet):
+        if self.pending:
+            self.pending = False
+            print(f"First packet {self.label} {(time.monotonic() - self.started) * 1000:.1f} ms after start")
+        return packet
@@ -9,6 +9,9 @@
 # This script is part of the PhaethonVPN project.          v0.0.2           #
 # --------------------------------- s3B-a --------------------------------- #
 
+import time
+STARTED = time.monotonic() # taken before anything else loads, for startup timing
+
 import ctypes
 import os
 import platform
@@ -27,7 +30,37 @@ def main():
     else:
         raise ImportError("Unsupported platform: " + platform)
     
-    tun.run()
+    if platform.startswith('win32'):
+        tun.run(metrics_port=metricsPort(sys.argv[1:]))
+    else:
+        tun.run()
+
+# Returns the port given with --metrics-port, or None to serve no metrics
+def metricsPort(argv):
+    if '--metrics-port' not in argv:
+        return None
+    position = argv.index('--metrics-port') + 1
+    if position >= len(argv) or not argv[position].isdigit():
+        print("--metrics-port needs a port number, serving no metrics.")
+        return None
+    return int(argv[position])
+
+# Starts the tunnel without prompts from command line arguments or a config file
+# Only the Linux tunnel supports it, and it must already run as root since
+# there is no terminal to relaunch into
+def headlessMain():
+    if not sys.platform.startswith('linux'):
+        print("Headless mode is only supported on Linux.")
+        sys.exit(1)
+    if os.geteuid() != 0:
+        print("Headless mode must be started as root.")
+        sys.exit(1)
+
+    import headless
+    options = headless.parseArguments(sys.argv[1:])
+
+    import tunLinux
+    tunLinux.run(**options, started=STARTED)
 
 # Checks if the script is running with administrator privileges on Windows
 def administratorCheck():
@@ -37,6 +70,10 @@ def administratorCheck():
         return False
 
 if __name__ == "__main__":
+    if "--headless" in sys.argv[1:]:
+        headlessMain()
+        sys.exit()
+
     system = platform.system()
 
     # Checks if the script is running as administrator prior to execution
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# ------------------------------- metrics.py ------------------------------ #
+# This script is designed to count what the datapath does without slowing   #
+# it down. Every packet loop thread updates its own set of counters, so no  #
+# locks are taken per packet, and the counters of all threads are summed    #
+# only when they are scraped from a small HTTP endpoint on localhost that   #
+# speaks the Prometheus text format.                                        #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import threading
+
+METRICS_PORT    = 9469 # Default localhost port the endpoint listens on
+LATENCY_SHIFT   = 10   # The first histogram bucket holds calls under 2**10 ns (~1 us)
+LATENCY_BUCKETS = 21   # Powers of two up to 2**30 ns (~1.07 s), then +Inf
+PREFIX = 'phaethon'
+
+# Returns a label value escaped for the text format: backslash, double quote and newline
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Returns help text escaped for the text format: backslash and newline
+def escapeHelp(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+# A latency histogram with power of two nanosecond buckets
+# Finding the bucket is a bit_length() call, so observing costs no search
+class Histogram:
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (LATENCY_BUCKETS + 1)
+        self.total = 0 # nanoseconds
+
+    def observe(self, ns):
+        i = ns.bit_length() - LATENCY_SHIFT
+        if i < 0:
+            i = 0
+        elif i > LATENCY_BUCKETS:
+            i = LATENCY_BUCKETS
+        self.counts[i] += 1
+        self.total += ns
+
+# The counters of one packet loop thread in one direction
+# Only the owning thread writes them, the scraper just reads
+class Counters:
+    __slots__ = ('direction', 'packets', 'bytes', 'drops', 'errors', 'queue_depth', 'send', 'recv')
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.packets = 0     # packets handed on
+        self.bytes = 0       # bytes of those packets
+        self.drops = 0       # packets consumed by a stage or with nowhere to go
+        self.errors = 0      # failed system calls
+        self.queue_depth = 0 # packets waiting to be handed on, where the loop queues any
+        self.send = Histogram() # time spent in the call handing packets on
+        self.recv = Histogram() # time spent in the call fetching packets, including any blocking wait
+
+# Every thread's counters, plus gauges read from elsewhere at scrape time
+class Registry:
+    def __init__(self):
+        self.counters = {} # (direction, thread id) -> Counters
+        self.gauges = []   # (name, kind, help, read)
+        self.lock = threading.Lock()
+
+    # Returns the calling thread's counters for a direction, creating them on first use
+    def get(self, direction):
+        key = (direction, threading.get_ident())
+        counters = self.counters.get(key)
+        if counters is None:
+            with self.lock:
+                counters = self.counters.setdefault(key, Counters(direction))
+        return counters
+
+    # Adds a metric whose value is read when scraped
+    # read returns a number, or a list of (labels dict, number) pairs
+    def addMetric(self, name, kind, help, read):
+        with self.lock:
+            self.gauges.append((name, kind, help, read))
+
+    # Returns the counters summed per direction
+    def totals(self):
+        with self.lock:
+            counters = list(self.counters.values())
+        totals = {}
+        for c in counters:
+            total = totals.get(c.direction)
+            if total is None:
+                total = totals[c.direction] = Counters(c.direction)
+            total.packets += c.packets
+            total.bytes += c.bytes
+            total.drops += c.drops
+            total.errors += c.errors
+            total.queue_depth += c.queue_depth
+            for mine, theirs in ((total.send, c.send), (total.recv, c.recv)):
+                mine.total += theirs.total
+                for i, count in enumerate(theirs.counts):
+                    mine.counts[i] += count
+        return totals
+
+    # Returns every metric in the Prometheus text exposition format
+    def render(self):
+        totals = self.totals()
+        lines = []
+
+        def series(name, kind, help, values):
+            lines.append(f"# HELP {PREFIX}_{name} {escapeHelp(help)}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in values:
+                label = ','.join(f'{key}="{escapeLabel(val)}"' for key, val in labels.items())
+                lines.append(f"{PREFIX}_{name}{{{label}}} {value}" if label else f"{PREFIX}_{name} {value}")
+
+        for name, help, attribute in (('packets_total', "Packets handed on.", 'packets'),
+                                      ('bytes_total', "Bytes handed on.", 'bytes'),
+                                      ('drops_total', "Packets dropped.", 'drops'),
+                                      ('errors_total', "Failed system calls.", 'errors')):
+            series(name, 'counter', help, [({'direction': d}, getattr(t, attribute)) for d, t in totals.items()])
+        series('queue_depth', 'gauge', "Packets waiting to be handed on.",
+               [({'direction': d}, t.queue_depth) for d, t in totals.items()])
+
+        for name, help, attribute in (('send_latency_seconds', "Time spent in calls handing packets on.", 'send'),
+                                      ('recv_latency_seconds', "Time spent in calls fetching packets, including waits.", 'recv')):
+            lines.append(f"# HELP {PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {PREFIX}_{name} histogram")
+            for direction, total in totals.items():
+                histogram = getattr(total, attribute)
+                cumulative = 0
+                for i, count in enumerate(histogram.counts):
+                    cumulative += count
+                    bound = '+Inf' if i == LATENCY_BUCKETS else repr((1 << (i + LATENCY_SHIFT)) / 1e9)
+                    lines.append(f'{PREFIX}_{name}_bucket{{direction="{direction}",le="{bound}"}} {cumulative}')
+                lines.append(f'{PREFIX}_{name}_sum{{direction="{direction}"}} {histogram.total / 1e9}')
+                lines.append(f'{PREFIX}_{name}_count{{direction="{direction}"}} {cumulative}')
+
+        with self.lock:
+            gauges = list(self.gauges)
+        for name, kind, help, read in gauges:
+            try:
+                value = read()
+            except Exception:
+                continue
+            series(name, kind, help, value if isinstance(value, list) else [({}, value)])
+        return '\n'.join(lines) + '\n'
+
+# Global registry used by the packet loops
+registry = Registry()
+
+# Returns the global registry
+def get_registry():
+    return registry
+
+# Returns the calling thread's counters for a direction ('outbound' or 'inbound')
+def counters(direction):
+    return registry.get(direction)
+
+# Serves the registry at http://host:port/metrics from a background thread
+# Returns the server, whose shutdown() stops it
+def serve(port=METRICS_PORT, host='127.0.0.1', registry=registry):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
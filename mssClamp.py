@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# ------------------------------- mssClamp.py ----------------------------- #
+# This script is designed to clamp the TCP maximum segment size advertised  #
+# in SYN and SYN-ACK packets crossing the tunnel, so neither end sends      #
+# segments larger than the tunnel MTU. The MSS option is rewritten in place #
+# and the TCP checksum is patched with the RFC 1624 incremental update      #
+# instead of being recomputed over the whole segment.                       #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+TCP       = 6    # IP protocol number of TCP
+SYN       = 0x02 # TCP SYN flag
+MSS_KIND  = 2    # TCP option kind of the MSS option
+IPV4_TCP  = 40   # IPv4 and TCP headers without options
+IPV6_TCP  = 60   # IPv6 and TCP headers without options
+
+# Returns the ones' complement checksum with a 16 bit word changed from old to new (RFC 1624 eqn. 3)
+def updateChecksum(checksum, old, new):
+    total = (~checksum & 0xFFFF) + (~old & 0xFFFF) + new
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+# Lowers the MSS option of the TCP header at offset to mss if it is larger
+# Returns True if the packet was rewritten
+def clampTCP(packet, offset, mss):
+    if len(packet) < offset + 20 or not packet[offset + 13] & SYN:
+        return False
+
+    end = offset + (packet[offset + 12] >> 4) * 4
+    if end > len(packet):
+        return False
+
+    i = offset + 20
+    while i < end:
+        kind = packet[i]
+        if kind == 0:   # end of options
+            return False
+        if kind == 1:   # no-op padding
+            i += 1
+            continue
+        if i + 1 >= end:
+            return False
+        length = packet[i + 1]
+        if length < 2:
+            return False
+        if kind == MSS_KIND and length == 4 and i + 4 <= end:
+            old = (packet[i + 2] << 8) | packet[i + 3]
+            if old <= mss:
+                return False
+            packet[i + 2] = mss >> 8
+            packet[i + 3] = mss & 0xFF
+            checksum = (packet[offset + 16] << 8) | packet[offset + 17]
+            checksum = updateChecksum(checksum, old, mss)
+            packet[offset + 16] = checksum >> 8
+            packet[offset + 17] = checksum & 0xFF
+            return True
+        i += length
+    return False
+
+# A pipeline stage clamping the MSS of TCP SYNs to the pipeline's MTU
+# Anything that isn't TCP is passed on after two byte comparisons
+class MSSClamp:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.clamped = 0
+
+    def __call__(self, packet):
+        if len(packet) < IPV4_TCP: # too short to hold a TCP header, let alone options
+            return packet
+        version = packet[0] >> 4
+        if version == 4:
+            if packet[9] != TCP or (packet[6] & 0x1F) or packet[7]:
+                return packet
+            offset = (packet[0] & 0x0F) * 4
+            overhead = IPV4_TCP
+        elif version == 6:
+            if packet[6] != TCP:
+                return packet
+            offset = 40
+            overhead = IPV6_TCP
+        else:
+            return packet
+
+        mtu = self.pipeline.mtu
+        if mtu and clampTCP(packet, offset, mtu - overhead):
+            self.clamped += 1
+        return packet
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# ------------------------------- netlink.py ------------------------------ #
+# This script is designed to configure network interfaces by talking        #
+# rtnetlink to the kernel directly, instead of forking the iproute2 'ip'    #
+# command. It can assign addresses, bring links up and down, set the MTU    #
+# and install or remove routes, and every request waits for the kernel's    #
+# acknowledgement so failures are reported instead of silently ignored.     #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import ipaddress
+import os
+import socket
+import struct
+
+NETLINK_ROUTE = 0
+
+# Message types
+NLMSG_ERROR  = 2
+RTM_NEWLINK  = 16
+RTM_NEWADDR  = 20
+RTM_DELADDR  = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+# Message flags
+NLM_F_REQUEST = 0x001
+NLM_F_ACK     = 0x004
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL    = 0x200
+NLM_F_CREATE  = 0x400
+
+# Attribute types
+IFA_ADDRESS  = 1
+IFA_LOCAL    = 2
+IFLA_MTU     = 4
+RTA_DST      = 1
+RTA_OIF      = 4
+RTA_GATEWAY  = 5
+RTA_PRIORITY = 6
+
+IFF_UP            = 0x1
+RT_TABLE_MAIN     = 254
+RTPROT_STATIC     = 4
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK     = 253
+RTN_UNICAST       = 1
+
+NLMSGHDR  = struct.Struct('=IHHII')     # length, type, flags, sequence, port id
+IFINFOMSG = struct.Struct('=BxHiII')    # family, device type, index, flags, change mask
+IFADDRMSG = struct.Struct('=BBBBI')     # family, prefix length, flags, scope, index
+RTMSG     = struct.Struct('=BBBBBBBBI') # family, dst len, src len, tos, table, protocol, scope, type, flags
+RTATTR    = struct.Struct('=HH')        # length, type
+
+# A failed rtnetlink request, carrying the errno the kernel answered with
+class NetlinkError(OSError):
+    pass
+
+# Returns an rtnetlink attribute padded to a 4 byte boundary
+def attribute(kind, data):
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, kind) + data + bytes(-length % 4)
+
+# Returns the address family of an ipaddress object
+def family(address):
+    return socket.AF_INET if address.version == 4 else socket.AF_INET6
+
+# Returns the kernel index of a network interface
+def interfaceIndex(name):
+    try:
+        return socket.if_nametoindex(name)
+    except OSError:
+        raise NetlinkError(19, f"No such device: {name}") # ENODEV
+
+# An rtnetlink socket that sends requests and waits for each acknowledgement
+class Netlink:
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.sequence = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    # Sends one request and raises NetlinkError if the kernel rejects it
+    def request(self, kind, flags, payload, description):
+        self.sequence += 1
+        header = NLMSGHDR.pack(NLMSGHDR.size + len(payload), kind, flags | NLM_F_REQUEST | NLM_F_ACK, self.sequence, 0)
+        self.sock.send(header + payload)
+
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, msg_type, _, sequence, _ = NLMSGHDR.unpack_from(data, offset)
+                if length < NLMSGHDR.size:
+                    break
+                if msg_type == NLMSG_ERROR and sequence == self.sequence:
+                    (error,) = struct.unpack_from('=i', data, offset + NLMSGHDR.size)
+                    if error:
+                        raise NetlinkError(-error, f"{description}: {os.strerror(-error)}")
+                    return
+                offset += (length + 3) & ~3
+
+    # Assigns an address such as '10.1.2.3' or '10.1.2.3/24' to an interface
+    # An address that is already assigned is left in place
+    def addAddress(self, name, address):
+        interface = ipaddress.ip_interface(address)
+        packed = interface.ip.packed
+        payload = IFADDRMSG.pack(family(interface), interface.network.prefixlen, 0, RT_SCOPE_UNIVERSE, interfaceIndex(name))
+        payload += attribute(IFA_LOCAL, packed) + attribute(IFA_ADDRESS, packed)
+        self.request(RTM_NEWADDR, NLM_F_CREATE | NLM_F_REPLACE, payload, f"add address {address} to {name}")
+
+    # Removes an address from an interface
+    def deleteAddress(self, name, address):
+        interface = ipaddress.ip_interface(address)
+        packed = interface.ip.packed
+        payload = IFADDRMSG.pack(family(interface), interface.network.prefixlen, 0, RT_SCOPE_UNIVERSE, interfaceIndex(name))
+        payload += attribute(IFA_LOCAL, packed) + attribute(IFA_ADDRESS, packed)
+        self.request(RTM_DELADDR, 0, payload, f"remove address {address} from {name}")
+
+    # Brings an interface up or down
+    def setLinkState(self, name, up):
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, interfaceIndex(name), IFF_UP if up else 0, IFF_UP)
+        self.request(RTM_NEWLINK, 0, payload, f"set {name} {'up' if up else 'down'}")
+
+    def setLinkUp(self, name):
+        self.setLinkState(name, True)
+
+    def setLinkDown(self, name):
+        self.setLinkState(name, False)
+
+    # Sets the MTU of an interface
+    def setMTU(self, name, mtu):
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, interfaceIndex(name), 0, 0)
+        payload += attribute(IFLA_MTU, struct.pack('=I', mtu))
+        self.request(RTM_NEWLINK, 0, payload, f"set the MTU of {name} to {mtu}")
+
+    # Builds the body of a route request for a destination network through an interface
+    def routeMessage(self, destination, name, gateway, metric):
+        network = ipaddress.ip_network(destination, strict=False)
+        scope = RT_SCOPE_LINK if gateway is None else RT_SCOPE_UNIVERSE
+        payload = RTMSG.pack(family(network), network.prefixlen, 0, 0, RT_TABLE_MAIN, RTPROT_STATIC, scope, RTN_UNICAST, 0)
+        if network.prefixlen:
+            payload += attribute(RTA_DST, network.network_address.packed)
+        payload += attribute(RTA_OIF, struct.pack('=i', interfaceIndex(name)))
+        if gateway is not None:
+            payload += attribute(RTA_GATEWAY, ipaddress.ip_address(gateway).packed)
+        if metric is not None:
+            payload += attribute(RTA_PRIORITY, struct.pack('=I', metric))
+        return payload
+
+    # Routes a destination network through an interface, replacing an existing route to it
+    def addRoute(self, destination, name, gateway=None, metric=None):
+        payload = self.routeMessage(destination, name, gateway, metric)
+        self.request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE, payload, f"add route {destination} via {name}")
+
+    # Removes a route previously added with addRoute
+    def deleteRoute(self, destination, name, gateway=None, metric=None):
+        payload = self.routeMessage(destination, name, gateway, metric)
+        self.request(RTM_DELROUTE, 0, payload, f"remove route {destination} via {name}")
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -------------------------------- pathMTU.py ----------------------------- #
+# This script is designed to manage the MTU of the tunnel. It can read and  #
+# set the MTU of the TUN device, discover the path MTU toward the relay by  #
+# sending probes with the Don't Fragment bit set and reading the estimate   #
+# the kernel keeps from ICMP "fragmentation needed" replies, and keep the   #
+# TUN device's MTU small enough that encapsulated packets never fragment.   #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import errno
+import fcntl
+import netlink
+import socket
+import struct
+import threading
+import time
+
+SIOCGIFMTU = 0x8921 # ioctl to get an interface's MTU
+
+IP_MTU_DISCOVER = 10 # Socket option selecting the path MTU discovery mode
+IP_PMTUDISC_DO  = 2  # Always set Don't Fragment
+IP_MTU          = 14 # Socket option reading the kernel's path MTU estimate
+
+OVERHEAD  = 28     # IPv4 and UDP headers added around every tunnelled packet
+MIN_MTU   = 576    # Smallest MTU every IPv4 host must accept
+MAX_MTU   = 9000   # Largest inner MTU handed to the TUN device
+ROUNDS    = 4      # Probe rounds, each can learn of one smaller hop
+WAIT      = 0.05   # Seconds to wait for ICMP replies after each probe
+REPROBE   = 600    # Seconds between path MTU checks while the tunnel is up
+FOLLOW    = 1.0    # Seconds between queue worker checks for a re-probed path MTU
+
+# Returns the MTU of a network interface
+def getMTU(name):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        ifr = fcntl.ioctl(sock, SIOCGIFMTU, struct.pack('16si20x', name.encode(), 0))
+    return struct.unpack('16si20x', ifr)[1]
+
+# Sets the MTU of a network interface
+def setMTU(name, mtu):
+    with netlink.Netlink() as nl:
+        nl.setMTU(name, mtu)
+
+# Returns the path MTU toward ip:port
+# Each round sends a datagram as large as the current estimate with Don't Fragment set;
+# a router that can't forward it answers with ICMP, lowering the kernel's estimate,
+# so the loop ends once a round leaves the estimate unchanged
+# A relay that answers a probe with port unreachable has still received it whole
+def discoverPathMTU(ip, port, rounds=ROUNDS, wait=WAIT):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        sock.connect((ip, port))
+        mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+
+        for _ in range(rounds):
+            try:
+                sock.send(bytes(mtu - OVERHEAD))
+            except OSError as e:
+                # The estimate dropped between reading it and sending, or an earlier
+                # probe reached the relay and was refused
+                if e.errno not in (errno.EMSGSIZE, errno.ECONNREFUSED):
+                    raise
+            time.sleep(wait)
+            estimate = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+            if estimate >= mtu:
+                break
+            mtu = estimate
+    return mtu
+
+# Returns the MTU the TUN device should use so tunnelled packets fit the path
+# extra is any per-packet overhead added on top of the UDP header, e.g. framing
+def innerMTU(path_mtu, extra=0):
+    return max(MIN_MTU, min(MAX_MTU, path_mtu - OVERHEAD - extra))
+
+# Returns the bytes sealing adds to every datagram the pipeline sends
+def sealingOverhead(pipeline):
+    if pipeline.cipher is None:
+        return 0
+    import tunnelCrypto # only loaded with sealing on
+    return tunnelCrypto.OVERHEAD
+
+# Sizes a pipeline for a path MTU: the framer's datagrams and the inner MTU the MSS
+# clamp works from, returns the inner MTU
+def applyPathMTU(pipeline, path_mtu):
+    framer = pipeline.framer
+    sealing = sealingOverhead(pipeline)
+    extra = sealing + (3 if framer is not None else 0) # framing magic and length prefix
+    if framer is not None:
+        framer.max_datagram = path_mtu - OVERHEAD - sealing
+    pipeline.mtu = innerMTU(path_mtu, extra)
+    return pipeline.mtu
+
+# Keeps the TUN device's MTU matched to the path toward the pipeline's relay,
+# re-probing in the background and adjusting the framer's datagram size too
+# shared, a multiprocessing.Value, publishes each path MTU to the queue workers,
+# whose PathMTUFollower applies it to their own copy of the pipeline
+class PathMTUMonitor:
+    def __init__(self, tun_name, pipeline, interval=REPROBE, shared=None):
+        self.tun_name = tun_name
+        self.pipeline = pipeline
+        self.interval = interval
+        self.shared = shared
+        self.path_mtu = None
+        self.mtu = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Probes the path once and applies the result, returns the inner MTU
+    def update(self):
+        ip, port = self.pipeline.destination
+        try:
+            path_mtu = discoverPathMTU(ip, port)
+        except OSError as e:
+            print(f"Path MTU probe toward {ip}:{port} failed: {e}")
+            return self.mtu
+
+        sealing = sealingOverhead(self.pipeline)
+        mtu = innerMTU(path_mtu, sealing + (3 if self.pipeline.framer is not None else 0))
+        if mtu != self.mtu:
+            try:
+                setMTU(self.tun_name, mtu)
+                print(f"Path MTU toward {ip}:{port} is {path_mtu}, TUN MTU set to {mtu}")
+            except OSError as e:
+                print(f"Could not set the MTU of {self.tun_name}: {e}")
+                return self.mtu
+        applyPathMTU(self.pipeline, path_mtu)
+        if self.shared is not None:
+            self.shared.value = path_mtu
+        self.path_mtu = path_mtu
+        self.mtu = mtu
+        return mtu
+
+    # Probes now, then keeps re-probing on a background thread
+    def start(self):
+        self.update()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+# Applies the path MTUs a PathMTUMonitor in the parent publishes to a queue worker's
+# pipeline, checking the shared value every interval seconds on a background thread
+class PathMTUFollower:
+    def __init__(self, pipeline, shared, interval=FOLLOW):
+        self.pipeline = pipeline
+        self.shared = shared
+        self.interval = interval
+        self.path_mtu = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Applies the published path MTU if it changed, returns it
+    def update(self):
+        path_mtu = self.shared.value
+        if path_mtu and path_mtu != self.path_mtu:
+            applyPathMTU(self.pipeline, path_mtu)
+            self.path_mtu = path_mtu
+        return self.path_mtu
+
+    def start(self):
+        self.update()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# ------------------------------- pipeline.py ----------------------------- #
+# This script is designed to hold the packet processing stages that sit     #
+# between the TUN device and the UDP socket. Each stage is a function that  #
+# takes a packet and returns it (possibly rewritten) or None to consume it, #
+# so features can be plugged into the datapath without editing the loops.   #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+# The ordered outbound (TUN -> server) and inbound (server -> TUN) stages of
+# a tunnel, along with the server address packets are currently sent to
+# Packets may be views into reused buffers, a stage that keeps one must copy it
+class Pipeline:
+    def __init__(self, destination):
+        self.destination = destination
+        self.router = None # Optional function choosing a destination per packet
+        self.framer = None # Optional framing.Framer coalescing outbound bursts
+        self.mtu = None    # MTU of the TUN device once known
+        self.capture = None # Optional capture.CaptureRing recording packets in both directions
+        self.scheduler = None # Optional qos.PriorityScheduler queuing outbound packets by class
+        self.dns = None # Optional dnsCache.DNSCache answering DNS queries back into the TUN device
+        self.cipher = None # Optional tunnelCrypto.SessionCipher sealing datagrams to the relay and opening replies
+        self.outbound = []
+        self.inbound = []
+        self.failures = 0 # packets dropped because a stage raised on them
+
+    # Returns the server address a packet should be sent to
+    def route(self, packet):
+        if self.router is None:
+            return self.destination
+        return self.router(packet)
+
+    # Adds a stage run on every packet read from the TUN device
+    def addOutbound(self, stage):
+        self.outbound.append(stage)
+
+    # Adds a stage run on every packet received from the server
+    def addInbound(self, stage):
+        self.inbound.append(stage)
+
+    # Runs a packet read from the TUN device through the outbound stages
+    # Returns the packet to send, or None if a stage consumed it or failed on it
+    def processOutbound(self, packet):
+        return self.process(self.outbound, packet)
+
+    # Runs a packet received from the server through the inbound stages
+    # Returns the packet to inject, or None if a stage consumed it or failed on it
+    def processInbound(self, packet):
+        return self.process(self.inbound, packet)
+
+    # Runs a packet through stages, a stage raising on a malformed packet drops only
+    # that packet, so the rest of its batch still goes through
+    def process(self, stages, packet):
+        try:
+            for stage in stages:
+                packet = stage(packet)
+                if packet is None:
+                    return None
+        except Exception as e:
+            self.failures += 1
+            print(f"Dropping a packet a stage failed on: {e!r}")
+            return None
+        return packet
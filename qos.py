@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# --------------------------------- qos.py -------------------------------- #
+# This script is designed to keep interactive traffic responsive while a    #
+# bulk transfer fills the tunnel. Outbound packets are sorted by DSCP mark, #
+# protocol, port and size into bounded per-class queues between the TUN     #
+# reader and the socket sender, and the sender drains them by strict        #
+# priority or deficit round robin. When the socket backs up only the        #
+# sender waits, the reader keeps going and full queues drop by policy, so   #
+# a stalled relay never blocks reading from the TUN device.                 #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import struct
+import threading
+import time
+from collections import deque
+
+INTERACTIVE = 0 # SSH, DNS, NTP, ICMP, small TCP segments and real-time DSCP marks
+DEFAULT     = 1 # everything else
+BULK        = 2 # full-sized packets and traffic marked as low priority
+CLASSES = ('interactive', 'default', 'bulk')
+
+LIMITS = (256, 1024, 512)    # Packets each class may hold before dropping
+QUANTA = (4500, 3000, 1500)  # Bytes each class may send per deficit round robin turn
+SEND_BUFFER = 64 * 1024      # Socket send buffer with queuing on, so the backlog waits here in priority order
+BURST = 0.002                # Seconds of idle time the shaper may catch up on in one burst
+
+INTERACTIVE_DSCP = {46, 44, 40, 48, 56, 32, 34, 36, 38} # EF, VOICE-ADMIT, CS5, CS6, CS7, CS4, AF41-43
+BULK_DSCP = {8, 1}                                      # CS1 and lower effort
+INTERACTIVE_PORTS = {22, 53, 123}                       # SSH, DNS, NTP
+SMALL_PACKET = 128  # TCP packets up to this size (ACKs, SYNs) are interactive
+LARGE_PACKET = 1000 # Unmarked packets over this size are bulk
+FULL_PACKET  = 1500 # Size assumed when sizing paced batches
+TCP = 6
+UDP = 17
+ICMP = 1
+ICMPV6 = 58
+
+# Returns the class of an IPv4 or IPv6 packet
+def classify(packet):
+    size = len(packet)
+    version = packet[0] >> 4
+    if version == 4:
+        dscp = packet[1] >> 2
+        protocol = packet[9]
+        header = (packet[0] & 0x0F) * 4
+        first = not ((packet[6] & 0x1F) or packet[7]) # only the first fragment carries the ports
+    elif version == 6:
+        dscp = ((packet[0] & 0x0F) << 2) | (packet[1] >> 6)
+        protocol = packet[6]
+        header = 40
+        first = True
+    else:
+        return DEFAULT
+
+    if dscp in INTERACTIVE_DSCP:
+        return INTERACTIVE
+    if dscp in BULK_DSCP:
+        return BULK
+    if protocol == ICMP or protocol == ICMPV6:
+        return INTERACTIVE
+    if size > LARGE_PACKET:
+        return BULK
+    if (protocol == TCP or protocol == UDP) and first and size >= header + 4:
+        source, destination = struct.unpack_from('!HH', packet, header)
+        if source in INTERACTIVE_PORTS or destination in INTERACTIVE_PORTS:
+            return INTERACTIVE
+        if protocol == TCP and size <= SMALL_PACKET:
+            return INTERACTIVE
+    return DEFAULT
+
+# Bounded per-class queues of outbound packets and the scheduler draining them
+# policy = 'strict' always sends the highest class waiting, which can starve bulk
+# traffic entirely, 'drr' shares the link by QUANTA so every class keeps moving
+# drop = 'tail' drops the arriving packet when its queue is full, 'head' the oldest
+# one, which keeps what is queued fresh at the cost of the oldest data
+# rate, in bytes per second, paces the sender just below the relay's capacity so
+# queues build here, in priority order, rather than in the network
+class PriorityScheduler:
+    def __init__(self, policy='strict', drop='tail', limits=LIMITS, quanta=QUANTA, rate=None):
+        if policy not in ('strict', 'drr'):
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        if drop not in ('tail', 'head'):
+            raise ValueError(f"Unknown drop policy: {drop}")
+        self.policy = policy
+        self.drop = drop
+        self.limits = limits
+        self.quanta = quanta
+        self.rate = rate
+        self.queues = [deque() for _ in CLASSES]
+        self.deficits = [0] * len(CLASSES)
+        self.current = 0       # class the deficit round robin is serving
+        self.depth = 0         # packets waiting across every class
+        self.queued_bytes = 0  # bytes of those packets
+        self.enqueued = [0] * len(CLASSES)
+        self.dropped = [0] * len(CLASSES)
+        self.sent = [0] * len(CLASSES)
+        self.next_send = 0.0   # when the shaper lets the next packet go
+        self.condition = threading.Condition()
+
+    # Queues a copy of a packet, returns how many packets were dropped to fit it (0 or 1)
+    def put(self, packet):
+        kind = classify(packet)
+        queue = self.queues[kind]
+        with self.condition:
+            if len(queue) >= self.limits[kind]:
+                self.dropped[kind] += 1
+                if self.drop == 'tail':
+                    return 1
+                self.queued_bytes -= len(queue.popleft())
+                dropped = 1
+            else:
+                self.depth += 1
+                dropped = 0
+            queue.append(bytes(packet))
+            self.queued_bytes += len(packet)
+            self.enqueued[kind] += 1
+            if self.depth == 1: # the sender only waits on an empty scheduler
+                self.condition.notify()
+        return dropped
+
+    # Removes and returns the next packet by strict priority
+    def nextStrict(self):
+        for kind, queue in enumerate(self.queues):
+            if queue:
+                self.sent[kind] += 1
+                packet = queue.popleft()
+                self.queued_bytes -= len(packet)
+                return packet
+
+    # Removes and returns the next packet by deficit round robin
+    # A class sends while its head packet fits its deficit, then the next class
+    # gets its quantum, and an emptied class forfeits what it had left
+    def nextRoundRobin(self):
+        queues = self.queues
+        deficits = self.deficits
+        while True:
+            kind = self.current
+            queue = queues[kind]
+            if queue and len(queue[0]) <= deficits[kind]:
+                packet = queue.popleft()
+                deficits[kind] -= len(packet)
+                if not queue:
+                    deficits[kind] = 0
+                self.sent[kind] += 1
+                self.queued_bytes -= len(packet)
+                return packet
+            if not queue:
+                deficits[kind] = 0
+            kind = self.current = (kind + 1) % len(queues)
+            if queues[kind]:
+                deficits[kind] += self.quanta[kind]
+
+    # Returns up to limit packets in scheduling order, waiting up to timeout
+    # seconds for the first one, or an empty list if none came
+    # With a rate set no more than BURST seconds of full sized packets are taken
+    # at once, so a packet arriving meanwhile never waits behind a long paced batch
+    def take(self, limit=1, timeout=1):
+        if self.rate:
+            limit = max(1, min(limit, int(self.rate * BURST / FULL_PACKET)))
+        with self.condition:
+            if not self.depth:
+                self.condition.wait(timeout)
+                if not self.depth:
+                    return []
+            pick = self.nextStrict if self.policy == 'strict' else self.nextRoundRobin
+            count = min(limit, self.depth)
+            packets = [pick() for _ in range(count)]
+            self.depth -= count
+        return packets
+
+    # Sleeps until the shaper lets size more bytes go, when a rate is set
+    def pace(self, size):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.next_send = max(self.next_send, now - BURST) + size / self.rate
+        delay = self.next_send - now
+        if delay > 0:
+            time.sleep(delay)
+
+    # Returns the packets waiting in each class
+    def depths(self):
+        return [len(queue) for queue in self.queues]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# ------------------------------ relayCache.py ---------------------------- #
+# This script is designed to remember how relays performed between runs.    #
+# Each relay's RTT is kept as an exponentially weighted moving average      #
+# along with its failure count, and entries expire after a TTL. The cache   #
+# lives in a json file within the ./servers directory so restarts and       #
+# reconnects can pick a relay without probing the whole country first.      #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import json
+import os
+import threading
+import time
+
+CACHE_PATH  = "./servers/relay_cache.json"
+ALPHA       = 0.3    # Weight of the newest sample in the EWMA
+TTL         = 3600   # Seconds before an entry is considered stale
+EXPIRY      = 86400  # Seconds before an entry is dropped from the cache entirely
+MAX_ENTRIES = 4096   # Entries kept on disk, the least recently updated are dropped first
+
+# Per-relay RTT history keyed by "ip:port", safe to update from a background thread
+# clock returns the wall clock time entries are stamped and aged with
+class RelayCache:
+    def __init__(self, path=CACHE_PATH, ttl=TTL, max_entries=MAX_ENTRIES, expiry=EXPIRY, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.ttl = ttl
+        self.expiry = expiry
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # Returns the key of a relay
+    @staticmethod
+    def key(ip, port):
+        return f"{ip}:{port}"
+
+    # Reads the cache from disk, an unreadable file just starts an empty cache
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            entries = {}
+        with self.lock:
+            self.entries = entries if isinstance(entries, dict) else {}
+        return self
+
+    # Writes the cache to disk through a temporary file so a crash never leaves it half written
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            self.prune()
+            try:
+                with open(tmp_path, 'w') as file:
+                    json.dump(self.entries, file)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Could not save relay cache: {e}")
+
+    # Drops expired entries, then the least recently updated ones above the size bound
+    # Must be called with the lock held
+    def prune(self):
+        now = self.clock()
+        expired = [key for key, entry in self.entries.items() if now - entry['updated'] > self.expiry]
+        for key in expired:
+            del self.entries[key]
+        if len(self.entries) > self.max_entries:
+            oldest = sorted(self.entries, key=lambda key: self.entries[key]['updated'])
+            for key in oldest[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+
+    # Folds a list of RTT samples (None for a failed probe) into a relay's history
+    def record(self, ip, port, samples):
+        key = self.key(ip, port)
+        with self.lock:
+            entry = self.entries.get(key, {'ewma': None, 'failures': 0, 'probes': 0, 'updated': 0})
+            for rtt in samples:
+                entry['probes'] += 1
+                if rtt is None:
+                    entry['failures'] += 1
+                    continue
+                entry['failures'] = 0
+                entry['ewma'] = rtt if entry['ewma'] is None else ALPHA * rtt + (1 - ALPHA) * entry['ewma']
+            entry['updated'] = self.clock()
+            self.entries[key] = entry
+
+    # Folds the results of relayProber.sweep() into the cache
+    def recordSweep(self, results):
+        for (ip, port), samples in results.items():
+            self.record(ip, port, samples)
+
+    # Drops the entries of relays, given as (ip, port) pairs, that are no longer listed
+    def forget(self, relays):
+        with self.lock:
+            for ip, port in relays:
+                self.entries.pop(self.key(ip, port), None)
+
+    # Returns True if the relay has no entry or its entry is older than the TTL
+    def isStale(self, ip, port):
+        with self.lock:
+            entry = self.entries.get(self.key(ip, port))
+        return entry is None or self.clock() - entry['updated'] > self.ttl
+
+    # Returns the relay's smoothed RTT if it is fresh and its last probe succeeded, otherwise None
+    def rtt(self, ip, port):
+        with self.lock:
+            entry = self.entries.get(self.key(ip, port))
+        if entry is None or entry['failures'] or entry['ewma'] is None:
+            return None
+        if self.clock() - entry['updated'] > self.ttl:
+            return None
+        return entry['ewma']
+
+cache = None
+
+# Returns the shared cache, loading it from disk on first use
+def get_cache():
+    global cache
+    if cache is None:
+        cache = RelayCache().load()
+    return cache
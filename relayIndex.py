@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# ------------------------------ relayIndex.py ---------------------------- #
+# This script is designed to compile the Tor relay csv within the ./servers #
+# directory into a compact binary index, and to memory-map that index at    #
+# startup. Relays are grouped by country so a country's relays are a slice  #
+# of fixed-size records, decoded only when they are actually looked at.     #
+# Each record keeps the relay's bandwidth, flags and nickname for ranking.  #
+# Run it directly to prebuild the index: python relayIndex.py [csv]         #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import csv as csvreader
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import sys
+
+MAGIC   = b'PHRI' # Identifies a PhaethonVPN relay index
+VERSION = 2
+
+# magic, version, csv mtime (ns), csv size, csv sha1, country count, record count, nickname bytes
+HEADER  = struct.Struct('<4sHxxQQ20sIII')
+# country code, first record, record count
+COUNTRY = struct.Struct('<2sII')
+# packed IPv4 address, ORPort, bandwidth (MiB/s), flag bits, nickname offset, nickname length
+RECORD  = struct.Struct('<4sHfHIB')
+
+# Bit assigned to each Tor relay flag in a record
+FLAGS = {
+    'Authority': 1 << 0, 'BadExit': 1 << 1, 'Exit': 1 << 2, 'Fast': 1 << 3,
+    'Guard': 1 << 4, 'HSDir': 1 << 5, 'MiddleOnly': 1 << 6, 'NoEdConsensus': 1 << 7,
+    'Running': 1 << 8, 'Stable': 1 << 9, 'StaleDesc': 1 << 10, 'Sybil': 1 << 11,
+    'V2Dir': 1 << 12, 'Valid': 1 << 13
+}
+
+# Converts the csv's comma separated flag list into flag bits
+def packFlags(flags):
+    bits = 0
+    for flag in flags.split(','):
+        bits |= FLAGS.get(flag.strip(), 0)
+    return bits
+
+# A single relay with every column kept from the csv
+class Relay:
+    __slots__ = ('ip', 'port', 'bandwidth', 'flags', 'nickname', 'country')
+
+    def __init__(self, ip, port, bandwidth, flags, nickname, country):
+        self.ip = ip
+        self.port = port
+        self.bandwidth = bandwidth
+        self.flags = flags
+        self.nickname = nickname
+        self.country = country
+
+    # The (ip, port) pair the relay is reached on, what probes, caches and tunnels use
+    @property
+    def address(self):
+        return (self.ip, self.port)
+
+    # Returns True if the relay carries the given Tor flag
+    def has(self, flag):
+        return bool(self.flags & FLAGS[flag])
+
+    def __repr__(self):
+        return f"Relay({self.nickname} {self.ip}:{self.port} {self.country} {self.bandwidth:.2f} MiB/s)"
+
+# Returns the path of the index compiled from the given csv
+def indexPath(csv_path):
+    return os.path.splitext(csv_path)[0] + '.idx'
+
+# Returns the sha1 digest of the csv contents
+def hashCSV(csv_path):
+    with open(csv_path, 'rb') as file:
+        return hashlib.sha1(file.read()).digest()
+
+# Returns the country code and (packed ip, port, bandwidth, flags, nickname) record of a
+# parsed csv row, or None if the row is malformed
+def parseRow(row):
+    if len(row) < 3 or not row[0] or not row[1]:
+        return None
+    try:
+        packed = socket.inet_aton(row[0])
+        port = int(row[2])
+        bandwidth = float(row[3]) if len(row) > 3 and row[3] else 0.0
+    except (OSError, ValueError):
+        return None
+    flags = packFlags(row[4]) if len(row) > 4 else 0
+    nickname = row[5].encode()[:255] if len(row) > 5 else b''
+    return row[1], (packed, port, bandwidth, flags, nickname)
+
+# Reads the csv and returns a dictionary of country code -> [(packed ip, port, bandwidth, flags, nickname)]
+def parseCSV(csv_path):
+    countries = {}
+    with open(csv_path, 'r', newline='') as file:
+        reader = csvreader.reader(file)
+        next(reader, None)
+        for row in reader:
+            parsed = parseRow(row)
+            if parsed is not None:
+                countries.setdefault(parsed[0], []).append(parsed[1])
+    return countries
+
+# Compiles the csv into the bytes of a relay index
+def compileIndex(csv_path):
+    stat = os.stat(csv_path)
+    return packIndex(parseCSV(csv_path), stat.st_mtime_ns, stat.st_size, hashCSV(csv_path))
+
+# Packs a dictionary of country code -> records, as returned by parseCSV, into the bytes
+# of a relay index stamped with the mtime, size and sha1 digest of the csv it came from
+def packIndex(countries, mtime_ns, size, digest):
+    table = bytearray()
+    records = bytearray()
+    nicknames = bytearray()
+    start = 0
+    for code in sorted(countries):
+        relays = countries[code]
+        table += COUNTRY.pack(code.encode(), start, len(relays))
+        for packed, port, bandwidth, flags, nickname in relays:
+            records += RECORD.pack(packed, port, bandwidth, flags, len(nicknames), len(nickname))
+            nicknames += nickname
+        start += len(relays)
+
+    header = HEADER.pack(MAGIC, VERSION, mtime_ns, size, digest, len(countries), start, len(nicknames))
+    return bytes(header + table + records + nicknames)
+
+# Writes the bytes of an index to index_path
+# The file is written to a temporary name and renamed so readers never see a partial index
+def writeIndex(data, index_path):
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+# Compiles the csv into a binary index next to it (or at index_path) and returns the index path
+def buildIndex(csv_path, index_path=None):
+    return writeIndex(compileIndex(csv_path), index_path or indexPath(csv_path))
+
+# Returns True if the index at index_path was compiled from the csv as it is now
+# A changed mtime alone does not invalidate the index as long as the contents hash the same
+def isFresh(csv_path, index_path):
+    try:
+        with open(index_path, 'rb') as file:
+            header = file.read(HEADER.size)
+        magic, version, mtime_ns, size, digest, _, _, _ = HEADER.unpack(header)
+        stat = os.stat(csv_path)
+    except (OSError, struct.error):
+        return False
+
+    if magic != MAGIC or version != VERSION or size != stat.st_size:
+        return False
+    if mtime_ns == stat.st_mtime_ns:
+        return True
+    return digest == hashCSV(csv_path)
+
+# The relays of one country, a read-only sequence of (ip, port) tuples
+# decoded from the mapped records on access
+class CountryRelays:
+    __slots__ = ('index', 'start', 'count')
+
+    def __init__(self, index, start, count):
+        self.index = index
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("relay index out of range")
+        return self.index.record(self.start + i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.index.record(self.start + i)
+
+    def __bool__(self):
+        return self.count > 0
+
+# A relay index backed by a memory map (or an in-memory buffer), usable wherever
+# the country -> relays dictionary was
+class RelayIndex:
+    def __init__(self, buffer):
+        self.map = buffer
+
+        magic, version, _, _, _, country_count, self.record_count, _ = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a relay index")
+
+        self.countries = {}
+        offset = HEADER.size
+        for _ in range(country_count):
+            code, start, count = COUNTRY.unpack_from(buffer, offset)
+            self.countries[code.decode()] = (start, count)
+            offset += COUNTRY.size
+        self.records_offset = offset
+        self.nicknames_offset = offset + self.record_count * RECORD.size
+
+        # country -> {(ip, port) or ip: record position}, built the first time a country is looked up
+        self.lookup = {}
+
+    # Maps an index file into memory
+    @classmethod
+    def open(cls, index_path):
+        with open(index_path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapped)
+        except ValueError:
+            mapped.close()
+            raise
+
+    # Returns the (ip, port) tuple of the record at the given position
+    def record(self, position):
+        packed, port, _, _, _, _ = RECORD.unpack_from(self.map, self.records_offset + position * RECORD.size)
+        return (socket.inet_ntoa(packed), str(port))
+
+    # Returns the full Relay at the given position
+    def relay(self, position, country=None):
+        packed, port, bandwidth, flags, name_offset, name_length = RECORD.unpack_from(
+            self.map, self.records_offset + position * RECORD.size)
+        name_start = self.nicknames_offset + name_offset
+        nickname = bytes(self.map[name_start:name_start + name_length]).decode(errors='replace')
+        return Relay(socket.inet_ntoa(packed), port, bandwidth, flags, nickname, country)
+
+    # Yields every Relay of a country
+    def relays(self, country):
+        start, count = self.countries.get(country, (0, 0))
+        for position in range(start, start + count):
+            yield self.relay(position, country)
+
+    # Returns the record position of a relay in O(1) once its country has been seen
+    # A relay is identified by its IP and port, since one IP can list several ORPorts;
+    # without a port the first relay listed on the IP is returned
+    def position(self, country, ip, port=None):
+        table = self.lookup.get(country)
+        if table is None:
+            table = {}
+            for i, (relay_ip, relay_port) in enumerate(self[country] if country in self.countries else ()):
+                position = self.countries[country][0] + i
+                table.setdefault((relay_ip, int(relay_port)), position)
+                table.setdefault(relay_ip, position)
+            self.lookup[country] = table
+        return table.get(ip if port is None else (ip, int(port)))
+
+    # Returns the port of a relay as a string, or None if it isn't listed
+    def port(self, country, ip):
+        position = self.position(country, ip)
+        if position is None:
+            return None
+        return self.record(position)[1]
+
+    # Returns the full Relay for a country, IP and optionally port, or None if it isn't listed
+    def find(self, country, ip, port=None):
+        position = self.position(country, ip, port)
+        if position is None:
+            return None
+        return self.relay(position, country)
+
+    def __contains__(self, country):
+        return country in self.countries
+
+    def __getitem__(self, country):
+        start, count = self.countries[country]
+        return CountryRelays(self, start, count)
+
+    def __iter__(self):
+        return iter(self.countries)
+
+    def __len__(self):
+        return len(self.countries)
+
+    def get(self, country, default=None):
+        if country not in self.countries:
+            return default
+        return self[country]
+
+    def keys(self):
+        return self.countries.keys()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+# Maps the index for the csv, compiling it first if it is missing or stale
+def load(csv_path):
+    index_path = indexPath(csv_path)
+    if not isFresh(csv_path, index_path):
+        buildIndex(csv_path, index_path)
+    return RelayIndex.open(index_path)
+
+# Compiles the csv straight into memory, for when the index file can't be written
+def loadInMemory(csv_path):
+    return RelayIndex(compileIndex(csv_path))
+
+# Prebuilds the index, e.g. while building an image
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "./servers/tor_relays_by_country.csv"
+    print("Index written to", buildIndex(path))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# ----------------------------- relayMonitor.py --------------------------- #
+# This script is designed to watch the health of the relay a tunnel is      #
+# using. It probes the active relay and a warm standby from the same        #
+# country in the background, and when the active relay stops answering or   #
+# slows down it swaps the pipeline's destination to the standby, leaving    #
+# the TUN device and its address untouched.                                 #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import bridges
+from collections import deque
+import relayCache
+import relayProber
+import threading
+import time
+
+INTERVAL     = 0.2 # Seconds between health checks
+TIMEOUT      = 0.3 # Seconds before a health probe counts as a failure
+FAILURES     = 2   # Consecutive failed probes before the active relay is abandoned
+SLOWDOWN     = 4.0 # Active RTT, as a multiple of the standby's, that counts as degraded
+STANDBYS     = 4   # Ranked relays kept in reserve as standbys
+ALPHA        = 0.3 # Weight of the newest sample in the RTT averages
+HISTORY      = 64  # Failover durations kept for inspection, the oldest are dropped first
+
+# Probes the active relay and a standby, and fails the pipeline over to the standby when needed
+# With a flowBalancer.FlowBalancer the active relay is the balancer's primary, and a
+# failover swaps the standby into the balancer's relay set in its place; the other
+# balanced relays are probed too, and one that stops answering is swapped for the
+# standby the same way, or dropped from the balancer when there is none
+class RelayMonitor:
+    def __init__(self, pipeline, country, interval=INTERVAL, timeout=TIMEOUT, failures=FAILURES, balancer=None):
+        self.pipeline = pipeline
+        self.country = country
+        self.balancer = balancer
+        self.interval = interval
+        self.timeout = timeout
+        self.max_failures = failures
+
+        self.failures = 0
+        self.failing_since = None
+        self.active_rtt = None
+        self.standby_rtt = None
+        self.standbys = []
+        self.listeners = [] # callables told of relays() whenever the standbys change
+        self.lock = threading.Lock() # guards standbys, which the relay watcher's thread also edits
+        self.failover_times = deque(maxlen=HISTORY) # Seconds from the first failed probe to the swap
+        self.last_failover = 0.0
+        self.failovers = 0
+        self.balanced_failures = {} # balanced relay other than the active one -> consecutive failed probes
+        self.evictions = 0 # balanced relays swapped out or dropped for not answering
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Fills the standby list with the best ranked relays that aren't the active one
+    # or already balanced across; relays with a fresh cached RTT are preferred
+    # The listeners hear of a standby before it can become the active relay
+    # Must be called with the lock held
+    def refillStandbys(self, exclude=()):
+        active_ip = self.pipeline.destination[0]
+        cache = relayCache.get_cache()
+        seen = {active_ip, *exclude, *(ip for ip, _ in self.standbys)}
+        if self.balancer is not None:
+            seen.update(ip for (ip, _), _ in self.balancer.relays)
+        candidates = []
+        for relay in bridges.rankRelays(self.country):
+            if relay.ip in seen:
+                continue
+            seen.add(relay.ip)
+            candidates.append(relay)
+
+        candidates.sort(key=lambda relay: bridges.scoreRelay(relay, cache.rtt(*relay.address)), reverse=True)
+        for relay in candidates[:STANDBYS - len(self.standbys)]:
+            self.standbys.append(relay.address)
+        for listener in self.listeners:
+            listener(self.relays())
+
+    # Returns the active relay and the standbys, every relay the monitor may send to
+    def relays(self):
+        return [self.pipeline.destination] + self.standbys
+
+    # Drops standbys the relay list no longer holds and refills behind them, called by
+    # relayWatcher.RelayWatcher on a reload; the active relay is left in place
+    def onRelaysChanged(self, index, diff):
+        removed = {(ip, port) for country, ip, port in diff.removed if country == self.country}
+        if not removed:
+            return
+        with self.lock:
+            standbys = [standby for standby in self.standbys if standby not in removed]
+            if standbys[:1] != self.standbys[:1]:
+                self.standby_rtt = None
+            self.standbys = standbys
+            self.refillStandbys()
+
+    # Starts monitoring on a background thread
+    def start(self):
+        with self.lock:
+            self.refillStandbys()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    # Stops monitoring and waits for the background thread
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    # Folds a new sample into a running RTT average
+    @staticmethod
+    def smooth(average, rtt):
+        if rtt is None:
+            return average
+        return rtt if average is None else ALPHA * rtt + (1 - ALPHA) * average
+
+    # Probes the active relay and the first standby every interval
+    def loop(self):
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            self.check(started)
+            self.stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    # Runs one health check and fails over if the active relay has degraded
+    # The probes run without the lock, so the standby is checked again before it is used
+    def check(self, started):
+        active = self.pipeline.destination
+        with self.lock:
+            standby = self.standbys[0] if self.standbys else None
+        balanced = [destination for destination, _ in self.balancer.relays if destination != active] if self.balancer else []
+        targets = [active] + balanced + ([standby] if standby else [])
+
+        results = relayProber.probeRelays(targets, timeout=self.timeout)
+        active_rtt = results[active][0]
+        standby_rtt = results[standby][0] if standby else None
+        dead = self.countFailures(balanced, results)
+        if dead:
+            with self.lock: # may hand the standby to the balancer, which the check below notices
+                for destination in dead:
+                    self.evict(destination)
+
+        if active_rtt is None:
+            if self.failures == 0:
+                self.failing_since = started
+            self.failures += 1
+        else:
+            self.failures = 0
+            self.failing_since = None
+            self.active_rtt = self.smooth(self.active_rtt, active_rtt)
+
+        if not standby:
+            return
+        with self.lock:
+            if not self.standbys or self.standbys[0] != standby:
+                return # the relay list was reloaded while probing, the probe is moot
+            if standby_rtt is None:
+                # A dead standby is useless, replace it with the next best relay
+                self.standbys.pop(0)
+                self.standby_rtt = None
+                self.refillStandbys(exclude=(standby[0],))
+                return
+            self.standby_rtt = self.smooth(self.standby_rtt, standby_rtt)
+            if self.degraded():
+                self.failover(started)
+
+    # Counts the failed probes of the balanced relays, returning those that reached the limit
+    def countFailures(self, balanced, results):
+        failures = {}
+        for destination in balanced:
+            if results[destination][0] is None:
+                failures[destination] = self.balanced_failures.get(destination, 0) + 1
+            else:
+                failures[destination] = 0
+        self.balanced_failures = failures
+        return [destination for destination, count in failures.items() if count >= self.max_failures]
+
+    # Swaps a balanced relay that stopped answering for the standby, or drops it from the
+    # balancer without one, so the flows pinned to it move to a live relay
+    # Must be called with the lock held
+    def evict(self, old):
+        self.balanced_failures.pop(old, None)
+        if self.standbys:
+            new = self.standbys.pop(0)
+            relay = bridges.country_relays.find(self.country, *new)
+            self.balancer.replace(old, new, relay.bandwidth if relay is not None else 0.0)
+            self.standby_rtt = None
+            print(f"Balanced relay {old[0]}:{old[1]} stopped answering, replaced by {new[0]}:{new[1]}")
+        elif self.balancer.remove(old):
+            print(f"Balanced relay {old[0]}:{old[1]} stopped answering, dropped from the balancer")
+        else:
+            return
+        self.evictions += 1
+        self.refillStandbys(exclude=(old[0],))
+
+    # Returns True if the active relay should be abandoned for the standby
+    def degraded(self):
+        if self.failures >= self.max_failures:
+            return True
+        if self.active_rtt is not None and self.standby_rtt is not None:
+            return self.active_rtt > SLOWDOWN * self.standby_rtt
+        return False
+
+    # Points the pipeline at the standby, assigning the destination tuple is atomic
+    # so the datapath picks it up with its next packet
+    # Must be called with the lock held
+    def failover(self, started):
+        old = self.pipeline.destination
+        new = self.standbys.pop(0)
+        if self.balancer is not None:
+            relay = bridges.country_relays.find(self.country, *new)
+            self.balancer.replace(old, new, relay.bandwidth if relay is not None else 0.0)
+        self.pipeline.destination = new
+
+        since = self.failing_since if self.failing_since is not None else started
+        elapsed = time.monotonic() - since
+        self.failover_times.append(elapsed)
+        self.last_failover = elapsed
+        self.failovers += 1
+        print(f"Relay {old[0]}:{old[1]} degraded, failed over to {new[0]}:{new[1]} in {elapsed * 1000:.0f} ms")
+
+        self.active_rtt, self.standby_rtt = self.standby_rtt, None
+        self.failures = 0
+        self.failing_since = None
+        self.refillStandbys(exclude=(old[0],))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# ------------------------------ relayProber.py --------------------------- #
+# This script is designed to measure the round trip time to Tor relays from #
+# inside the process. Each probe is a timed TCP connect to the relay's      #
+# ORPort, so it measures the port the tunnel actually uses instead of ICMP, #
+# and every relay is probed concurrently on one asyncio event loop with a   #
+# cap on the number of connections in flight.                               #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import asyncio
+from statistics import median
+from time import perf_counter
+
+CONCURRENCY = 256 # Connections in flight at once
+TIMEOUT     = 1.0 # Seconds before a single probe counts as a failure
+SAMPLES     = 1   # Probes sent to each relay
+
+# Returns the seconds taken to open a TCP connection to ip:port, or None on failure
+async def probeTCP(ip, port, timeout=TIMEOUT):
+    start = perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    rtt = perf_counter() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass # the connection already did its job
+    return rtt
+
+# Probes one relay samples times, holding a slot of the semaphore for each probe
+# Returns a list with an RTT (or None for a failed probe) per sample
+async def probeRelay(ip, port, semaphore, timeout=TIMEOUT, samples=SAMPLES):
+    results = []
+    for _ in range(samples):
+        async with semaphore:
+            results.append(await probeTCP(ip, int(port), timeout))
+    return results
+
+# Probes every (ip, port) pair and returns a dictionary of (ip, port) -> RTT samples
+async def sweep(relays, concurrency=CONCURRENCY, timeout=TIMEOUT, samples=SAMPLES):
+    semaphore = asyncio.Semaphore(concurrency)
+    relays = list(relays)
+    results = await asyncio.gather(*(probeRelay(ip, port, semaphore, timeout, samples) for ip, port in relays))
+    return dict(zip(relays, results))
+
+# Synchronous entry point for sweep(), runs it on a fresh event loop
+def probeRelays(relays, concurrency=CONCURRENCY, timeout=TIMEOUT, samples=SAMPLES):
+    return asyncio.run(sweep(relays, concurrency, timeout, samples))
+
+# Returns the median of the successful samples, or None if every probe failed
+def summarize(samples):
+    successes = [rtt for rtt in samples if rtt is not None]
+    if not successes:
+        return None
+    return median(successes)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# ----------------------------- relayWatcher.py --------------------------- #
+# This script is designed to pick up a new relay csv without restarting the #
+# tunnel. A background thread polls the csv within the ./servers directory, #
+# including a replacement renamed over it, and any other csv dropped beside #
+# it, and when they change streams the new version and diffs its rows       #
+# against the last one, so only the rows that were added or changed are     #
+# parsed. The relay index is then repacked in memory and handed over in one #
+# reference swap, leaving the datapath and the cached RTTs of unchanged     #
+# relays alone.                                                             #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import csv as csvreader
+import hashlib
+import os
+import relayIndex
+import socket
+import threading
+import time
+
+INTERVAL = 5 # Seconds between checks of the csv
+
+# The relays that differ between two versions of the csv, as (country, ip, port) keys
+# changed holds relays listed in both whose bandwidth, flags or nickname moved
+class RelayDiff:
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, added=(), removed=(), changed=()):
+        self.added = set(added)
+        self.removed = set(removed)
+        self.changed = set(changed)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed"
+
+# Returns the country and record of a raw csv line, or None if it isn't a relay
+def parseLine(line):
+    row = next(csvreader.reader([line.decode(errors='replace')]), [])
+    return relayIndex.parseRow(row)
+
+# Returns the (country, ip, port) keys of parsed lines
+def relayKeys(parsed):
+    return {(country, socket.inet_ntoa(record[0]), record[1]) for country, record in parsed if country is not None}
+
+# Keeps a relay index in step with the csv it is compiled from, and with any other csv
+# dropped into the same directory, whose relays are added to it
+# onReload is called from the watcher's thread with the new relayIndex.RelayIndex and
+# the RelayDiff that produced it; the index is a new object, so readers of the old one
+# carry on undisturbed and a single assignment makes the new one live
+class RelayWatcher:
+    def __init__(self, csv_path, onReload, interval=INTERVAL, index_path=None):
+        self.csv_path = csv_path
+        self.directory = os.path.dirname(os.path.abspath(csv_path))
+        self.index_path = index_path or relayIndex.indexPath(csv_path)
+        self.onReload = onReload
+        self.listeners = [] # further callables told of every reload, after onReload
+        self.interval = interval
+        self.lines = set()   # raw data lines of the version last read
+        self.records = {}    # raw line -> (country, record) or (None, None), parsed once
+        self.signature = None # path, inode, mtime and size of each csv of the version last read
+        self.reloads = 0
+        self.reload_time = 0.0 # seconds the last reload took
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Returns the csv files the relays are read from: the csv, then any other csv in
+    # its directory by name
+    def paths(self):
+        try:
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith('.csv'))
+        except OSError:
+            names = []
+        own = os.path.basename(self.csv_path)
+        return [self.csv_path] + [os.path.join(self.directory, name) for name in names if name != own]
+
+    # Returns what identifies a version of the given csv files, by default every one
+    # the relays are read from, or None if the csv itself is missing
+    def stat(self, paths=None):
+        signature = []
+        for path in paths or self.paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if path == self.csv_path:
+                    return None
+                continue # an extra csv removed again since the directory was listed
+            signature.append((path, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    # Streams the files of a signature, returning their data lines in order and the
+    # sha1 of the whole csv
+    def read(self, signature):
+        digest = hashlib.sha1()
+        lines = []
+        for path, _, _, _ in signature:
+            with open(path, 'rb') as file:
+                header = file.readline()
+                if path != self.csv_path:
+                    lines.extend(file)
+                    continue
+                digest.update(header)
+                for line in file:
+                    digest.update(line)
+                    lines.append(line)
+        return lines, digest.digest()
+
+    # Learns the csv the relay list is about to be loaded from, returns the watcher
+    # Called before the list is loaded, so an edit made while it loads, or any other
+    # csv already in the directory, is applied by the first check
+    def seed(self):
+        signature = self.stat([self.csv_path])
+        if signature is None:
+            raise OSError(f"{self.csv_path} not found")
+        lines, _ = self.read(signature)
+        self.lines = set(lines)
+        self.records = {line: parseLine(line) or (None, None) for line in self.lines}
+        self.signature = signature
+        return self
+
+    # Checks the csv files and applies any change, returning the RelayDiff or None if
+    # they are unchanged, the csv is missing or a file is still being written
+    def reload(self):
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            return None
+        started = time.perf_counter()
+        lines, digest = self.read(signature)
+        if self.stat() != signature: # written to while being read, try again next round
+            return None
+
+        present = set(lines)
+        added = present - self.lines
+        removed = self.lines - present
+        records = self.records
+        gone = [records.pop(line) for line in removed]
+        fresh = []
+        for line in added:
+            parsed = records[line] = parseLine(line) or (None, None)
+            fresh.append(parsed)
+        self.lines = present
+        self.signature = signature
+
+        added_keys = relayKeys(fresh)
+        removed_keys = relayKeys(gone)
+        diff = RelayDiff(added_keys - removed_keys, removed_keys - added_keys, added_keys & removed_keys)
+
+        countries = {}
+        for line in lines:
+            country, record = records[line]
+            if country is not None:
+                countries.setdefault(country, []).append(record)
+        _, _, mtime, size = signature[0]
+        data = relayIndex.packIndex(countries, mtime, size, digest)
+        if len(signature) == 1: # the index on disk only ever holds the csv it is named after
+            try:
+                relayIndex.writeIndex(data, self.index_path) # so the next start maps it as is
+            except OSError as e:
+                print(f"Could not write the relay index: {e}")
+        index = relayIndex.RelayIndex(data)
+        self.onReload(index, diff)
+        for listener in self.listeners:
+            listener(index, diff)
+
+        self.reloads += 1
+        self.reload_time = time.perf_counter() - started
+        print(f"Relay list reloaded in {self.reload_time * 1000:.1f} ms: {diff}")
+        return diff
+
+    # Keeps checking the csv files on a background thread, learning the csv first if
+    # seed() wasn't called
+    def start(self):
+        if self.signature is None:
+            self.seed()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while True:
+            try:
+                self.reload()
+            except (OSError, ValueError) as e:
+                print(f"Could not reload the relay list: {e}")
+            if self.stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# ----------------------------- splitTunnel.py ---------------------------- #
+# This script is designed to decide which destinations go through the       #
+# tunnel and which bypass it. Include and exclude prefix lists, which may   #
+# hold tens of thousands of entries such as country IP lists, are compiled  #
+# into longest-prefix-match tries for IPv4 and IPv6. The same tries give    #
+# the smallest set of routes to install for the TUN device and a per-packet #
+# forward or bypass decision in the datapath, looked up a byte at a time    #
+# straight from the packet header.                                          #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import ipaddress
+import os
+from array import array
+
+BYPASS  = 0  # Send the packet outside the tunnel
+FORWARD = 1  # Send the packet through the tunnel
+STRIDE  = 8  # Bits consumed per trie level, so each level is indexed by one address byte
+FANOUT  = 1 << STRIDE
+
+# A multibit trie mapping prefixes to values by longest match
+# Every node is FANOUT consecutive entries of flat arrays, a prefix is expanded over the
+# entries it covers in the node at its last byte, and each entry remembers the length of
+# the prefix that set it so a longer prefix always wins whatever the insertion order
+# A lookup reads at most one entry per address byte: 4 for IPv4, 16 for IPv6
+class PrefixTrie:
+    def __init__(self, version=4, default=None):
+        self.version = version
+        self.depth = 4 if version == 4 else 16 # address bytes
+        self.default = default # value when no prefix matches, set by a /0 prefix
+        self.children = array('i', bytes(4 * FANOUT)) # entry -> first entry of the child node, 0 for none
+        self.values = array('b', b'\xff' * FANOUT)    # entry -> value, -1 for none
+        self.lengths = array('B', bytes(FANOUT))      # entry -> length of the prefix that set the value
+        self.count = 0 # prefixes inserted
+
+    # Appends an empty node, returns its first entry
+    def addNode(self):
+        first = len(self.values)
+        self.children.extend(array('i', bytes(4 * FANOUT)))
+        self.values.extend(array('b', b'\xff' * FANOUT))
+        self.lengths.extend(array('B', bytes(FANOUT)))
+        return first
+
+    # Maps a prefix (an ip_network of the trie's version) to a value, overriding
+    # a prefix of the same length inserted earlier
+    def insert(self, network, value):
+        length = network.prefixlen
+        self.count += 1
+        if length == 0:
+            self.default = value
+            return
+
+        address = network.network_address.packed
+        node = 0
+        last = (length - 1) // STRIDE # level holding the prefix
+        for level in range(last):
+            entry = node + address[level]
+            child = self.children[entry]
+            if not child:
+                child = self.children[entry] = self.addNode()
+            node = child
+
+        span = 1 << (STRIDE * (last + 1) - length) # entries the prefix covers in its node
+        start = node + address[last]
+        for entry in range(start, start + span):
+            if length >= self.lengths[entry]:
+                self.values[entry] = value
+                self.lengths[entry] = length
+
+    # Returns the value of the longest prefix matching the address stored at offset in data
+    def lookup(self, data, offset=0):
+        children = self.children
+        values = self.values
+        best = self.default
+        node = 0
+        for i in range(offset, offset + self.depth):
+            entry = node + data[i]
+            value = values[entry]
+            if value >= 0:
+                best = value
+            node = children[entry]
+            if not node:
+                break
+        return best
+
+    # Returns the value of the longest prefix matching an ip_address
+    def lookupAddress(self, address):
+        return self.lookup(address.packed)
+
+    # Returns the bytes held by the trie's arrays
+    def size(self):
+        return len(self.children) * 4 + len(self.values) + len(self.lengths)
+
+# Returns the ip_networks listed in entries, each either a prefix or the path of a
+# file holding one prefix per line, with # comments and blank lines ignored
+def loadPrefixes(entries):
+    networks = []
+    for entry in entries or ():
+        entry = str(entry).strip()
+        if os.path.isfile(entry):
+            with open(entry) as f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        networks.append(ipaddress.ip_network(line, strict=False))
+        else:
+            networks.append(ipaddress.ip_network(entry, strict=False))
+    return networks
+
+# The forward or bypass decision of every destination
+# With an include list only destinations it covers are tunneled, otherwise everything
+# is; exclude wins over include for the same prefix and the longest prefix wins overall
+# bypass holds destinations that must never be tunneled whatever the lists say, such
+# as the local networks and the relays themselves, which would otherwise loop
+# The relay only carries IPv4 unless ipv6 is set, so without it IPv6 is tunneled only
+# where the include list names IPv6 prefixes and otherwise stays on the local network
+class SplitTunnel:
+    def __init__(self, include=(), exclude=(), bypass=(), ipv6=False):
+        include = loadPrefixes(include)
+        default4 = BYPASS if include else FORWARD
+        default6 = FORWARD if ipv6 and not include else BYPASS
+        exclude = loadPrefixes(exclude) + [ipaddress.ip_network(n, strict=False) for n in bypass]
+        self.tries = {4: PrefixTrie(4, default4), 6: PrefixTrie(6, default6)}
+        self.prefixes = {4: [], 6: []} # every prefix inserted, for computing routes
+        for value, networks in ((FORWARD, include), (BYPASS, exclude)):
+            for network in networks:
+                self.tries[network.version].insert(network, value)
+                self.prefixes[network.version].append(network)
+        self.forwarded = 0
+        self.bypassed = 0
+
+    # Makes a destination bypass the tunnel from now on, e.g. a relay failed over to
+    # A lookup running meanwhile sees the trie before or after, never a node half made
+    def addBypass(self, network):
+        network = ipaddress.ip_network(network, strict=False)
+        self.tries[network.version].insert(network, BYPASS)
+        self.prefixes[network.version].append(network)
+
+    # Returns True if a packet's destination goes through the tunnel
+    def forwards(self, packet):
+        version = packet[0] >> 4
+        if version == 4:
+            return self.tries[4].lookup(packet, 16) == FORWARD
+        if version == 6:
+            return self.tries[6].lookup(packet, 24) == FORWARD
+        return False
+
+    # Pipeline stage dropping packets whose destination bypasses the tunnel, which
+    # only arrive when some other route points them at the TUN device
+    def __call__(self, packet):
+        if self.forwards(packet):
+            self.forwarded += 1
+            return packet
+        self.bypassed += 1
+        return None
+
+    # Returns the smallest list of prefixes covering exactly the tunneled destinations
+    # of an IP version. Every prefix boundary splits the address space into intervals
+    # with one decision each, tunneled intervals are merged and summarized into CIDR
+    # blocks, and a whole address space is returned as two halves so the routes sit
+    # beside the existing default route instead of replacing it
+    def routes(self, version=4):
+        trie = self.tries[version]
+        bits = 32 if version == 4 else 128
+        top = 1 << bits
+        boundaries = {0}
+        for network in self.prefixes[version]:
+            boundaries.add(int(network.network_address))
+            boundaries.add(int(network.broadcast_address) + 1)
+        boundaries.discard(top)
+        starts = sorted(boundaries)
+
+        address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        routes = []
+        first = None
+        for start in starts:
+            tunneled = trie.lookup(start.to_bytes(bits // 8, 'big')) == FORWARD
+            if tunneled and first is None:
+                first = start
+            elif not tunneled and first is not None:
+                routes.extend(ipaddress.summarize_address_range(address(first), address(start - 1)))
+                first = None
+        if first is not None:
+            routes.extend(ipaddress.summarize_address_range(address(first), address(top - 1)))
+
+        if routes and routes[0].prefixlen == 0:
+            routes = list(routes[0].subnets(1))
+        return routes
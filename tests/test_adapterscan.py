@@ -0,0 +1,87 @@
+# Tests for the buddy allocator of tunnel subnets and the pool of client addresses
+
+import ipaddress
+
+import pytest
+
+import adapterscan
+
+
+def net(text):
+    return ipaddress.ip_network(text)
+
+
+def test_allocations_split_the_pool_lowest_first():
+    allocator = adapterscan.AddressAllocator('10.0.0.0/24')
+    assert allocator.allocate(26) == net('10.0.0.0/26')
+    assert allocator.allocate(25) == net('10.0.0.128/25')
+    assert allocator.allocate(27) == net('10.0.0.64/27')
+    assert allocator.allocate(27) == net('10.0.0.96/27')
+
+
+def test_local_networks_are_never_handed_out():
+    allocator = adapterscan.AddressAllocator('10.0.0.0/24', [net('10.0.0.0/25'), net('192.168.1.0/24')])
+    assert allocator.conflicts('10.0.0.5') and not allocator.conflicts('10.0.0.200')
+    assert allocator.allocate(26) == net('10.0.0.128/26')
+
+
+def test_an_exhausted_pool_returns_none():
+    allocator = adapterscan.AddressAllocator('10.0.0.0/24')
+    subnets = [allocator.allocate(26) for _ in range(4)]
+    assert len(set(subnets)) == 4
+    assert allocator.allocate(26) is None
+    assert allocator.allocate(30) is None
+    with pytest.raises(ValueError):
+        allocator.allocate(23)
+
+
+def test_released_buddies_merge_back_into_the_full_block():
+    allocator = adapterscan.AddressAllocator('10.0.0.0/24')
+    subnets = [allocator.allocate(26) for _ in range(4)]
+    for subnet in reversed(subnets):
+        allocator.release(subnet)
+    assert allocator.allocate(24) == net('10.0.0.0/24')
+
+
+def test_a_lone_release_waits_for_its_buddy():
+    allocator = adapterscan.AddressAllocator('10.0.0.0/24')
+    first, second = allocator.allocate(25), allocator.allocate(25)
+    allocator.release(first)
+    assert allocator.allocate(24) is None
+    allocator.release(second)
+    assert allocator.allocate(24) == net('10.0.0.0/24')
+
+
+def test_double_release_is_refused():
+    allocator = adapterscan.AddressAllocator('10.0.0.0/24')
+    subnet = allocator.allocate(26)
+    allocator.allocate(26)
+    allocator.release(subnet)
+    with pytest.raises(ValueError):
+        allocator.release(subnet)
+    with pytest.raises(ValueError):
+        allocator.release('10.0.0.128/27') # inside the free upper half
+    with pytest.raises(ValueError):
+        allocator.release('10.1.0.0/26')
+    assert allocator.allocate(26) == subnet
+
+
+def test_address_pool_skips_network_and_broadcast_and_reuses_released():
+    pool = adapterscan.AddressPool('10.201.0.0/30')
+    first, second = pool.allocate(), pool.allocate()
+    assert (str(first), str(second)) == ('10.201.0.1', '10.201.0.2')
+    assert pool.allocate() is None
+    pool.release(first)
+    assert pool.allocate() == first
+
+
+def test_address_pool_refuses_a_double_release():
+    pool = adapterscan.AddressPool('10.201.0.0/24')
+    address = pool.allocate()
+    pool.release(address)
+    with pytest.raises(ValueError):
+        pool.release(address)
+    with pytest.raises(ValueError):
+        pool.release('10.201.0.200') # never handed out
+    assert pool.allocate() == address
+    assert pool.allocate() == ipaddress.ip_address('10.201.0.2')
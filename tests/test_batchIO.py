@@ -0,0 +1,43 @@
+# Tests for packet batches and running them through the pipeline stages
+
+import batchIO
+import tunLinux
+from pipeline import Pipeline
+
+
+def test_oversized_packet_is_refused_and_leaves_the_slot_alone():
+    batch = batchIO.PacketBatch(2, buffer_size=64)
+    assert batch.store(0, b'a' * 10)
+    assert not batch.store(0, b'b' * 65)
+    assert bytes(batch.slots[0][:batch.lengths[0]]) == b'a' * 10
+
+
+# A batch of count packets whose first byte numbers them
+def numbered(count, buffer_size=64):
+    batch = batchIO.PacketBatch(count, buffer_size)
+    for i in range(count):
+        batch.store(i, bytes([i]) * 8)
+    batch.count = count
+    return batch
+
+
+def test_a_failing_stage_drops_only_its_packet():
+    def stage(packet):
+        if packet[0] == 1:
+            raise ValueError("malformed")
+        return packet
+
+    pipeline = Pipeline(('192.0.2.1', 9001))
+    pipeline.addOutbound(stage)
+    batch = numbered(4)
+    tunLinux.processBatch(batch, pipeline)
+    assert [batch.packet(i)[0] for i in range(batch.count)] == [0, 2, 3]
+    assert pipeline.failures == 1
+
+
+def test_a_packet_grown_past_its_slot_is_dropped_alone():
+    pipeline = Pipeline(('192.0.2.1', 9001))
+    pipeline.addOutbound(lambda packet: bytes(packet) * 16 if packet[0] == 2 else packet)
+    batch = numbered(4)
+    tunLinux.processBatch(batch, pipeline)
+    assert [batch.packet(i)[0] for i in range(batch.count)] == [0, 1, 3]
@@ -0,0 +1,48 @@
+# Tests for relay selection in bridges
+
+import pytest
+
+import bridges
+import relayCache
+import relayIndex
+
+CSV = """IP Address,Country,ORPort,Bandwidth (MiB/s),Flags,Nickname
+10.0.0.1,xx,443,1.00,"Fast, Running, Stable",first
+10.0.0.1,xx,9001,1.00,"Fast, Running, Stable",second
+10.0.0.2,xx,443,0.50,"Running",third
+"""
+
+
+@pytest.fixture
+def relays(tmp_path, monkeypatch):
+    path = tmp_path / 'relays.csv'
+    path.write_text(CSV)
+    cache = relayCache.RelayCache(str(tmp_path / 'cache.json'))
+    monkeypatch.setattr(bridges, 'country_relays', relayIndex.loadInMemory(str(path)))
+    monkeypatch.setattr(relayCache, 'cache', cache)
+    monkeypatch.setattr(bridges, 'probeAndCache', lambda relays: {})
+    return cache
+
+
+def test_fastest_relay_keeps_the_port_it_measured(relays):
+    relays.record('10.0.0.1', 9001, [0.005])
+    relays.record('10.0.0.1', 443, [None])
+    assert bridges.chooseRelay('xx', 'fastest') == ('10.0.0.1', 9001)
+
+
+def test_relays_sharing_an_ip_are_ranked_apart(relays):
+    relays.record('10.0.0.1', 443, [0.5])
+    relays.record('10.0.0.1', 9001, [0.001])
+    assert bridges.chooseRelay('xx', 'ranked') == ('10.0.0.1', 9001)
+
+
+def test_unprobed_country_probes_every_address(relays, monkeypatch):
+    probed = []
+
+    def probe(candidates):
+        probed.extend(relay.address for relay in candidates)
+        return {('10.0.0.2', 443): 0.001}
+
+    monkeypatch.setattr(bridges, 'probeAndCache', probe)
+    assert bridges.chooseRelay('xx', 'fastest') == ('10.0.0.2', 443)
+    assert sorted(probed) == [('10.0.0.1', 443), ('10.0.0.1', 9001), ('10.0.0.2', 443)]
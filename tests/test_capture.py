@@ -0,0 +1,78 @@
+# Tests for the capture ring and writing it out on SIGUSR1 from queue workers
+
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+import capture
+
+PACKET = bytes([0x45]) + bytes(19)
+
+
+def test_ring_keeps_the_newest_packets(tmp_path):
+    ring = capture.CaptureRing(slots=4)
+    for i in range(6):
+        ring.record(PACKET + bytes([i]), capture.OUTBOUND)
+    assert ring.dump(str(tmp_path / 'ring.pcap')) == 4
+    assert [ring.view[slot * ring.snaplen + 20] for slot in ring.order()] == [2, 3, 4, 5]
+
+
+# Records packets into the forked ring like a queue worker, then waits for SIGUSR1
+def worker(ring, directory, ready, count):
+    capture.installSignal(ring, directory)
+    for _ in range(count):
+        ring.record(PACKET, capture.OUTBOUND)
+    ready.set()
+    deadline = time.monotonic() + 5
+    while not os.listdir(directory) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason="needs SIGUSR1")
+def test_parent_signal_writes_one_file_per_worker(tmp_path):
+    context = multiprocessing.get_context('fork')
+    previous = signal.getsignal(signal.SIGUSR1)
+    pids = []
+    capture.forwardSignal(pids)
+    try:
+        workers = []
+        for i in range(2):
+            ready = context.Event()
+            directory = tmp_path / str(i)
+            directory.mkdir()
+            process = context.Process(target=worker, args=(capture.CaptureRing(), str(directory), ready, i + 1), daemon=True)
+            process.start()
+            pids.append(process.pid)
+            workers.append((process, ready, directory))
+        for _, ready, _ in workers:
+            assert ready.wait(5)
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        for process, _, _ in workers:
+            process.join(5)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+    for i, (_, _, directory) in enumerate(workers):
+        files = os.listdir(directory)
+        assert len(files) == 1 and str(pids[i]) in files[0]
+        size = os.path.getsize(directory / files[0])
+        assert size == capture.PCAP_HEADER.size + (i + 1) * (capture.PCAP_RECORD.size + len(PACKET))
+
+
+def test_filter_does_not_match_short_packets():
+    udp = bytearray(PACKET)
+    udp[9] = 17
+    match = capture.parseFilter('udp host 0.0.0.0 port 53')
+    for packet in (b'', bytes([0x45]), bytes(udp[:12]), bytes(udp), bytes([0x60]) + bytes(20)):
+        assert not match(packet)
+    assert match(bytes(udp) + bytes([0, 53, 0, 0]))
+
+
+def test_ring_passes_short_packets_over():
+    ring = capture.CaptureRing(slots=4, filter=capture.parseFilter('tcp port 443'))
+    ring.record(b'\x45\x00', capture.OUTBOUND)
+    ring.record(b'', capture.INBOUND)
+    assert next(ring.counter) == 0 # nothing recorded
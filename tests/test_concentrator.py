@@ -0,0 +1,106 @@
+# Tests for the concentrator's unsealed datapath
+
+import socket
+
+import pytest
+
+import concentrator
+import framing
+
+
+def ipv4(source, destination, size=40):
+    header = bytearray(20)
+    header[0] = 0x45
+    header[2:4] = size.to_bytes(2, 'big')
+    header[8] = 64
+    header[9] = 17
+    header[12:16] = socket.inet_aton(source)
+    header[16:20] = socket.inet_aton(destination)
+    return bytes(header) + bytes(size - 20)
+
+
+def frame(*packets):
+    return bytes([framing.FRAME_MAGIC]) + b''.join(framing.LENGTH.pack(len(p)) + p for p in packets)
+
+
+@pytest.fixture
+def running():
+    kernel, tun = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(0.2)
+    hub = concentrator.Concentrator(tun.fileno(), server, concentrator.SessionTable('10.201.0.0/16')).start()
+    kernel.settimeout(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(('127.0.0.1', 0))
+    client.settimeout(1)
+    yield hub, server.getsockname(), kernel, client
+    hub.stop()
+    for sock in (client, server, kernel, tun):
+        sock.close()
+
+
+# Returns the datagrams the client receives until count packets have arrived
+def receive(client, count):
+    datagrams = []
+    packets = 0
+    while packets < count:
+        datagram = client.recv(2000)
+        datagrams.append(datagram)
+        packets += len(list(framing.unpack(datagram))) if framing.isFramed(datagram) else 1
+    return datagrams
+
+
+def test_replies_to_a_framing_client_are_framed(running):
+    hub, address, kernel, client = running
+    client.sendto(frame(ipv4('10.0.100.1', '198.51.100.1'), ipv4('10.0.100.1', '198.51.100.2')), address)
+    assert kernel.recv(2000)[12:16] == socket.inet_aton('10.201.0.2')
+    kernel.recv(2000)
+
+    for i in range(3):
+        kernel.send(ipv4('198.51.100.1', '10.201.0.2', 60 + i))
+    datagrams = receive(client, 3)
+    assert all(framing.isFramed(datagram) for datagram in datagrams)
+    packets = [packet for datagram in datagrams for packet in framing.unpack(datagram)]
+    assert [len(packet) for packet in packets] == [60, 61, 62]
+    assert all(packet[16:20] == socket.inet_aton('10.0.100.1') for packet in packets)
+
+
+def test_replies_to_a_plain_client_are_not_framed(running):
+    hub, address, kernel, client = running
+    client.sendto(ipv4('10.0.100.1', '198.51.100.1'), address)
+    kernel.recv(2000)
+
+    kernel.send(ipv4('198.51.100.1', '10.201.0.2'))
+    reply = client.recv(2000)
+    assert not framing.isFramed(reply)
+    assert reply[16:20] == socket.inet_aton('10.0.100.1')
+
+
+def test_large_replies_leave_unframed(running):
+    hub, address, kernel, client = running
+    client.sendto(frame(ipv4('10.0.100.1', '198.51.100.1')), address)
+    kernel.recv(2000)
+
+    kernel.send(ipv4('198.51.100.1', '10.201.0.2', framing.MAX_DATAGRAM))
+    reply = client.recv(2000)
+    assert not framing.isFramed(reply) and len(reply) == framing.MAX_DATAGRAM
+
+
+
+def test_framed_replies_leave_while_the_tun_device_stays_busy(running, monkeypatch):
+    hub, address, kernel, client = running
+    client.sendto(frame(ipv4('10.0.100.1', '198.51.100.1')), address)
+    kernel.recv(2000)
+
+    real = concentrator.select.select
+    busy = lambda r, w, x, timeout=None: (r, [], []) if r == [hub.tun] else real(r, w, x, timeout)
+    monkeypatch.setattr(concentrator.select, 'select', busy) # the TUN device never looks idle
+    hub.flush_deadline = 0
+    kernel.send(ipv4('198.51.100.1', '10.201.0.2', 60))
+    try:
+        reply = client.recv(2000)
+        assert [len(packet) for packet in framing.unpack(reply)] == [60]
+    finally:
+        monkeypatch.undo()
+        kernel.send(ipv4('198.51.100.1', '10.201.9.9')) # wakes the loop blocked reading
@@ -0,0 +1,140 @@
+# Tests for dnsCache's answers, negative caching, expiry and prefetching
+
+import os
+import struct
+
+import pytest
+
+import dnsCache
+
+CLIENT = bytes([10, 0, 0, 2])
+RESOLVER = bytes([1, 1, 1, 1])
+PORT = 40000
+NAME = b'\x07example\x03com\x00'
+QUESTION = NAME + struct.pack('!HH', 1, 1) # A, IN
+
+
+def udp(source, destination, sport, dport, message):
+    length = 8 + len(message)
+    packet = bytearray(20 + length)
+    struct.pack_into('!BBHHHBBH4s4s', packet, 0, 0x45, 0, len(packet), 0, 0x4000, 64, dnsCache.UDP, 0, source, destination)
+    struct.pack_into('!HHHH', packet, 20, sport, dport, length, 0)
+    packet[28:] = message
+    return packet
+
+
+def query(ident, port=PORT):
+    return udp(CLIENT, RESOLVER, port, dnsCache.DNS_PORT, dnsCache.HEADER.pack(ident, 0x0100, 1, 0, 0, 0) + QUESTION)
+
+
+def answer(ident, ttl=300, port=PORT):
+    record = b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, ttl, 4) + bytes([93, 184, 216, 34])
+    message = dnsCache.HEADER.pack(ident, 0x8180, 1, 1, 0, 0) + QUESTION + record
+    return udp(RESOLVER, CLIENT, dnsCache.DNS_PORT, port, message)
+
+
+def nxdomain(ident, minimum=900, port=PORT):
+    soa = b'\x02ns\xc0\x14' + b'\x04host\xc0\x14' + struct.pack('!IIIII', 1, 7200, 900, 1209600, minimum)
+    record = b'\xc0\x14' + struct.pack('!HHIH', dnsCache.SOA, 1, 3600, len(soa)) + soa
+    message = dnsCache.HEADER.pack(ident, 0x8183, 1, 0, 1, 0) + QUESTION + record
+    return udp(RESOLVER, CLIENT, dnsCache.DNS_PORT, port, message)
+
+
+@pytest.fixture
+def cache():
+    read, write = os.pipe()
+    os.set_blocking(read, False)
+    cache = dnsCache.DNSCache(prefetch=0)
+    cache.tun = write
+    cache.replies = read
+    yield cache
+    os.close(read)
+    os.close(write)
+
+
+def reply(cache):
+    packet = os.read(cache.replies, 65535)
+    return packet[28:]
+
+
+def test_answer_is_cached_and_served_with_the_query_id(cache):
+    packet = query(1)
+    assert cache.outbound(packet) is packet
+    assert cache.inbound(answer(1)) is not None
+    assert cache.outbound(query(2)) is None
+    message = reply(cache)
+    assert struct.unpack_from('!H', message)[0] == 2
+    assert message[12:12 + len(QUESTION)] == QUESTION
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_unasked_response_is_not_cached(cache):
+    cache.inbound(answer(1))
+    assert not cache.entries
+    packet = query(1, port=PORT + 1)
+    cache.outbound(packet)
+    cache.inbound(answer(1)) # the client port doesn't match the query's
+    assert not cache.entries
+
+
+def test_ttl_counts_down_and_entry_expires(cache):
+    cache.outbound(query(1))
+    cache.inbound(answer(1, ttl=300))
+    entry = next(iter(cache.entries.values()))
+    entry.stored -= 100
+    cache.outbound(query(2))
+    ttl = struct.unpack_from('!I', reply(cache), 12 + len(QUESTION) + 6)[0]
+    assert ttl == 200
+    entry.stored -= 200
+    packet = query(3)
+    assert cache.outbound(packet) is packet
+    assert not cache.entries
+
+
+def test_nxdomain_is_cached_for_at_most_negative_ttl(cache):
+    cache.outbound(query(1))
+    cache.inbound(nxdomain(1))
+    entry = next(iter(cache.entries.values()))
+    assert entry.negative and entry.lifetime == dnsCache.NEGATIVE_TTL
+    assert cache.outbound(query(2)) is None
+    assert cache.negative_hits == 1
+
+
+def test_negative_ttl_zero_keeps_no_negative_answers(cache):
+    cache.negative_ttl = 0
+    cache.outbound(query(1))
+    cache.inbound(nxdomain(1))
+    assert not cache.entries
+
+
+def test_least_recently_used_answer_is_evicted(cache):
+    cache.size = 1
+    cache.outbound(query(1))
+    cache.inbound(answer(1))
+    other = query(2)
+    other[28 + 12 + 1] = ord('x') # xxample.com
+    cache.outbound(other)
+    response = answer(2)
+    response[28 + 12 + 1] = ord('x')
+    cache.inbound(response)
+    assert len(cache.entries) == 1
+    packet = query(3)
+    assert cache.outbound(packet) is packet
+
+
+def test_answer_close_to_expiry_is_refreshed(cache):
+    cache.prefetch = 0.5
+    cache.outbound(query(1))
+    cache.inbound(answer(1, ttl=100))
+    stale = next(iter(cache.entries.values()))
+    stale.stored -= 60
+    packet = query(2)
+    assert cache.outbound(packet) is packet # answered and sent on to refresh
+    assert struct.unpack_from('!H', reply(cache))[0] == 2
+    fresh = struct.unpack_from('!H', packet, 28)[0]
+    assert cache.prefetches == 1
+    assert cache.inbound(answer(fresh, ttl=100)) is None # the refresh goes no further
+    assert next(iter(cache.entries.values())) is not stale
+    assert cache.outbound(query(3)) is None
+    reply(cache)
+    assert cache.prefetches == 1
@@ -0,0 +1,62 @@
+# Tests for the flow balancer's bucket table, weighting and rendezvous hashing
+
+import socket
+import struct
+
+import flowBalancer
+
+A = ('192.0.2.1', 443)
+B = ('192.0.2.2', 443)
+C = ('192.0.2.3', 9001)
+
+
+# Returns an IPv4 TCP packet of a flow between two ports
+def flow(sport, dport=443, source='10.0.0.2', destination='198.51.100.7'):
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0x4000, 64, 6, 0,
+                         socket.inet_aton(source), socket.inet_aton(destination))
+    return header + struct.pack('!HH', sport, dport) + bytes(16)
+
+
+def test_shares_follow_the_weights():
+    balancer = flowBalancer.FlowBalancer([(A, 3.0), (B, 1.0)])
+    shares = balancer.shares()
+    assert abs(shares[A] - 0.75) < 0.03
+    assert abs(shares[B] - 0.25) < 0.03
+
+
+def test_relays_without_bandwidth_still_get_a_minimum_weight():
+    balancer = flowBalancer.FlowBalancer([(A, 1.0), (B, 0.0)])
+    assert dict(balancer.relays)[B] == flowBalancer.MIN_WEIGHT
+
+
+def test_a_flow_always_maps_to_the_same_relay():
+    balancer = flowBalancer.FlowBalancer([(A, 1.0), (B, 1.0), (C, 1.0)])
+    for sport in range(40000, 40200):
+        assert len({balancer.route(flow(sport)) for _ in range(3)}) == 1
+    assert len({balancer.route(flow(sport)) for sport in range(40000, 40200)}) == 3
+
+
+def test_fragments_hash_on_their_addresses_alone():
+    first, second = bytearray(flow(40000)), bytearray(flow(50000, 80))
+    assert flowBalancer.flowHash(first) != flowBalancer.flowHash(second)
+    first[6] = second[6] = 0x20 # more fragments, whose ports only the first would carry
+    assert flowBalancer.flowHash(first) == flowBalancer.flowHash(second)
+
+def test_removing_a_relay_only_moves_its_flows():
+    balancer = flowBalancer.FlowBalancer([(A, 1.0), (B, 1.0), (C, 1.0)])
+    before = list(balancer.table)
+    assert balancer.remove(B)
+    for old, new in zip(before, balancer.table):
+        if old != B:
+            assert new == old
+        else:
+            assert new in (A, C)
+    assert B not in balancer.shares()
+
+
+def test_the_last_relay_is_never_removed():
+    balancer = flowBalancer.FlowBalancer([(A, 1.0)])
+    assert not balancer.remove(A)
+    assert not balancer.remove(B)
+    assert set(balancer.table) == {A}
+
@@ -0,0 +1,49 @@
+# Tests for the headless command line and config file
+
+import json
+
+import pytest
+
+import os
+import subprocess
+import sys
+
+import batchIO
+import headless
+
+
+def test_defaults_follow_the_module_constants():
+    options = headless.parseArguments(['--country', 'de'])
+    assert options['batch_size'] == batchIO.BATCH_SIZE
+    assert options['flush_deadline'] == batchIO.FLUSH_DEADLINE
+    assert options['dns_negative_ttl'] is None and options['cipher'] is None # left to tunLinux.run
+    assert options['metrics_port'] is None
+
+
+def test_optional_modules_load_only_when_their_options_are_checked():
+    code = ("import sys, headless; headless.parseArguments(['--country', 'de']); "
+            "print(sorted({'capture', 'dnsCache', 'relayWatcher', 'tunnelCrypto', 'cryptography'} & set(sys.modules)))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == '[]'
+
+
+def test_an_unknown_cipher_is_rejected(tmp_path):
+    key = tmp_path / 'key'
+    key.write_bytes(bytes(32))
+    with pytest.raises(SystemExit):
+        headless.parseArguments(['--country', 'de', '--key-file', str(key), '--cipher', 'rot13'])
+
+
+def test_command_line_overrides_the_config_file(tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'country': 'de', 'batch_size': 16, 'mode': 'packet'}))
+    options = headless.parseArguments(['--config', str(config), '--batch-size', '32'])
+    assert options['batch_size'] == 32 and options['mode'] == 'packet'
+
+
+def test_unknown_config_options_are_rejected(tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'country': 'de', 'batch': 16}))
+    with pytest.raises(SystemExit):
+        headless.parseArguments(['--config', str(config)])
@@ -0,0 +1,9 @@
+# Tests for the options the interactive start reads from the command line
+
+import main
+
+
+def test_metrics_are_off_unless_asked_for():
+    assert main.metricsPort([]) is None
+    assert main.metricsPort(['--metrics-port', '9469']) == 9469
+    assert main.metricsPort(['--metrics-port']) is None
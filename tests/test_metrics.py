@@ -0,0 +1,65 @@
+# Tests for the per-thread counters and their Prometheus text exposition
+
+import threading
+
+import metrics
+
+
+# Updates a fresh set of counters for direction from a thread of its own
+def countFrom(registry, direction, packets, size):
+    def loop():
+        counters = registry.get(direction)
+        counters.packets += packets
+        counters.bytes += packets * size
+        counters.send.observe(1500) # ns, the second bucket
+    thread = threading.Thread(target=loop)
+    thread.start()
+    thread.join()
+
+
+def test_thread_counters_are_merged_per_direction():
+    registry = metrics.Registry()
+    countFrom(registry, 'outbound', 3, 100)
+    countFrom(registry, 'outbound', 2, 50)
+    countFrom(registry, 'inbound', 1, 10)
+    assert len(registry.counters) == 3
+    totals = registry.totals()
+    assert (totals['outbound'].packets, totals['outbound'].bytes) == (5, 400)
+    assert totals['outbound'].send.counts[1] == 2
+    assert totals['inbound'].packets == 1
+
+
+def test_render_exposition_format():
+    registry = metrics.Registry()
+    countFrom(registry, 'outbound', 3, 100)
+    countFrom(registry, 'outbound', 2, 50)
+    lines = registry.render().splitlines()
+
+    assert '# HELP phaethon_packets_total Packets handed on.' in lines
+    assert '# TYPE phaethon_packets_total counter' in lines
+    assert 'phaethon_packets_total{direction="outbound"} 5' in lines
+    assert 'phaethon_bytes_total{direction="outbound"} 400' in lines
+    assert '# TYPE phaethon_queue_depth gauge' in lines
+    assert '# TYPE phaethon_send_latency_seconds histogram' in lines
+    assert 'phaethon_send_latency_seconds_bucket{direction="outbound",le="1.024e-06"} 0' in lines
+    assert 'phaethon_send_latency_seconds_bucket{direction="outbound",le="2.048e-06"} 2' in lines
+    assert 'phaethon_send_latency_seconds_bucket{direction="outbound",le="+Inf"} 2' in lines
+    assert 'phaethon_send_latency_seconds_count{direction="outbound"} 2' in lines
+    for i, line in enumerate(lines): # every TYPE line follows the HELP line of its metric
+        if line.startswith('# TYPE '):
+            assert lines[i - 1].startswith('# HELP ' + line.split()[2] + ' ')
+
+
+def test_added_metrics_escape_labels_and_help():
+    registry = metrics.Registry()
+    registry.addMetric('classes', 'gauge', "Per class\\depth\nsecond line.",
+                       lambda: [({'class': 'say "hi"\\now\n'}, 3), ({}, 1)])
+    registry.addMetric('plain', 'counter', "A plain counter.", lambda: 7)
+    registry.addMetric('broken', 'gauge', "Raises when read.", lambda: 1 / 0)
+    lines = registry.render().splitlines()
+
+    assert '# HELP phaethon_classes Per class\\\\depth\\nsecond line.' in lines
+    assert 'phaethon_classes{class="say \\"hi\\"\\\\now\\n"} 3' in lines
+    assert 'phaethon_classes 1' in lines
+    assert '# TYPE phaethon_plain counter' in lines and 'phaethon_plain 7' in lines
+    assert not any('broken' in line for line in lines)
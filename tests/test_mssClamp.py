@@ -0,0 +1,108 @@
+# Tests for mssClamp's MSS rewrite and its incremental checksum update
+
+import socket
+import struct
+
+import mssClamp
+from pipeline import Pipeline
+
+SOURCE = '10.0.0.2'
+DESTINATION = '198.51.100.7'
+
+
+# Returns the ones' complement checksum of data, computed from scratch
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+# Returns the TCP checksum of an IPv4 packet's segment with its checksum field zeroed
+def tcpChecksum(packet):
+    segment = bytearray(packet[20:])
+    segment[16:18] = b'\0\0'
+    pseudo = packet[12:20] + struct.pack('!BBH', 0, mssClamp.TCP, len(segment))
+    return checksum(bytes(pseudo) + bytes(segment))
+
+
+# Returns an IPv4 TCP packet with the given flags and an MSS option, checksums valid
+def tcpPacket(mss=1460, flags=mssClamp.SYN, payload=b''):
+    options = struct.pack('!BBH', mssClamp.MSS_KIND, 4, mss) + b'\x01\x01\x04\x02' # MSS, NOP, NOP, SACK permitted
+    tcp = bytearray(struct.pack('!HHIIBBHHH', 40000, 443, 1, 0, (20 + len(options)) // 4 << 4, flags, 65535, 0, 0))
+    tcp += options + payload
+    ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0x4000, 64, mssClamp.TCP, 0,
+                               socket.inet_aton(SOURCE), socket.inet_aton(DESTINATION)))
+    ip[10:12] = struct.pack('!H', checksum(bytes(ip)))
+    packet = ip + tcp
+    packet[36:38] = struct.pack('!H', tcpChecksum(packet))
+    return packet
+
+
+def clamp(mtu=1400):
+    pipeline = Pipeline((DESTINATION, 443))
+    pipeline.mtu = mtu
+    return mssClamp.MSSClamp(pipeline)
+
+
+def mssOf(packet):
+    return struct.unpack_from('!H', packet, 42)[0]
+
+
+def test_syn_mss_is_lowered_and_checksum_stays_valid():
+    stage = clamp(1400)
+    packet = tcpPacket(1460, payload=b'odd')
+    assert stage(packet) is packet
+    assert mssOf(packet) == 1400 - mssClamp.IPV4_TCP
+    assert struct.unpack_from('!H', packet, 36)[0] == tcpChecksum(packet)
+    assert stage.clamped == 1
+
+
+def test_syn_ack_is_clamped_too():
+    packet = tcpPacket(9000, flags=mssClamp.SYN | 0x10)
+    clamp()(packet)
+    assert mssOf(packet) == 1360
+    assert struct.unpack_from('!H', packet, 36)[0] == tcpChecksum(packet)
+
+
+def test_mss_below_the_clamp_is_left_alone():
+    stage = clamp(1400)
+    packet = tcpPacket(1200)
+    original = bytes(packet)
+    stage(packet)
+    assert bytes(packet) == original and stage.clamped == 0
+
+
+def test_non_syn_packets_pass_unchanged():
+    packet = tcpPacket(1460, flags=0x10) # ACK
+    original = bytes(packet)
+    clamp()(packet)
+    assert bytes(packet) == original
+
+
+def test_non_tcp_and_non_ip_packets_pass_unchanged():
+    udp = tcpPacket(1460)
+    udp[9] = 17
+    garbage = bytearray(b'\x00' * 60)
+    for packet in (udp, garbage):
+        original = bytes(packet)
+        assert clamp()(packet) is packet
+        assert bytes(packet) == original
+
+
+def test_short_packets_pass_unchanged():
+    stage = clamp()
+    for packet in (bytearray(b'\x45'), tcpPacket(1460)[:30], tcpPacket(1460)[:42]):
+        original = bytes(packet)
+        assert stage(packet) is packet
+        assert bytes(packet) == original
+    assert stage.clamped == 0
+
+
+def test_update_checksum_matches_a_full_recompute():
+    data = bytearray(b'\x12\x34\x56\x78\x9a\xbc')
+    before = checksum(bytes(data))
+    data[2:4] = b'\xff\xff'
+    assert mssClamp.updateChecksum(before, 0x5678, 0xFFFF) == checksum(bytes(data))
@@ -0,0 +1,105 @@
+# Tests for the rtnetlink messages netlink.py builds, byte for byte
+
+import struct
+import sys
+
+import pytest
+
+import netlink
+
+if sys.byteorder != 'little':
+    pytest.skip("the expected messages are written out in little endian host order", allow_module_level=True)
+
+INDEX = 7
+
+
+# Stands in for the rtnetlink socket, keeping what is sent and acknowledging it with error
+class FakeSocket:
+    def __init__(self, error=0):
+        self.error = error
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+    def recv(self, size):
+        request = self.sent[-1]
+        sequence = struct.unpack_from('=I', request, 8)[0]
+        body = struct.pack('=i', self.error) + request[:netlink.NLMSGHDR.size]
+        return netlink.NLMSGHDR.pack(netlink.NLMSGHDR.size + len(body), netlink.NLMSG_ERROR, 0, sequence, 0) + body
+
+
+@pytest.fixture
+def nl(monkeypatch):
+    monkeypatch.setattr(netlink, 'interfaceIndex', lambda name: INDEX)
+    nl = netlink.Netlink.__new__(netlink.Netlink) # no real socket
+    nl.sock = FakeSocket()
+    nl.sequence = 0
+    return nl
+
+
+def test_attributes_are_padded_to_four_bytes():
+    assert netlink.attribute(1, b'\x0a\x01\x02\x03') == bytes.fromhex('08000100 0a010203')
+    assert netlink.attribute(3, b'tun0\0') == bytes.fromhex('09000300 74756e30 00000000')
+    assert netlink.attribute(6, b'') == bytes.fromhex('04000600')
+
+
+def test_address_add_layout(nl):
+    nl.addAddress('tun0', '10.1.2.3/24')
+    assert nl.sock.sent == [bytes.fromhex(
+        '28000000 1400 0505 01000000 00000000'  # nlmsghdr: length 40, RTM_NEWADDR, REQUEST|ACK|REPLACE|CREATE, seq 1
+        '02 18 00 00 07000000'                  # ifaddrmsg: AF_INET, /24, no flags, universe scope, index 7
+        '08000200 0a010203'                     # IFA_LOCAL
+        '08000100 0a010203')]                   # IFA_ADDRESS
+
+
+def test_route_add_through_a_gateway_layout(nl):
+    nl.addRoute('192.0.2.0/24', 'eth0', gateway='10.0.0.1', metric=100)
+    assert nl.sock.sent == [bytes.fromhex(
+        '3c000000 1800 0505 01000000 00000000'  # nlmsghdr: length 60, RTM_NEWROUTE
+        '02 18 00 00 fe 04 00 01 00000000'      # rtmsg: AF_INET, /24, main table, static, universe, unicast
+        '08000100 c0000200'                     # RTA_DST
+        '08000400 07000000'                     # RTA_OIF
+        '08000500 0a000001'                     # RTA_GATEWAY
+        '08000600 64000000')]                   # RTA_PRIORITY
+
+
+def test_link_scope_route_layout(nl):
+    nl.addRoute('0.0.0.0/1', 'tun0')
+    assert nl.sock.sent[0][netlink.NLMSGHDR.size:] == bytes.fromhex(
+        '02 01 00 00 fe 04 fd 01 00000000'      # /1, link scope without a gateway
+        '08000100 00000000'
+        '08000400 07000000')
+
+
+def test_ipv6_route_and_default_route_layouts(nl):
+    nl.addRoute('2001:db8::/32', 'tun0')
+    nl.deleteRoute('0.0.0.0/0', 'tun0', gateway='10.0.0.1')
+    v6, default = nl.sock.sent
+    assert v6[:8] == bytes.fromhex('38000000 1800 0505') # length 56
+    assert v6[netlink.NLMSGHDR.size:] == bytes.fromhex(
+        '0a 20 00 00 fe 04 fd 01 00000000'
+        '14000100 20010db8 00000000 00000000 00000000'
+        '08000400 07000000')
+    assert default == bytes.fromhex(
+        '2c000000 1900 0500 02000000 00000000'  # RTM_DELROUTE, REQUEST|ACK, seq 2
+        '02 00 00 00 fe 04 00 01 00000000'      # a /0 carries no RTA_DST
+        '08000400 07000000'
+        '08000500 0a000001')
+
+
+def test_mtu_and_link_state_layouts(nl):
+    nl.setMTU('tun0', 1400)
+    nl.setLinkUp('tun0')
+    mtu, up = nl.sock.sent
+    assert mtu == bytes.fromhex('28000000 1000 0500 01000000 00000000'
+                                '00 00 0000 07000000 00000000 00000000'
+                                '08000400 78050000')
+    assert up[netlink.NLMSGHDR.size:] == bytes.fromhex('00 00 0000 07000000 01000000 01000000')
+
+
+def test_a_rejected_request_raises_with_the_errno(nl):
+    nl.sock.error = -17 # EEXIST
+    with pytest.raises(netlink.NetlinkError) as error:
+        nl.addRoute('192.0.2.0/24', 'tun0')
+    assert error.value.errno == 17
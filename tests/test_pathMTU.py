@@ -0,0 +1,58 @@
+# Tests for path MTU discovery and handing re-probed MTUs to queue workers
+
+import errno
+import multiprocessing
+
+import framing
+import pathMTU
+from pipeline import Pipeline
+
+
+# A connected UDP socket whose probes are refused by the far end after the first
+class RefusedSocket:
+    def __init__(self, *args):
+        self.sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def connect(self, address):
+        pass
+
+    def getsockopt(self, *args):
+        return 1500 if self.sent == 0 else 1400
+
+    def send(self, data):
+        self.sent += 1
+        if self.sent > 1:
+            raise OSError(errno.ECONNREFUSED, "Connection refused")
+
+
+def test_refused_probe_counts_as_delivered(monkeypatch):
+    monkeypatch.setattr(pathMTU.socket, 'socket', RefusedSocket)
+    assert pathMTU.discoverPathMTU('192.0.2.1', 9001, wait=0) == 1400
+
+
+def test_path_mtu_sizes_the_pipeline():
+    pipeline = Pipeline(('192.0.2.1', 9001))
+    pipeline.framer = framing.Framer('on')
+    assert pathMTU.applyPathMTU(pipeline, 1400) == 1400 - pathMTU.OVERHEAD - 3
+    assert pipeline.mtu == 1369
+    assert pipeline.framer.max_datagram == 1400 - pathMTU.OVERHEAD
+
+
+def test_workers_follow_the_published_path_mtu():
+    shared = multiprocessing.get_context('fork').Value('i', 0, lock=False)
+    pipeline = Pipeline(('192.0.2.1', 9001))
+    follower = pathMTU.PathMTUFollower(pipeline, shared)
+    assert follower.update() is None and pipeline.mtu is None
+
+    shared.value = 1300
+    assert follower.update() == 1300
+    assert pipeline.mtu == 1300 - pathMTU.OVERHEAD
@@ -0,0 +1,96 @@
+# Tests for packet classification and the strict and deficit round robin schedulers
+
+import socket
+import struct
+
+import pytest
+
+import qos
+
+
+# Returns an IPv4 packet of the given size, protocol, ports and DSCP mark
+def ipv4(size=100, protocol=qos.UDP, sport=40000, dport=443, dscp=0):
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, dscp << 2, size, 0, 0x4000, 64, protocol, 0,
+                         socket.inet_aton('10.0.0.2'), socket.inet_aton('198.51.100.7'))
+    return header + struct.pack('!HH', sport, dport) + bytes(size - 24)
+
+
+def test_classify():
+    assert qos.classify(ipv4(dport=22)) == qos.INTERACTIVE
+    assert qos.classify(ipv4(sport=53, dport=40000)) == qos.INTERACTIVE
+    assert qos.classify(ipv4(protocol=qos.ICMP)) == qos.INTERACTIVE
+    assert qos.classify(ipv4(60, qos.TCP)) == qos.INTERACTIVE # a bare ACK
+    assert qos.classify(ipv4(dscp=46)) == qos.INTERACTIVE     # EF
+    assert qos.classify(ipv4(dscp=8)) == qos.BULK             # CS1
+    assert qos.classify(ipv4(1400, qos.TCP)) == qos.BULK
+    assert qos.classify(ipv4(1400, qos.TCP, dscp=46)) == qos.INTERACTIVE
+    assert qos.classify(ipv4(500, qos.TCP)) == qos.DEFAULT
+    assert qos.classify(bytes([0x60]) + bytes(5) + bytes([qos.UDP]) + bytes(33) + struct.pack('!HH', 40000, 53)) == qos.INTERACTIVE
+
+
+def test_strict_drains_high_priority_first():
+    scheduler = qos.PriorityScheduler('strict')
+    bulk = [ipv4(1400, qos.TCP, sport=i) for i in range(3)]
+    default = [ipv4(500, qos.TCP, sport=i) for i in range(3)]
+    interactive = [ipv4(dport=53, sport=i) for i in range(3)]
+    for packet in bulk + default + interactive:
+        scheduler.put(packet)
+    assert scheduler.take(9) == interactive + default + bulk
+
+
+def test_drr_shares_follow_the_quanta():
+    quanta = (3000, 2000, 1000)
+    scheduler = qos.PriorityScheduler('drr', limits=(1000, 1000, 1000), quanta=quanta)
+    packets = {qos.INTERACTIVE: ipv4(1000, dscp=46), qos.DEFAULT: ipv4(1000, dscp=0), qos.BULK: ipv4(1000, dscp=8)}
+    for _ in range(600):
+        for packet in packets.values():
+            scheduler.put(packet)
+    sent = [0, 0, 0]
+    for packet in scheduler.take(600):
+        sent[qos.classify(packet)] += len(packet)
+    total = sum(sent)
+    for kind, quantum in enumerate(quanta):
+        assert sent[kind] / total == pytest.approx(quantum / sum(quanta), abs=0.02)
+
+
+def test_drr_keeps_bulk_moving():
+    scheduler = qos.PriorityScheduler('drr')
+    for _ in range(100):
+        scheduler.put(ipv4(dport=53))
+    scheduler.put(ipv4(1400, qos.TCP))
+    assert any(qos.classify(packet) == qos.BULK for packet in scheduler.take(20))
+
+
+@pytest.mark.parametrize('policy', ['strict', 'drr'])
+@pytest.mark.parametrize('drop', ['tail', 'head'])
+def test_queued_bytes_return_to_zero(policy, drop):
+    scheduler = qos.PriorityScheduler(policy, drop, limits=(4, 4, 4))
+    dropped = 0
+    for size in range(100, 1500, 50):
+        for dscp in (46, 0, 8):
+            dropped += scheduler.put(ipv4(size, dscp=dscp))
+    assert dropped == sum(scheduler.dropped) > 0
+    assert scheduler.queued_bytes == sum(len(p) for queue in scheduler.queues for p in queue)
+    while scheduler.take(5, timeout=0):
+        pass
+    assert scheduler.depth == 0 and scheduler.queued_bytes == 0
+    assert scheduler.depths() == [0, 0, 0]
+
+
+def test_head_drop_keeps_the_newest_packets():
+    scheduler = qos.PriorityScheduler('strict', 'head', limits=(2, 2, 2))
+    packets = [ipv4(dport=53, sport=i) for i in range(4)]
+    for packet in packets:
+        scheduler.put(packet)
+    assert scheduler.take(4) == packets[2:]
+
+
+def test_take_times_out_empty():
+    assert qos.PriorityScheduler().take(4, timeout=0.01) == []
+
+
+def test_unknown_policies_are_rejected():
+    with pytest.raises(ValueError):
+        qos.PriorityScheduler('fifo')
+    with pytest.raises(ValueError):
+        qos.PriorityScheduler(drop='random')
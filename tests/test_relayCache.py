@@ -0,0 +1,73 @@
+# Tests for the relay cache's RTT averages, expiry and pruning
+
+import pytest
+
+import relayCache
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return relayCache.RelayCache(str(tmp_path / 'cache.json'), ttl=60, max_entries=3, expiry=600, clock=clock)
+
+
+def test_rtt_is_an_exponentially_weighted_average(cache):
+    cache.record('192.0.2.1', 443, [0.100])
+    assert cache.rtt('192.0.2.1', 443) == pytest.approx(0.100)
+    cache.record('192.0.2.1', 443, [0.200])
+    assert cache.rtt('192.0.2.1', 443) == pytest.approx(relayCache.ALPHA * 0.200 + (1 - relayCache.ALPHA) * 0.100)
+
+
+def test_a_failed_last_probe_hides_the_rtt_until_one_succeeds(cache):
+    cache.record('192.0.2.1', 443, [0.100, None])
+    assert cache.rtt('192.0.2.1', 443) is None
+    assert cache.entries['192.0.2.1:443']['failures'] == 1
+    cache.record('192.0.2.1', 443, [0.100])
+    assert cache.rtt('192.0.2.1', 443) == pytest.approx(0.100)
+
+
+def test_entries_go_stale_after_the_ttl(cache, clock):
+    assert cache.isStale('192.0.2.1', 443)
+    cache.record('192.0.2.1', 443, [0.050])
+    clock.now += 59
+    assert not cache.isStale('192.0.2.1', 443)
+    assert cache.rtt('192.0.2.1', 443) == pytest.approx(0.050)
+    clock.now += 2
+    assert cache.isStale('192.0.2.1', 443)
+    assert cache.rtt('192.0.2.1', 443) is None
+
+
+def test_prune_drops_expired_then_least_recently_updated_entries(cache, clock):
+    cache.record('192.0.2.1', 443, [0.01])
+    clock.now += 601
+    for i in range(2, 6):
+        cache.record(f'192.0.2.{i}', 443, [0.01])
+        clock.now += 1
+    with cache.lock:
+        cache.prune()
+    assert sorted(cache.entries) == ['192.0.2.3:443', '192.0.2.4:443', '192.0.2.5:443']
+
+
+def test_save_and_load_round_trip(cache, clock, tmp_path):
+    cache.record('192.0.2.1', 443, [0.02])
+    cache.save()
+    loaded = relayCache.RelayCache(cache.path, ttl=60, clock=clock).load()
+    assert loaded.rtt('192.0.2.1', 443) == pytest.approx(0.02)
+
+
+def test_an_unreadable_file_starts_an_empty_cache(tmp_path):
+    path = tmp_path / 'cache.json'
+    path.write_text('not json')
+    assert relayCache.RelayCache(str(path)).load().entries == {}
@@ -0,0 +1,33 @@
+# Tests for the relay index and the relays balanced across from it
+
+import bridges
+import flowBalancer
+import relayCache
+import relayIndex
+
+CSV = """IP Address,Country,ORPort,Bandwidth (MiB/s),Flags,Nickname
+10.0.0.1,xx,443,1.00,"Fast, Running",low
+10.0.0.1,xx,9001,4.00,"Fast, Running",high
+10.0.0.2,xx,443,2.00,"Running",other
+"""
+
+
+def loadIndex(tmp_path):
+    path = tmp_path / 'relays.csv'
+    path.write_text(CSV)
+    return relayIndex.loadInMemory(str(path))
+
+
+def test_relays_sharing_an_ip_are_found_by_port(tmp_path):
+    index = loadIndex(tmp_path)
+    assert index.find('xx', '10.0.0.1', 443).nickname == 'low'
+    assert index.find('xx', '10.0.0.1', '9001').nickname == 'high'
+    assert index.find('xx', '10.0.0.1', 80) is None
+    assert index.port('xx', '10.0.0.1') == '443' # the first listed without a port
+
+
+def test_balancer_weighs_the_primary_by_its_own_port(tmp_path, monkeypatch):
+    monkeypatch.setattr(bridges, 'country_relays', loadIndex(tmp_path))
+    monkeypatch.setattr(relayCache, 'cache', relayCache.RelayCache(str(tmp_path / 'cache.json')))
+    selected = dict(flowBalancer.selectRelays('xx', 2, ('10.0.0.1', 9001)))
+    assert selected == {('10.0.0.1', 9001): 4.0, ('10.0.0.2', 443): 2.0}
@@ -0,0 +1,105 @@
+# Tests for relay failover, alone and under a flow balancer
+
+import pytest
+
+import bridges
+import flowBalancer
+import relayCache
+import relayIndex
+import relayMonitor
+import relayWatcher
+from pipeline import Pipeline
+
+CSV = """IP Address,Country,ORPort,Bandwidth (MiB/s),Flags,Nickname
+10.0.0.1,xx,443,4.00,"Fast, Running, Stable",primary
+10.0.0.2,xx,443,2.00,"Fast, Running, Stable",balanced
+10.0.0.3,xx,443,1.00,"Fast, Running, Stable",standby
+"""
+
+
+@pytest.fixture
+def relays(tmp_path, monkeypatch):
+    path = tmp_path / 'relays.csv'
+    path.write_text(CSV)
+    monkeypatch.setattr(bridges, 'country_relays', relayIndex.loadInMemory(str(path)))
+    monkeypatch.setattr(relayCache, 'cache', relayCache.RelayCache(str(tmp_path / 'cache.json')))
+
+
+# Answers probes of the dead relay with failures and of everything else with rtt
+def deadRelay(monkeypatch, dead, rtt=0.01):
+    monkeypatch.setattr(relayMonitor.relayProber, 'probeRelays',
+                        lambda targets, timeout: {t: [None if t == dead else rtt] for t in targets})
+
+
+def test_failover_swaps_the_standby_into_the_balancer(relays, monkeypatch):
+    primary = ('10.0.0.1', 443)
+    balancer = flowBalancer.FlowBalancer(flowBalancer.selectRelays('xx', 2, primary))
+    pipeline = Pipeline(primary)
+    pipeline.router = balancer.route
+    monitor = relayMonitor.RelayMonitor(pipeline, 'xx', balancer=balancer)
+    with monitor.lock:
+        monitor.refillStandbys()
+    assert monitor.standbys == [('10.0.0.3', 443)] # the balanced relay is no standby
+
+    deadRelay(monkeypatch, primary)
+    for _ in range(relayMonitor.FAILURES):
+        monitor.check(0.0)
+
+    assert pipeline.destination == ('10.0.0.3', 443)
+    assert set(balancer.table) == {('10.0.0.2', 443), ('10.0.0.3', 443)}
+    assert monitor.failovers == 1 and monitor.last_failover > 0
+
+
+def test_failover_history_is_bounded(relays, monkeypatch):
+    monitor = relayMonitor.RelayMonitor(Pipeline(('10.0.0.1', 443)), 'xx')
+    for _ in range(relayMonitor.HISTORY + 10):
+        monitor.standbys = [('10.0.0.3', 443)]
+        monitor.pipeline.destination = ('10.0.0.1', 443)
+        monitor.failover(0.0)
+    assert len(monitor.failover_times) == relayMonitor.HISTORY
+
+
+def test_reload_during_probe_leaves_standbys_alone(relays, monkeypatch):
+    primary = ('10.0.0.1', 443)
+    monitor = relayMonitor.RelayMonitor(Pipeline(primary), 'xx')
+    monitor.standbys = [('10.0.0.2', 443)]
+
+    def probe(targets, timeout):
+        monitor.onRelaysChanged(None, relayWatcher.RelayDiff(removed={('xx', '10.0.0.2', 443)}))
+        return {t: [None] for t in targets}
+
+    monkeypatch.setattr(relayMonitor.relayProber, 'probeRelays', probe)
+    monitor.check(0.0)
+    assert ('10.0.0.2', 443) not in monitor.standbys
+    assert monitor.standbys == [('10.0.0.3', 443)]
+
+
+
+def test_dead_balanced_relay_is_swapped_for_the_standby(relays, monkeypatch):
+    primary, balanced = ('10.0.0.1', 443), ('10.0.0.2', 443)
+    balancer = flowBalancer.FlowBalancer(flowBalancer.selectRelays('xx', 2, primary))
+    monitor = relayMonitor.RelayMonitor(Pipeline(primary), 'xx', balancer=balancer)
+    with monitor.lock:
+        monitor.refillStandbys()
+
+    deadRelay(monkeypatch, balanced) # only the balanced relay stops answering
+    for _ in range(relayMonitor.FAILURES):
+        monitor.check(0.0)
+
+    assert monitor.pipeline.destination == primary
+    assert set(balancer.table) == {primary, ('10.0.0.3', 443)}
+    assert monitor.evictions == 1 and monitor.failovers == 0
+
+
+def test_dead_balanced_relay_is_dropped_without_a_standby(relays, monkeypatch):
+    primary, balanced = ('10.0.0.1', 443), ('10.0.0.2', 443)
+    balancer = flowBalancer.FlowBalancer([(primary, 1.0), (balanced, 1.0)])
+    monitor = relayMonitor.RelayMonitor(Pipeline(primary), 'xx', balancer=balancer)
+    monkeypatch.setattr(monitor, 'refillStandbys', lambda exclude=(): None) # no standbys to be had
+
+    deadRelay(monkeypatch, balanced)
+    for _ in range(relayMonitor.FAILURES):
+        monitor.check(0.0)
+
+    assert set(balancer.table) == {primary}
+    assert monitor.evictions == 1
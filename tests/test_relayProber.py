@@ -0,0 +1,25 @@
+# Tests for timed TCP connect probes
+
+import socket
+import warnings
+
+import relayProber
+
+
+def test_probes_measure_open_ports_and_fail_closed_ones():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0)) # bound but not listening, so connects are refused
+    open_relay = listener.getsockname()
+    closed_relay = closed.getsockname()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', ResourceWarning)
+            results = relayProber.probeRelays([open_relay, closed_relay], samples=2)
+    finally:
+        listener.close()
+        closed.close()
+    assert relayProber.summarize(results[open_relay]) is not None
+    assert results[closed_relay] == [None, None]
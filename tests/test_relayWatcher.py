@@ -0,0 +1,59 @@
+# Tests for picking up relay csv changes while the tunnel runs
+
+import os
+
+import relayIndex
+import relayWatcher
+
+HEADER = "IP Address,Country,ORPort,Bandwidth (MiB/s),Flags,Nickname\n"
+FIRST = "10.0.0.1,xx,443,1.00,\"Fast, Running\",first\n"
+SECOND = "10.0.0.2,xx,443,2.00,\"Running\",second\n"
+THIRD = "10.0.0.3,yy,9001,3.00,\"Running\",third\n"
+
+
+def write(path, *rows, mtime=None):
+    path.write_text(HEADER + ''.join(rows))
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+
+def watch(tmp_path):
+    csv = tmp_path / 'relays.csv'
+    write(csv, FIRST)
+    reloads = []
+    watcher = relayWatcher.RelayWatcher(str(csv), lambda index, diff: reloads.append((index, diff)), interval=60)
+    return csv, watcher, reloads
+
+
+def test_edit_between_seed_and_load_is_picked_up(tmp_path):
+    csv, watcher, reloads = watch(tmp_path)
+    watcher.seed()
+    write(csv, FIRST, SECOND, mtime=os.stat(csv).st_mtime_ns + 10**9) # lands while the list loads
+    diff = watcher.reload()
+    assert diff.added == {('xx', '10.0.0.2', 443)} and not diff.removed
+    index, _ = reloads[0]
+    assert [relay.ip for relay in index.relays('xx')] == ['10.0.0.1', '10.0.0.2']
+    assert watcher.reload() is None
+
+
+def test_csv_dropped_into_the_directory_adds_its_relays(tmp_path):
+    csv, watcher, reloads = watch(tmp_path)
+    watcher.seed()
+    write(tmp_path / 'extra.csv', THIRD)
+    diff = watcher.reload()
+    assert diff.added == {('yy', '10.0.0.3', 9001)}
+    index, _ = reloads[0]
+    assert 'yy' in index and 'xx' in index
+    assert not os.path.exists(relayIndex.indexPath(str(csv))) # the index on disk stays the csv's own
+
+    os.remove(tmp_path / 'extra.csv')
+    diff = watcher.reload()
+    assert diff.removed == {('yy', '10.0.0.3', 9001)}
+    assert 'yy' not in reloads[1][0]
+
+
+def test_unchanged_csv_is_not_reloaded(tmp_path):
+    csv, watcher, reloads = watch(tmp_path)
+    watcher.seed()
+    assert watcher.reload() is None
+    assert reloads == []
@@ -0,0 +1,54 @@
+# Tests for the split tunnel's decisions and the routes it installs
+
+import ipaddress
+
+import splitTunnel
+
+
+def networks(routes):
+    return [str(network) for network in routes]
+
+
+# Returns a minimal IPv4 or IPv6 header addressed to dst
+def packetTo(dst):
+    address = ipaddress.ip_address(dst)
+    if address.version == 4:
+        return bytes([0x45]) + bytes(15) + address.packed
+    return bytes([0x60]) + bytes(23) + address.packed
+
+
+def test_exclude_only_tunnels_ipv4_and_leaves_ipv6_alone():
+    split = splitTunnel.SplitTunnel(exclude=['10.0.0.0/8'])
+    assert networks(split.routes(4))[0] == '0.0.0.0/5'
+    assert '10.0.0.0/8' not in networks(split.routes(4))
+    assert split.routes(6) == []
+    assert split.forwards(packetTo('8.8.8.8'))
+    assert not split.forwards(packetTo('10.1.2.3'))
+    assert not split.forwards(packetTo('2001:db8::1'))
+
+
+def test_no_lists_route_ipv4_in_halves():
+    split = splitTunnel.SplitTunnel()
+    assert networks(split.routes(4)) == ['0.0.0.0/1', '128.0.0.0/1']
+    assert split.routes(6) == []
+
+
+def test_ipv6_is_tunneled_when_the_relay_carries_it():
+    split = splitTunnel.SplitTunnel(exclude=['10.0.0.0/8'], ipv6=True)
+    assert networks(split.routes(6)) == ['::/1', '8000::/1']
+    assert split.forwards(packetTo('2001:db8::1'))
+
+
+def test_include_lists_decide_each_version():
+    split = splitTunnel.SplitTunnel(include=['192.0.2.0/24', '2001:db8::/32'])
+    assert networks(split.routes(4)) == ['192.0.2.0/24']
+    assert networks(split.routes(6)) == ['2001:db8::/32']
+    assert not split.forwards(packetTo('8.8.8.8'))
+    assert split.forwards(packetTo('2001:db8::1'))
+
+
+def test_bypass_and_longest_prefix_win():
+    split = splitTunnel.SplitTunnel(include=['10.0.0.0/8'], exclude=['10.1.0.0/16'], bypass=['10.1.2.3/32'])
+    assert split.forwards(packetTo('10.2.0.1'))
+    assert not split.forwards(packetTo('10.1.0.1'))
+    assert not split.forwards(packetTo('10.1.2.3'))
@@ -0,0 +1,140 @@
+# Tests for tunLinux's multi-queue worker layout and what it loads
+
+import ipaddress
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+if not sys.platform.startswith('linux'):
+    pytest.skip("tunLinux runs on Linux only", allow_module_level=True)
+
+import metrics
+import tunLinux
+from pipeline import Pipeline
+
+
+def test_worker_sockets_have_ports_of_their_own():
+    socks = [tunLinux.createWorkerSocket() for _ in range(4)]
+    try:
+        ports = {sock.getsockname()[1] for sock in socks}
+        assert len(ports) == len(socks)
+        for sock in socks:
+            assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT) == 0
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def test_replies_reach_the_worker_that_sent():
+    socks = [tunLinux.createWorkerSocket() for _ in range(3)]
+    relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay.bind(('127.0.0.1', 0))
+    relay.settimeout(1)
+    try:
+        for i, sock in enumerate(socks):
+            sock.sendto(bytes([i]), relay.getsockname())
+        for _ in socks:
+            data, address = relay.recvfrom(16)
+            relay.sendto(data, ('127.0.0.1', address[1]))
+        for i, sock in enumerate(socks):
+            assert sock.recv(16) == bytes([i])
+    finally:
+        relay.close()
+        for sock in socks:
+            sock.close()
+
+
+def test_optional_stages_load_only_when_enabled():
+    code = "import sys, tunLinux; print(sorted({'dnsCache', 'qos', 'splitTunnel', 'tunnelCrypto', 'headless'} & set(sys.modules)))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == '[]'
+
+
+class OneShotScheduler:
+    def __init__(self, packets, stop_event):
+        self.packets = list(packets)
+        self.stop_event = stop_event
+        self.depth = 0
+        self.paced = []
+
+    def take(self, limit=1, timeout=1):
+        taken, self.packets = self.packets[:limit], self.packets[limit:]
+        if not self.packets:
+            self.stop_event.set()
+        return taken
+
+    def pace(self, size):
+        self.paced.append(size)
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_queued_paths_count_and_pace_the_same_bytes(batched):
+    pytest.importorskip('cryptography')
+    import tunnelCrypto
+    relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay.bind(('127.0.0.1', 0))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        stop_event = threading.Event()
+        packets = [bytes(100), bytes(300)]
+        pipeline = Pipeline(relay.getsockname())
+        pipeline.cipher = tunnelCrypto.SessionCipher(bytes(32))
+        pipeline.scheduler = OneShotScheduler(packets, stop_event)
+        stats = metrics.counters('outbound')
+        before = stats.bytes
+        tunLinux.sendQueued(sock, stop_event, pipeline, batch_size=len(packets), batched=batched)
+        assert stats.bytes - before == 400
+        assert sum(pipeline.scheduler.paced) == 400
+    finally:
+        sock.close()
+        relay.close()
+
+
+def test_default_gateway_prefers_the_lowest_metric(tmp_path):
+    routes = tmp_path / 'route'
+    routes.write_text(
+        "Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\tMask\tMTU\tWindow\tIRTT\n"
+        "wlan0\t00000000\t0101A8C0\t0003\t0\t0\t600\t00000000\t0\t0\t0\n"
+        "eth0\t00000000\t0100000A\t0003\t0\t0\t100\t00000000\t0\t0\t0\n"
+        "PhaethonVPN\t00000000\t00000000\t0001\t0\t0\t0\t00000080\t0\t0\t0\n")
+    assert tunLinux.defaultGateway(str(routes)) == ('eth0', '10.0.0.1')
+
+
+def test_standby_stays_bypassed_after_failover(monkeypatch, tmp_path):
+    import bridges
+    import relayCache
+    import relayIndex
+    import relayMonitor
+    import splitTunnel
+
+    path = tmp_path / 'relays.csv'
+    path.write_text("IP Address,Country,ORPort,Bandwidth (MiB/s),Flags,Nickname\n"
+                    "10.0.0.1,xx,443,4.00,\"Fast, Running, Stable\",primary\n"
+                    "10.0.0.3,xx,443,1.00,\"Fast, Running, Stable\",standby\n")
+    monkeypatch.setattr(bridges, 'country_relays', relayIndex.loadInMemory(str(path)))
+    monkeypatch.setattr(relayCache, 'cache', relayCache.RelayCache(str(tmp_path / 'cache.json')))
+    routed = []
+    monkeypatch.setattr(tunLinux, 'addBypassRoute', routed.append)
+
+    primary = ('10.0.0.1', 443)
+    monitor = relayMonitor.RelayMonitor(Pipeline(primary), 'xx')
+    split = splitTunnel.SplitTunnel(exclude=['192.168.0.0/16'], bypass=['10.0.0.1/32'])
+    monitor.listeners.append(tunLinux.RelayBypass(split, [primary]))
+    with monitor.lock:
+        monitor.refillStandbys()
+    assert routed == ['10.0.0.3/32']
+
+    monkeypatch.setattr(relayMonitor.relayProber, 'probeRelays',
+                        lambda targets, timeout: {t: [None if t == primary else 0.01] for t in targets})
+    for _ in range(relayMonitor.FAILURES):
+        monitor.check(0.0)
+
+    assert monitor.pipeline.destination == ('10.0.0.3', 443)
+    assert not split.forwards(bytes([0x45]) + bytes(15) + bytes([10, 0, 0, 3]))
+    assert all(not network.overlaps(ipaddress.ip_network('10.0.0.3/32')) for network in split.routes(4))
+    assert routed == ['10.0.0.3/32']
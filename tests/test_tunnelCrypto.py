@@ -0,0 +1,168 @@
+import os
+import socket
+import time
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import batchIO
+import concentrator
+import tunnelCrypto
+
+PSK = bytes(range(32))
+
+
+def pair(cipher='aes-gcm'):
+    initiator = tunnelCrypto.SessionCipher(PSK, cipher=cipher)
+    responder = tunnelCrypto.SessionCipher(PSK, initiator.session, initiator=False, cipher=cipher)
+    return initiator, responder
+
+
+@pytest.mark.parametrize('cipher', tunnelCrypto.CIPHERS)
+def test_roundtrip_both_ways(cipher):
+    initiator, responder = pair(cipher)
+    sealed = bytes(initiator.seal(b'hello'))
+    assert len(sealed) == 5 + tunnelCrypto.OVERHEAD
+    assert bytes(responder.open(sealed)) == b'hello'
+    assert bytes(initiator.open(bytes(responder.seal(b'world')))) == b'world'
+
+
+def test_replay_is_rejected():
+    initiator, responder = pair()
+    sealed = bytes(initiator.seal(b'x'))
+    assert responder.open(sealed) is not None
+    assert responder.open(sealed) is None
+    assert responder.replayed == 1
+
+
+def test_window_accepts_out_of_order_and_rejects_too_old():
+    initiator, responder = pair()
+    sealed = [bytes(initiator.seal(b'x')) for _ in range(tunnelCrypto.WINDOW + 2)]
+    assert responder.open(sealed[1]) is not None
+    assert responder.open(sealed[0]) is not None # behind the highest but inside the window
+    assert responder.open(sealed[-1]) is not None
+    assert responder.open(sealed[2]) is not None
+    assert responder.open(sealed[1]) is None     # now outside the window
+    assert responder.replayed == 1
+
+
+def test_tampered_and_unsealed_datagrams_are_rejected():
+    initiator, responder = pair()
+    sealed = bytearray(initiator.seal(b'payload'))
+    sealed[-1] ^= 1
+    assert responder.open(bytes(sealed)) is None
+    assert responder.open(b'\x45' + bytes(60)) is None
+    assert responder.rejected == 2
+
+
+def test_sessions_sharing_a_key_never_share_keystream():
+    first = tunnelCrypto.SessionCipher(PSK)
+    second = tunnelCrypto.SessionCipher(PSK)
+    assert len(first.session) == tunnelCrypto.SESSION_ID == 16
+    assert first.session != second.session
+    # Both start counting from 0, so only the session id keeps their nonces apart
+    payload = bytes(64)
+    one = bytes(first.seal(payload))[tunnelCrypto.HEADER.size:]
+    two = bytes(second.seal(payload))[tunnelCrypto.HEADER.size:]
+    assert one != two
+
+
+def test_split_ciphers_seal_under_their_own_sessions():
+    ciphers = tunnelCrypto.SessionCipher(PSK).split(3)
+    assert len({cipher.session for cipher in ciphers}) == 3
+    sealed = bytes(ciphers[1].seal(b'hi'))
+    responder = tunnelCrypto.SessionCipher(PSK, tunnelCrypto.sessionOf(sealed), initiator=False)
+    assert bytes(responder.open(sealed)) == b'hi'
+    # Replies to one worker's session open in any of them
+    assert bytes(ciphers[0].open(bytes(responder.seal(b'back')))) == b'back'
+
+
+def ipv4(source, destination, size=40):
+    header = bytearray(20)
+    header[0] = 0x45
+    header[2:4] = size.to_bytes(2, 'big')
+    header[8] = 64
+    header[9] = 17
+    header[12:16] = socket.inet_aton(source)
+    header[16:20] = socket.inet_aton(destination)
+    return bytes(header) + bytes(size - 20)
+
+
+@pytest.fixture
+def running():
+    kernel, tun = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(0.2)
+    table = concentrator.SessionTable('10.201.0.0/16')
+    hub = concentrator.Concentrator(tun.fileno(), server, table, PSK).start()
+    kernel.settimeout(1)
+    clients = []
+
+    def client():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(1)
+        clients.append(sock)
+        return sock
+
+    yield hub, server.getsockname(), kernel, client
+    hub.stop()
+    for sock in clients + [server, kernel, tun]:
+        sock.close()
+
+
+def settle(hub, count):
+    deadline = time.monotonic() + 2
+    while hub.rejected + sum(s.packets_in for s in hub.table.by_address.values()) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_concentrator_replay_from_another_address_opens_no_session(running):
+    hub, address, kernel, client = running
+    cipher = tunnelCrypto.SessionCipher(PSK)
+    sealed = bytes(cipher.seal(ipv4('10.0.100.1', '10.201.0.1')))
+    client().sendto(sealed, address)
+    assert kernel.recv(2000)[12:16] == socket.inet_aton('10.201.0.2')
+
+    attacker = client()
+    attacker.sendto(sealed, address) # the captured datagram from a new port
+    attacker.sendto(sealed, address)
+    settle(hub, 3)
+    assert hub.rejected == 2
+    assert len(hub.table) == 1
+
+
+def test_concentrator_forged_datagrams_open_no_session(running):
+    hub, address, kernel, client = running
+    sock = client()
+    for _ in range(20):
+        sock.sendto(bytes([tunnelCrypto.MAGIC]) + os.urandom(80), address)
+    settle(hub, 20)
+    assert hub.rejected == 20
+    assert len(hub.table) == 0
+
+
+def test_concentrator_budgets_key_derivations():
+    hub = concentrator.Concentrator(None, None, None, PSK)
+    now = hub.budget_time
+    derived = [hub.deriveCipher(os.urandom(tunnelCrypto.SESSION_ID), now) for _ in range(concentrator.KEY_DERIVATIONS + 10)]
+    assert sum(cipher is not None for cipher in derived) == concentrator.KEY_DERIVATIONS
+    assert hub.deriveCipher(os.urandom(tunnelCrypto.SESSION_ID), now + 0.1) is not None
+
+
+def test_seal_batch_skips_a_datagram_too_large_to_seal():
+    initiator, responder = pair()
+    batch = batchIO.PacketBatch(3)
+    out = batchIO.PacketBatch(3)
+    packets = [b'first', bytes(batchIO.BUFFER_SIZE - tunnelCrypto.OVERHEAD + 1), b'last']
+    for i, packet in enumerate(packets):
+        assert batch.store(i, packet)
+        batch.setTarget(i, ('192.0.2.1', 1000 + i))
+    batch.count = len(packets)
+
+    assert initiator.sealBatch(batch, out) == 2
+    assert out.count == 2 and initiator.oversized == 1
+    assert [bytes(responder.open(bytes(out.packet(i)))) for i in range(out.count)] == [b'first', b'last']
+    assert out.targets[:2] == [('192.0.2.1', 1000), ('192.0.2.1', 1002)]
@@ -8,93 +8,803 @@
 # --------------------------------- s3B-a --------------------------------- #
 
 import adapterscan
+import batchIO
 import bridges
+import bufferPool
+import capture
 import fcntl
-from multiprocessing import Event
+import framing
+import metrics
+import mssClamp
+import netlink
 import os
+import pathMTU
+from pipeline import Pipeline
+import relayWatcher
+import select
 import socket
 import struct
-import subprocess
 import threading
+import time
 
 TUNSETIFF = 0x400454ca # ioctl to set TUN/TAP interface flags
 IFF_TUN   = 0x0001 # TUN device
 IFF_NO_PI = 0x1000 # Do not provide packet information in the I/O operations
+IFF_MULTI_QUEUE = 0x0100 # Allow the device to be opened once per queue
 
 # Creates a TUN device on a Linux system and returns the file descriptor
-def create_tun(name=''):
+def create_tun(name='', multi_queue=False):
+    flags = IFF_TUN | IFF_NO_PI
+    if multi_queue:
+        flags |= IFF_MULTI_QUEUE
     tun = os.open('/dev/net/tun', os.O_RDWR)
-    ifr = struct.pack('16sH', name.encode(), IFF_TUN | IFF_NO_PI)
+    ifr = struct.pack('16sH', name.encode(), flags)
     fcntl.ioctl(tun, TUNSETIFF, ifr)
     return tun
 
-# Configures the TUN device with the given specifications
-def configure_tun(name, ip):
-    subprocess.run(['ip', 'addr', 'add', ip, 'dev', name])
-    subprocess.run(['ip', 'link', 'set', name, 'up'])
+# Opens count queues of a multi-queue TUN device and returns their file descriptors
+# The kernel hashes flows across the queues, so each one can be served by its own process
+def create_tun_queues(name, count):
+    queues = []
+    try:
+        for _ in range(count):
+            queues.append(create_tun(name, multi_queue=True))
+    except OSError:
+        for queue in queues:
+            os.close(queue)
+        raise
+    return queues
+
+# Configures the TUN device with the given specifications over rtnetlink
+# Raises netlink.NetlinkError if the kernel rejects any step
+def configure_tun(name, ip, mtu=None):
+    with netlink.Netlink() as nl:
+        nl.addAddress(name, ip)
+        if mtu:
+            nl.setMTU(name, mtu)
+        nl.setLinkUp(name)
+
+# Routes the tunneled destinations of a split tunnel through the TUN device, returns how many
+# If the kernel refuses a route (e.g. with IPv6 switched off) the rest of that IP version is skipped
+def installSplitRoutes(name, split):
+    count = 0
+    with netlink.Netlink() as nl:
+        for version in (4, 6):
+            for network in split.routes(version):
+                try:
+                    nl.addRoute(str(network), name)
+                except netlink.NetlinkError as e:
+                    print(f"Skipping IPv{version} split tunnel routes: {e}")
+                    break
+                count += 1
+    return count
+
+# Returns the interface and gateway of the IPv4 default route with the lowest metric, the
+# gateway None on a point to point link, or None without a default route
+def defaultGateway(path='/proc/net/route'):
+    best = None
+    with open(path) as f:
+        next(f) # column names
+        for line in f:
+            fields = line.split()
+            if fields[1] != '00000000' or fields[7] != '00000000': # destination and mask
+                continue
+            metric = int(fields[6])
+            if best is None or metric < best[0]:
+                gateway = socket.inet_ntoa(struct.pack('<I', int(fields[2], 16)))
+                best = (metric, fields[0], None if gateway == '0.0.0.0' else gateway)
+    return best[1:] if best else None
+
+# Keeps every relay a relayMonitor.RelayMonitor may switch to outside a split tunnel,
+# told of them through the monitor's listeners before any becomes the active relay
+# Each new relay bypasses the split tunnel's trie and gets a /32 route through the
+# default gateway, so the split routes through the TUN device can't loop its datagrams
+class RelayBypass:
+    def __init__(self, split, relays=()):
+        self.split = split
+        self.bypassed = {ip for ip, _ in relays} # already bypassed when the split tunnel was built
+
+    def __call__(self, relays):
+        for ip, _ in relays:
+            if ip in self.bypassed:
+                continue
+            self.bypassed.add(ip)
+            self.split.addBypass(f"{ip}/32")
+            try:
+                addBypassRoute(f"{ip}/32")
+            except OSError as e:
+                print(f"Could not route relay {ip} around the tunnel: {e}")
+
+# Routes a destination through the default gateway instead of any split tunnel route
+def addBypassRoute(destination):
+    route = defaultGateway()
+    if route is None:
+        raise OSError("no default route")
+    name, gateway = route
+    with netlink.Netlink() as nl:
+        nl.addRoute(destination, name, gateway)
 
 # Reads packets from the TUN session
-def readPackets(tun, sock, server_ip, server_port, stop_event):
+# Packets are read in place into a pooled buffer, so no per-packet bytes are allocated
+# The destination is read from the pipeline on every send so a failover takes effect at once
+def readPackets(tun, sock, server_ip, server_port, stop_event, pool=None, pipeline=None):
+    pipeline = pipeline or Pipeline((server_ip, server_port))
+    pool = pool or bufferPool.get_pool()
+    buffer = pool.acquire()
+    view = buffer.view
+    stats = metrics.counters('outbound')
+    clock = time.perf_counter_ns
+
+    try:
+        while not stop_event.is_set():
+            try:
+                start = clock()
+                n = os.readv(tun, [view])
+                stats.recv.observe(clock() - start)
+                packet = view[:n]
+                if pipeline.outbound:
+                    packet = pipeline.processOutbound(packet)
+                    if packet is None:
+                        stats.drops += 1
+                        continue
+                sendPacket(sock, packet, pipeline, stats)
+            except Exception as e:
+                stats.errors += 1
+                if not stop_event.is_set():
+                    print(f"Error reading from TUN device: {e}")
+                else:
+                    print("Stopping read thread due to stop event.")
+    finally:
+        pool.release(buffer)
+
+# Sends one outbound packet to the server, sealing it when the pipeline has a cipher
+# Returns the bytes counted for it, the packet's own length as sendBatch counts them,
+# so what is counted and paced doesn't depend on sealing or batching
+def sendPacket(sock, packet, pipeline, stats):
+    if pipeline.capture is not None:
+        pipeline.capture.record(packet, capture.OUTBOUND)
+    size = len(packet)
+    destination = pipeline.route(packet)
+    if pipeline.cipher is not None:
+        packet = pipeline.cipher.seal(packet)
+    start = time.perf_counter_ns()
+    sock.sendto(packet, destination)
+    stats.send.observe(time.perf_counter_ns() - start)
+    stats.packets += 1
+    stats.bytes += size
+    return size
+
+# Runs a packet from the server through the inbound stages and writes it to the TUN device
+def writeInbound(tun, packet, pipeline=None, stats=None):
+    if pipeline is not None and pipeline.inbound:
+        packet = pipeline.processInbound(packet)
+        if packet is None:
+            if stats is not None:
+                stats.drops += 1
+            return
+    if pipeline is not None and pipeline.capture is not None:
+        pipeline.capture.record(packet, capture.INBOUND)
+    if stats is None:
+        os.write(tun, packet)
+        return
+    start = time.perf_counter_ns()
+    os.write(tun, packet)
+    stats.send.observe(time.perf_counter_ns() - start)
+    stats.packets += 1
+    stats.bytes += len(packet)
+
+# Writes a datagram from the server to the TUN device, opening it first when the
+# pipeline has a cipher and splitting framed datagrams back into the packets they carry
+def inject(tun, datagram, pipeline=None, stats=None):
+    if pipeline is not None and pipeline.cipher is not None:
+        datagram = pipeline.cipher.open(datagram)
+        if datagram is None: # forged, replayed or not sealed at all
+            if stats is not None:
+                stats.drops += 1
+            return
+    if not framing.isFramed(datagram):
+        writeInbound(tun, datagram, pipeline, stats)
+        return
+    if pipeline is not None and pipeline.framer is not None:
+        pipeline.framer.observe()
+    for packet in framing.unpack(datagram):
+        writeInbound(tun, packet, pipeline, stats)
+
+# Reads packets from the TUN session into the pipeline's scheduler instead of sending them
+# The read side never waits on the socket, a full class queue drops by the scheduler's policy
+def readPacketsQueued(tun, stop_event, pipeline, pool=None):
+    scheduler = pipeline.scheduler
+    pool = pool or bufferPool.get_pool()
+    buffer = pool.acquire()
+    view = buffer.view
+    stats = metrics.counters('outbound')
+    clock = time.perf_counter_ns
+
+    try:
+        while not stop_event.is_set():
+            try:
+                start = clock()
+                n = os.readv(tun, [view])
+                stats.recv.observe(clock() - start)
+                packet = view[:n]
+                if pipeline.outbound:
+                    packet = pipeline.processOutbound(packet)
+                    if packet is None:
+                        stats.drops += 1
+                        continue
+                stats.drops += scheduler.put(packet)
+            except Exception as e:
+                stats.errors += 1
+                if not stop_event.is_set():
+                    print(f"Error reading from TUN device: {e}")
+                else:
+                    print("Stopping read thread due to stop event.")
+    finally:
+        pool.release(buffer)
+
+# Sends the packets queued in the pipeline's scheduler to the server in scheduling order
+# With batched set up to batch_size packets go out per sendmmsg, otherwise one per sendto
+def sendQueued(sock, stop_event, pipeline, batch_size=batchIO.BATCH_SIZE, batched=False):
+    scheduler = pipeline.scheduler
+    batch = batchIO.PacketBatch(batch_size) if batched else None
+    framed = batchIO.PacketBatch(batch_size) if batched and pipeline.framer else None
+    sealed = batchIO.PacketBatch(batch_size) if batched and pipeline.cipher else None
+    stats = metrics.counters('outbound')
+
+    while not stop_event.is_set():
+        packets = scheduler.take(batch_size if batched else 1)
+        if not packets:
+            continue
+        stats.queue_depth = scheduler.depth
+        try:
+            if batch is not None:
+                kept = 0
+                for packet in packets:
+                    if batch.store(kept, packet):
+                        kept += 1
+                    else:
+                        stats.drops += 1
+                batch.count = kept
+                size = sendBatch(sock, batch, framed, pipeline, stats, sealed)
+            else:
+                size = sendPacket(sock, packets[0], pipeline, stats)
+            scheduler.pace(size)
+        except Exception as e:
+            stats.errors += 1
+            if not stop_event.is_set():
+                print(f"Error sending to server: {e}")
+        finally:
+            if batch is not None:
+                batch.clear()
+
+# Receives packets from the server and injects them into the TUN device
+# Datagrams are received in place into a pooled buffer, so no per-packet bytes are allocated
+def receiveFromServerAndInject(sock, tun, stop_event, pool=None, pipeline=None):
+    pool = pool or bufferPool.get_pool()
+    buffer = pool.acquire()
+    view = buffer.view
+    stats = metrics.counters('inbound')
+    clock = time.perf_counter_ns
+
+    try:
+        while not stop_event.is_set():
+            try:
+                start = clock()
+                n = sock.recv_into(view)
+                stats.recv.observe(clock() - start)
+                inject(tun, view[:n], pipeline, stats)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                stats.errors += 1
+                print(f"Error receiving data: {e}")
+    finally:
+        pool.release(buffer)
+
+# Waits up to the remaining flush deadline for the file descriptor to become readable
+def waitForMore(fd, deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return False
+    readable, _, _ = select.select([fd], [], [], remaining)
+    return bool(readable)
+
+# Runs every packet of a batch through the outbound stages, closing the gaps
+# left by packets a stage consumed or grew past the size of a slot
+def processBatch(batch, pipeline):
+    kept = 0
+    for i in range(batch.count):
+        original = batch.packet(i)
+        packet = pipeline.processOutbound(original)
+        if packet is None:
+            continue
+        if packet is not original and not batch.store(i, packet):
+            continue
+        batch.move(i, kept)
+        kept += 1
+    batch.count = kept
+
+# Sends a batch of outbound packets to the server in bulk, coalescing them
+# into framed datagrams when framing is enabled on the pipeline
+# With a cipher on the pipeline the datagrams are sealed into the slots of sealed
+# last, so a coalesced burst costs one cipher call per datagram
+# Returns the bytes counted for the batch, as sendPacket does for one packet
+def sendBatch(sock, batch, framed, pipeline, stats, sealed=None):
+    if pipeline.capture is not None:
+        for i in range(batch.count):
+            pipeline.capture.record(batch.packet(i), capture.OUTBOUND)
+    if batch.destination != pipeline.destination:
+        batch.setDestination(*pipeline.destination)
+    if pipeline.router is not None:
+        for i in range(batch.count):
+            batch.setTarget(i, pipeline.router(batch.packet(i)))
+    start = time.perf_counter_ns()
+    datagrams = batch
+    if framed is not None and pipeline.framer.enabled:
+        pipeline.framer.coalesce(batch, framed)
+        datagrams = framed
+    if sealed is not None:
+        stats.drops += datagrams.count - pipeline.cipher.sealBatch(datagrams, sealed)
+        datagrams = sealed
+    datagrams.send(sock)
+    if datagrams is not batch:
+        datagrams.clear()
+        if framed is not None:
+            framed.clear()
+    stats.send.observe(time.perf_counter_ns() - start)
+    size = sum(batch.lengths[:batch.count])
+    stats.packets += batch.count
+    stats.bytes += size
+    return size
+
+# Reads bursts of packets from the TUN session and flushes them to the server in bulk
+# With framing enabled on the pipeline each burst is coalesced into as few datagrams as fit
+def readPacketsBatched(tun, sock, server_ip, server_port, stop_event, batch_size=batchIO.BATCH_SIZE, flush_deadline=batchIO.FLUSH_DEADLINE, pipeline=None):
+    pipeline = pipeline or Pipeline((server_ip, server_port))
+    batch = batchIO.PacketBatch(batch_size)
+    framed = batchIO.PacketBatch(batch_size) if pipeline.framer else None
+    sealed = batchIO.PacketBatch(batch_size) if pipeline.cipher else None
+    os.set_blocking(tun, False)
+    stats = metrics.counters('outbound')
+    clock = time.perf_counter_ns
+
     while not stop_event.is_set():
+        readable, _, _ = select.select([tun], [], [], 1)
+        if not readable:
+            continue
         try:
-            packet = os.read(tun, 4096)
-            sock.sendto(packet, (server_ip, server_port))
+            deadline = time.monotonic() + flush_deadline
+            while not batch.full():
+                start = clock()
+                try:
+                    batch.readFromTun(tun)
+                except BlockingIOError:
+                    if not waitForMore(tun, deadline):
+                        break
+                    continue
+                stats.recv.observe(clock() - start)
+            if pipeline.outbound:
+                read = batch.count
+                processBatch(batch, pipeline)
+                stats.drops += read - batch.count
+            stats.queue_depth = batch.count
+            sendBatch(sock, batch, framed, pipeline, stats, sealed)
+            stats.queue_depth = 0
         except Exception as e:
+            stats.errors += 1
             if not stop_event.is_set():
                 print(f"Error reading from TUN device: {e}")
             else:
                 print("Stopping read thread due to stop event.")
+        finally:
+            batch.clear()
+
+# Receives bursts of packets from the server and injects them into the TUN device in bulk
+def receiveFromServerAndInjectBatched(sock, tun, stop_event, batch_size=batchIO.BATCH_SIZE, flush_deadline=batchIO.FLUSH_DEADLINE, pipeline=None):
+    batch = batchIO.PacketBatch(batch_size)
+    stats = metrics.counters('inbound')
+    clock = time.perf_counter_ns
 
-# Receives packets from the server and injects them into the TUN device
-def receiveFromServerAndInject(sock, tun, stop_event):
     while not stop_event.is_set():
+        readable, _, _ = select.select([sock], [], [], 1)
+        if not readable:
+            continue
         try:
-            data, _ = sock.recvfrom(4096)
-            os.write(tun, data)
+            deadline = time.monotonic() + flush_deadline
+            while not batch.full():
+                start = clock()
+                if batch.receive(sock):
+                    stats.recv.observe(clock() - start)
+                elif not waitForMore(sock, deadline):
+                    break
+            stats.queue_depth = batch.count
+            for i in range(batch.count):
+                inject(tun, batch.packet(i), pipeline, stats)
+            stats.queue_depth = 0
         except Exception as e:
+            stats.errors += 1
             print(f"Error receiving data: {e}")
+        finally:
+            batch.clear()
+
+# Runs the packet loops for one TUN queue and socket until interrupted
+def runLoops(tun, sock, pipeline, stop_event, mode, batch_size, flush_deadline):
+    server_ip, server_port = pipeline.destination
+    if pipeline.dns is not None:
+        pipeline.dns.tun = tun # cached answers are written to this loop's own queue
+
+    if mode == 'async':
+        import asyncEngine # asyncio is slow to import, only load it when it's used
+        asyncEngine.runTunnel(tun, sock, pipeline)
+        return
+
+    if mode == 'batch':
+        reader_thread = threading.Thread(target=readPacketsBatched, args=(tun, sock, server_ip, server_port, stop_event, batch_size, flush_deadline, pipeline))
+        injector_thread = threading.Thread(target=receiveFromServerAndInjectBatched, args=(sock, tun, stop_event, batch_size, flush_deadline, pipeline))
+    else:
+        reader_thread = threading.Thread(target=readPackets, args=(tun, sock, server_ip, server_port, stop_event), kwargs={'pipeline': pipeline})
+        injector_thread = threading.Thread(target=receiveFromServerAndInject, args=(sock, tun, stop_event), kwargs={'pipeline': pipeline})
+
+    threads = [reader_thread, injector_thread]
+    if pipeline.scheduler is not None:
+        # Packets queue by class between the reader and a sender thread of their own,
+        # and a small send buffer keeps the backlog in those queues rather than the kernel's
+        import qos # only loaded with queuing on
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, qos.SEND_BUFFER)
+        threads[0] = threading.Thread(target=readPacketsQueued, args=(tun, stop_event, pipeline))
+        threads.append(threading.Thread(target=sendQueued, args=(sock, stop_event, pipeline, batch_size, mode == 'batch')))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+# Creates a UDP socket on a port of its own for one queue worker
+# Every worker has its own source port, so the relay sees each one as a separate
+# client and its replies come back to the worker that sent the request
+def createWorkerSocket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', 0))
+    sock.settimeout(1)
+    return sock
+
+# Serves a single queue of a multi-queue TUN device from its own process
+# metrics_port, when given, serves this worker's own counters, and path_mtu, when given,
+# is the shared value the parent's PathMTUMonitor publishes re-probed path MTUs in
+def queueWorker(tun, pipeline, stop_event, mode, batch_size, flush_deadline, metrics_port=None, capture_dir=capture.CAPTURE_DIR,
+                path_mtu=None):
+    if pipeline.capture is not None:
+        capture.installSignal(pipeline.capture, capture_dir)
+    sock = createWorkerSocket()
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    follower = pathMTU.PathMTUFollower(pipeline, path_mtu).start() if path_mtu is not None else None
+    try:
+        runLoops(tun, sock, pipeline, stop_event, mode, batch_size, flush_deadline)
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        if follower:
+            follower.stop()
+        os.close(tun)
+        sock.close()
+
+# Spreads the tunnel across one worker process per TUN queue and waits for them
+# Each worker starts from a forked copy of the pipeline, with a cipher of its own
+# so no two workers seal under the same session
+# The kernel hashes a flow onto the same TUN queue every time, so a flow enters and
+# leaves the tunnel through one worker and the stateful stages stay per worker:
+# the cipher, the DNS cache's pending queries, the framer's 'auto' detection and
+# the capture ring all only ever see the flows of their own worker
+# With a metrics_port, worker i serves its counters on metrics_port + i, and with capture
+# on a SIGUSR1 to this process is passed on so every worker writes out its own ring
+# path_mtu is the shared value of re-probed path MTUs the workers follow, if any
+def runQueueWorkers(queues, pipeline, mode, batch_size, flush_deadline, metrics_port=None, capture_dir=capture.CAPTURE_DIR,
+                    path_mtu=None):
+    import multiprocessing
+
+    # fork keeps the queue file descriptors valid inside the workers
+    context = multiprocessing.get_context('fork')
+    stop_event = context.Event()
+
+    ciphers = pipeline.cipher.split(len(queues)) if pipeline.cipher is not None else None
+    workers = []
+    pids = [] # of the workers a SIGUSR1 is passed on to
+    if pipeline.capture is not None:
+        capture.forwardSignal(pids)
+    for i, tun in enumerate(queues):
+        if ciphers is not None:
+            pipeline.cipher = ciphers[i] # the worker forked next takes this one
+        worker = context.Process(
+            target=queueWorker,
+            args=(tun, pipeline, stop_event, mode, batch_size, flush_deadline,
+                  metrics_port + i if metrics_port is not None else None, capture_dir, path_mtu),
+            daemon=True
+        )
+        worker.start()
+        workers.append(worker)
+        if pipeline.capture is not None:
+            pids.append(worker.pid)
+    print(f"Started {len(workers)} queue workers, each on a UDP port of its own")
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop_event.set()
+        for worker in workers:
+            worker.join(timeout=2)
+            if worker.is_alive():
+                worker.terminate()
+    finally:
+        for tun in queues:
+            os.close(tun)
 
 # This function runs the main logic of the TUN device management and packet handling
-def run():
+# mode = 'packet' moves one packet per system call, 'batch' moves bursts of up to
+# batch_size packets and flushes partial bursts after flush_deadline seconds,
+# 'async' runs both directions on a single asyncio event loop
+# multi_queue opens one TUN queue per worker process, defaulting to one per CPU
+# failover watches the relay in the background and switches to a standby when it degrades,
+# it applies to the single process modes since the workers each hold their own destination
+# relays > 1 spreads flows across that many relays of the country, weighted by bandwidth;
+# in the single process modes every balanced relay is then watched as with failover, and
+# one that stops answering is swapped for a standby, or dropped when there is none
+# coalesce = 'on', 'off' or 'auto' packs the small packets of a burst into shared datagrams
+# in batch mode, 'auto' waits until the relay is seen sending framed datagrams itself
+# mtu = 'auto' sizes the TUN device to the discovered path MTU toward the relay and keeps
+# re-probing, a number sets it outright and None leaves the kernel default
+# country or relay ('IP' or 'IP:PORT') skip the interactive prompt, picking a relay of the
+# country by policy ('fastest' or 'ranked', see bridges.chooseRelay) with the given filters
+# started is the time.monotonic() the process started at, when given the time to bring the
+# tunnel up and to pass the first packet each way is logged against it
+# metrics_port serves the datapath counters on http://127.0.0.1:metrics_port/metrics
+# capture_sample records 1 in every capture_sample packets, capture_filter (e.g. 'udp port 53')
+# only those matching, into a ring that SIGUSR1 writes out as a pcap file in capture_dir,
+# capture.CAPTURE_DIR when None
+# queuing = 'strict' or 'drr' queues outbound packets by class (see qos.PriorityScheduler) in
+# the packet and batch modes, full queues drop by queue_drop ('tail' or 'head') and queue_rate,
+# in Mbit/s, paces the sender so the backlog builds in those queues instead of the network
+# split_include and split_exclude are lists of prefixes, or files of them, to tunnel and to
+# leave out; with either set only the tunneled destinations are routed to the TUN device and
+# the local networks and relays always bypass it (see splitTunnel.SplitTunnel); the relay
+# carries IPv4 only, so IPv6 is tunneled just where split_include names IPv6 prefixes
+# dns_cache answers repeated DNS queries from a cache of that many answers, keeping negative
+# answers up to dns_negative_ttl seconds and refreshing answers with dns_prefetch of their TTL left,
+# either None for the dnsCache defaults
+# key_file holds a pre-shared key the relay also has; with it every datagram is sealed with
+# cipher ('aes-gcm' or 'chacha20', the first when None) under per-session keys (see
+# tunnelCrypto.SessionCipher)
+# relay_reload checks the relay csv, and any other csv dropped beside it, every that many
+# seconds and swaps in the relays they list without touching the datapath, in the single process modes,
+# relayWatcher.INTERVAL when None and 0 never checks it
+def run(mode='packet', batch_size=batchIO.BATCH_SIZE, flush_deadline=batchIO.FLUSH_DEADLINE, multi_queue=False, workers=None, failover=False, relays=1, coalesce='off', mtu='auto',
+        country=None, relay=None, policy='fastest', stable_only=False, min_bandwidth=0.0, started=None, metrics_port=None,
+        capture_sample=None, capture_filter=None, capture_dir=None, queuing=None, queue_drop='tail', queue_rate=None,
+        split_include=None, split_exclude=None, dns_cache=None, dns_negative_ttl=None, dns_prefetch=None,
+        key_file=None, cipher=None, relay_reload=None):
+
+    # Learn the relay csv before the relay list is loaded from it, so an edit made in
+    # between is still picked up; the list is only loaded with a country or a prompt
+    watcher = None
+    if relay_reload is None:
+        relay_reload = relayWatcher.INTERVAL
+    if relay_reload and (country is not None or relay is None):
+        try:
+            watcher = bridges.watchRelays(relay_reload)
+        except OSError as e:
+            print(f"Not watching the relay list: {e}")
 
     # networking setup
-    network = chooseNetwork()
+    network = chooseNetwork(country, relay, policy, stable_only, min_bandwidth)
+    if network is None:
+        print("No relay to connect to.")
+        return
     tun_name = 'PhaethonVPN'
     tun_ip = adapterscan.generateNonConflictingIP(skip_first=100)
-    server_ip = network[0]
-    server_country = network[1]
-    server_port = int(bridges.returnPort(server_country, server_ip))
+    server_ip, server_country, server_port = network
     print(f"Connecting to server {server_ip}:{server_port} with TUN device {tun_name} at IP {tun_ip}")
 
+    pipeline = Pipeline((server_ip, server_port))
+    balancer = None
+    if relays > 1:
+        import flowBalancer
+        balancer = flowBalancer.FlowBalancer(flowBalancer.selectRelays(server_country, relays, (server_ip, server_port)))
+        pipeline.router = balancer.route
+        for (ip, port), share in balancer.shares().items():
+            print(f"Balancing {share * 100:.1f}% of flows to {ip}:{port}")
+    if coalesce != 'off':
+        pipeline.framer = framing.Framer(coalesce)
+    if key_file is not None:
+        import tunnelCrypto # only loaded with sealing on
+        cipher = cipher or tunnelCrypto.CIPHERS[0]
+        pipeline.cipher = tunnelCrypto.SessionCipher(tunnelCrypto.loadKey(key_file), cipher=cipher)
+        print(f"Sealing datagrams with {cipher}, session {pipeline.cipher.session.hex()}")
+
+    fixed_mtu = mtu if mtu != 'auto' else None
+
+    # The monitor picks its standbys now so the split tunnel can bypass them from the start
+    monitor = None
+    if (failover or balancer is not None) and not multi_queue:
+        import relayMonitor
+        monitor = relayMonitor.RelayMonitor(pipeline, server_country, balancer=balancer)
+        with monitor.lock:
+            monitor.refillStandbys()
+
+    # Drop anything that reaches the TUN device without belonging in the tunnel
+    split = None
+    if split_include or split_exclude:
+        relays_in_use = list(balancer.shares()) if balancer else [pipeline.destination]
+        if monitor:
+            relays_in_use += monitor.relays()
+        bypass = list(adapterscan.getLocalNetworks()) + [f"{ip}/32" for ip, _ in relays_in_use]
+        import splitTunnel # only loaded with split tunneling on
+        split = splitTunnel.SplitTunnel(split_include, split_exclude, bypass)
+        pipeline.addOutbound(split)
+        if monitor:
+            monitor.listeners.append(RelayBypass(split, relays_in_use))
+    if dns_cache:
+        import dnsCache # only loaded with the cache on
+        dns = pipeline.dns = dnsCache.DNSCache(dns_cache,
+                                               dnsCache.NEGATIVE_TTL if dns_negative_ttl is None else dns_negative_ttl,
+                                               dnsCache.PREFETCH if dns_prefetch is None else dns_prefetch)
+        pipeline.addOutbound(dns.outbound)
+        pipeline.addInbound(dns.inbound)
+
+    # Clamp the MSS of TCP handshakes in both directions to the tunnel MTU
+    clamp = mssClamp.MSSClamp(pipeline)
+    pipeline.addOutbound(clamp)
+    pipeline.addInbound(clamp)
+    registry = metrics.get_registry()
+    registry.addMetric('mss_clamped_total', 'counter', "TCP handshakes whose MSS was clamped.", lambda: clamp.clamped)
+    registry.addMetric('tun_mtu', 'gauge', "MTU of the TUN device.", lambda: pipeline.mtu or 0)
+    registry.addMetric('stage_failures_total', 'counter', "Packets dropped because a pipeline stage raised on them.", lambda: pipeline.failures)
+    if split is not None:
+        registry.addMetric('split_forwarded_total', 'counter', "Packets the split tunnel let through.", lambda: split.forwarded)
+        registry.addMetric('split_bypassed_total', 'counter', "Packets the split tunnel dropped as bypassing the tunnel.", lambda: split.bypassed)
+    if pipeline.dns is not None:
+        registry.addMetric('dns_cache_hits_total', 'counter', "DNS queries answered from the cache.", lambda: dns.hits)
+        registry.addMetric('dns_cache_negative_hits_total', 'counter', "DNS queries answered with a cached negative answer.", lambda: dns.negative_hits)
+        registry.addMetric('dns_cache_misses_total', 'counter', "DNS queries sent on to the relay.", lambda: dns.misses)
+        registry.addMetric('dns_cache_prefetches_total', 'counter', "Cached DNS answers refreshed before expiring.", lambda: dns.prefetches)
+        registry.addMetric('dns_cache_entries', 'gauge', "DNS answers in the cache.", lambda: len(dns.entries))
+        registry.addMetric('dns_cache_hit_ratio', 'gauge', "Share of DNS queries answered from the cache.", dns.hitRate)
+    if pipeline.cipher is not None:
+        registry.addMetric('crypto_rejected_total', 'counter', "Datagrams dropped for failing to authenticate.", lambda: pipeline.cipher.rejected)
+        registry.addMetric('crypto_replayed_total', 'counter', "Datagrams dropped as replays or too far out of order.", lambda: pipeline.cipher.replayed)
+        registry.addMetric('crypto_oversized_total', 'counter', "Datagrams dropped for not fitting a batch slot once sealed.", lambda: pipeline.cipher.oversized)
+        registry.addMetric('crypto_rekeys_total', 'counter', "Switches to a new session after sealing REKEY_AFTER datagrams.", lambda: pipeline.cipher.rekeys)
+    if pipeline.framer is not None:
+        registry.addMetric('framed_packets_total', 'counter', "Packets coalesced into framed datagrams.", lambda: pipeline.framer.packets)
+        registry.addMetric('framed_datagrams_total', 'counter', "Framed datagrams sent.", lambda: pipeline.framer.datagrams)
+    if capture_sample or capture_filter:
+        capture_dir = capture_dir or capture.CAPTURE_DIR
+        packet_filter = capture.parseFilter(capture_filter) if capture_filter else None
+        pipeline.capture = capture.CaptureRing(sample=capture_sample or 1, filter=packet_filter)
+        if not multi_queue: # the queue workers hold the rings and install it themselves
+            capture.installSignal(pipeline.capture, capture_dir)
+        print(f"Capturing packets, send SIGUSR1 to process {os.getpid()} to write them to {capture_dir}")
+    if queuing is not None and mode == 'async':
+        print("Priority queuing needs the packet or batch mode, leaving it off")
+    elif queuing is not None:
+        import qos # only loaded with queuing on
+        scheduler = pipeline.scheduler = qos.PriorityScheduler(queuing, queue_drop, rate=queue_rate * 125000 if queue_rate else None)
+        registry.addMetric('qos_queue_depth', 'gauge', "Outbound packets waiting per class.",
+                           lambda: [({'class': name}, depth) for name, depth in zip(qos.CLASSES, scheduler.depths())])
+        registry.addMetric('qos_queued_bytes', 'gauge', "Bytes of outbound packets waiting across every class.", lambda: scheduler.queued_bytes)
+        registry.addMetric('qos_drops_total', 'counter', "Outbound packets dropped from a full class queue.",
+                           lambda: [({'class': name}, count) for name, count in zip(qos.CLASSES, scheduler.dropped)])
+        registry.addMetric('qos_sent_total', 'counter', "Outbound packets sent per class.",
+                           lambda: [({'class': name}, count) for name, count in zip(qos.CLASSES, scheduler.sent)])
+    if started is not None:
+        import headless # only needed to time a headless start
+        pipeline.addOutbound(headless.FirstPacketTimer(started, "sent to the relay"))
+        pipeline.addInbound(headless.FirstPacketTimer(started, "received from the relay"))
+
+    if multi_queue:
+        queues = create_tun_queues(tun_name, workers or os.cpu_count() or 1)
+        configure_tun(tun_name, tun_ip, fixed_mtu)
+        pipeline.mtu = pathMTU.getMTU(tun_name)
+        if split is not None:
+            print(f"Routed {installSplitRoutes(tun_name, split)} split tunnel prefixes through {tun_name}")
+        mtu_monitor = None
+        path_mtu = None
+        if mtu == 'auto':
+            import multiprocessing
+            path_mtu = multiprocessing.get_context('fork').Value('i', 0, lock=False) # the workers' copies follow it
+            mtu_monitor = pathMTU.PathMTUMonitor(tun_name, pipeline, shared=path_mtu).start()
+        logStartup(started)
+        try:
+            runQueueWorkers(queues, pipeline, mode, batch_size, flush_deadline, metrics_port, capture_dir, path_mtu)
+        finally:
+            if mtu_monitor:
+                mtu_monitor.stop()
+        return
+
     tun = create_tun(tun_name)
-    configure_tun(tun_name, tun_ip)
+    configure_tun(tun_name, tun_ip, fixed_mtu)
+    pipeline.mtu = pathMTU.getMTU(tun_name)
+    if split is not None:
+        print(f"Routed {installSplitRoutes(tun_name, split)} split tunnel prefixes through {tun_name}")
+    mtu_monitor = pathMTU.PathMTUMonitor(tun_name, pipeline).start() if mtu == 'auto' else None
 
     # UDP socket for communication with the server
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.settimeout(1)
 
-    stop_event = Event()
-
-    reader_thread = threading.Thread(target=readPackets, args=(tun, sock, server_ip, server_port, stop_event))
-    injector_thread = threading.Thread(target=receiveFromServerAndInject, args=(sock, tun, stop_event))
-
-    reader_thread.start()
-    injector_thread.start()
+    stop_event = threading.Event()
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    if monitor:
+        monitor.start()
+        registry.addMetric('failovers_total', 'counter', "Switches to a standby relay.", lambda: monitor.failovers)
+        registry.addMetric('relay_evictions_total', 'counter', "Balanced relays swapped out or dropped for not answering.", lambda: monitor.evictions)
+        registry.addMetric('failover_seconds', 'gauge', "Time from the first failed probe to the last switch.", lambda: monitor.last_failover)
+    if watcher:
+        if monitor:
+            watcher.listeners.append(monitor.onRelaysChanged)
+        watcher.start()
+        registry.addMetric('relay_reloads_total', 'counter', "Changes to the relay csv picked up while running.", lambda: watcher.reloads)
+        registry.addMetric('relay_reload_seconds', 'gauge', "Time the last relay list reload took.", lambda: watcher.reload_time)
+    logStartup(started)
 
     try:
-        reader_thread.join()
-        injector_thread.join()
-    except KeyboardInterrupt:
-        stop_event.set()
-        reader_thread.join()
-        injector_thread.join()
+        runLoops(tun, sock, pipeline, stop_event, mode, batch_size, flush_deadline)
     finally:
+        if watcher:
+            watcher.stop()
+        if monitor:
+            monitor.stop()
+        if mtu_monitor:
+            mtu_monitor.stop()
         os.close(tun)
         sock.close()
 
-# Returns an array with the chosen network's IP and country code
-# bridges.returnIP[0] = Server IP
-# bridges.returnIP[1] = Country Code
-def chooseNetwork():
+# Logs how long the tunnel took to come up, when the start time is known
+def logStartup(started):
+    if started is not None:
+        print(f"Tunnel up {(time.monotonic() - started) * 1000:.1f} ms after start")
+
+# Returns the chosen network's server IP, country code and port, or None
+# Prompts for a country unless a country or relay is given
+def chooseNetwork(country=None, relay=None, policy='fastest', stable_only=False, min_bandwidth=0.0):
+    if relay is not None:
+        import headless # parses the relay the same way the command line does
+        server_ip, server_port = headless.parseRelay(relay)
+        if country is None:
+            # Nothing needs the relay list, but then the port must be given
+            if server_port is None:
+                print(f"Give the port of relay {server_ip} as IP:PORT, or its country with --country.")
+                return None
+            return [server_ip, None, server_port]
+
+    # Failover and balancing pick other relays of the country from the list
     bridges.loadDictionary()
-    return bridges.returnIP()
\ No newline at end of file
+    if relay is not None:
+        if server_port is not None:
+            return [server_ip, country, server_port]
+        port = bridges.returnPort(country, server_ip)
+        if port is None:
+            print(f"Relay {server_ip} isn't listed for country {country}, give its port as IP:PORT.")
+            return None
+        return [server_ip, country, int(port)]
+
+    if country is not None:
+        chosen = bridges.chooseRelay(country, policy, stable_only, min_bandwidth)
+        if chosen is None:
+            return None
+        server_ip, server_port = chosen
+    else:
+        choice = bridges.returnIP()
+        if choice is None:
+            return None
+        server_ip, country, server_port = choice
+    if server_ip is None:
+        return None
+    return [server_ip, country, int(server_port)]
\ No newline at end of file
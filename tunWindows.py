@@ -9,10 +9,13 @@
 
 import adapterscan as adaptScan
 import bridges
+import bufferPool
 import ctypes
 import ctypes.wintypes as wintypes
+import metrics
 from multiprocessing import Event
 import socket
+import splitTunnel
 import subprocess
 import time
 import threading
@@ -46,30 +49,51 @@ def startWintunSession(adapter, mtu):
     return session
 
 # Reads packets from the Wintun session
-def readPackets(session, sock, server_ip, server_port, stop_event):
+# Each packet is copied once from the Wintun ring straight into a pooled buffer
+# Nothing is printed per packet, the counters in metrics are the place to look
+def readPackets(session, sock, server_ip, server_port, stop_event, pool=None):
     read_event = wintun.WintunGetReadWaitEvent(session)
     if not read_event:
         print("Failed to get read wait event.")
         return
 
-    while not stop_event.is_set():
-        result = ctypes.windll.kernel32.WaitForSingleObject(read_event, 1000)  # 1s timeout to check stop_event
-        if result == 0:
-            packet_size = wintypes.DWORD(0)
-            packet = wintun.WintunReceivePacket(session, ctypes.byref(packet_size))
-            print(f"Received packet of size {packet_size.value} bytes.")
-            if packet:
-                packet_bytes = ctypes.string_at(packet, packet_size.value)
+    pool = pool or bufferPool.get_pool()
+    buffer = pool.acquire()
+    view = buffer.view
+    destination = (server_ip, server_port)
+    packet_size = wintypes.DWORD(0)
+    stats = metrics.counters('outbound')
+    clock = time.perf_counter_ns
+
+    try:
+        while not stop_event.is_set():
+            result = ctypes.windll.kernel32.WaitForSingleObject(read_event, 1000)  # 1s timeout to check stop_event
+            if result != 0:
+                continue
+
+            # Drain everything queued in the ring before waiting again
+            while not stop_event.is_set():
+                start = clock()
+                packet = wintun.WintunReceivePacket(session, ctypes.byref(packet_size))
+                if not packet:
+                    break
+                size = min(packet_size.value, buffer.size)
+                ctypes.memmove(buffer.address, packet, size)
                 wintun.WintunReleaseReceivePacket(session, packet)
+                stats.recv.observe(clock() - start)
 
                 # Send
                 try:
-                    sock.sendto(packet_bytes, (server_ip, server_port))
-                    time.sleep(0.01)
+                    start = clock()
+                    sock.sendto(view[:size], destination)
+                    stats.send.observe(clock() - start)
+                    stats.packets += 1
+                    stats.bytes += size
                 except Exception as e:
+                    stats.errors += 1
                     print(f"Send error: {e}")
-        else:
-            continue
+    finally:
+        pool.release(buffer)
 
 # Closes the Wintun adapter and any resources associated with it
 def closeAdapter(adapter):
@@ -80,49 +104,38 @@ def closeAdapter(adapter):
         print("No adapter to close.")
 
 # Receives packets from the server and injects them into the Wintun session
-def receiveFromServerAndInject(sock, session, stop_event):
-    while not stop_event.is_set():
-        try:
-            data, _ = sock.recvfrom(65535)
-            if data:
-                packet = wintun.WintunAllocateSendPacket(session, len(data))
-                print(f"Received {len(data)} bytes from server, injecting into Wintun session.")
-                if packet:
-                    ctypes.memmove(packet, data, len(data))
-                    wintun.WintunSendPacket(session, packet)
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print(f"Receive error: {e}")
-            break
-
-# This helper function runs the packet reader
-def packetReader(session, sock, server_ip, server_port, stop_event):
-    while not stop_event.is_set():
-        readPackets(session, sock, server_ip, server_port, stop_event)
-
-# This helper function runs the packet injector
-def packetInjector(sock, session, stop_event):
-    while not stop_event.is_set():
-        receiveFromServerAndInject(sock, session, stop_event)
+# Datagrams are received in place into a pooled buffer before being copied into the Wintun ring
+def receiveFromServerAndInject(sock, session, stop_event, pool=None):
+    pool = pool or bufferPool.get_pool()
+    buffer = pool.acquire()
+    stats = metrics.counters('inbound')
+    clock = time.perf_counter_ns
 
-# This function initializes the Wintun library, creates an adapter, and starts a session
-# Receives packets from the server and injects them into the Wintun session
-def receiveFromServerAndInject(sock, session, stop_event):
-    while not stop_event.is_set():
-        try:
-            data, _ = sock.recvfrom(65535)
-            if data:
-                packet = wintun.WintunAllocateSendPacket(session, len(data))
-                print(f"Received {len(data)} bytes from server, injecting into Wintun session.")
-                if packet:
-                    ctypes.memmove(packet, data, len(data))
+    try:
+        while not stop_event.is_set():
+            try:
+                start = clock()
+                size = sock.recv_into(buffer.view)
+                stats.recv.observe(clock() - start)
+                if size:
+                    start = clock()
+                    packet = wintun.WintunAllocateSendPacket(session, size)
+                    if not packet:
+                        stats.drops += 1 # the Wintun ring is full
+                        continue
+                    ctypes.memmove(packet, buffer.address, size)
                     wintun.WintunSendPacket(session, packet)
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print(f"Receive error: {e}")
-            break
+                    stats.send.observe(clock() - start)
+                    stats.packets += 1
+                    stats.bytes += size
+            except socket.timeout:
+                continue
+            except Exception as e:
+                stats.errors += 1
+                print(f"Receive error: {e}")
+                break
+    finally:
+        pool.release(buffer)
 
 # This helper function runs the packet reader
 def packetReader(session, sock, server_ip, server_port, stop_event):
@@ -135,7 +148,10 @@ def packetInjector(sock, session, stop_event):
         receiveFromServerAndInject(sock, session, stop_event)
 
 # This function initializes the Wintun library, creates an adapter, and starts a session
-def run():
+# metrics_port, when given, serves the datapath counters on http://127.0.0.1:metrics_port/metrics
+# split_include and split_exclude are prefixes, or files of them, to tunnel and to leave out,
+# by default everything but the local networks and the relay goes through the tunnel
+def run(metrics_port=None, split_include=None, split_exclude=None):
     # Wintun Adapter name and tunnel type
     adapter_name = "PhaethonVPN"
     tunnel_type = "PhaethonVPN"
@@ -176,17 +192,21 @@ def run():
         "Get-NetAdapter | Where-Object { $_.InterfaceAlias -like '*PhaethonVPN*' }"
     ])
 
-    # Add a default route to the adapter
-    subprocess.run([
-        "route", "add", "0.0.0.0", "mask", "0.0.0.0", random_ip
-    ])
-
     # network setup
     choosenNetwork = chooseNetwork()
     server_ip = choosenNetwork[0]
     print("\nThe IP is: ", server_ip)
     server_country = choosenNetwork[1]
-    server_port = int(bridges.returnPort(server_country, server_ip))
+    server_port = int(choosenNetwork[2])
+
+    # Route the tunneled destinations to the adapter, keeping the local networks
+    # and the relay itself outside the tunnel
+    split = splitTunnel.SplitTunnel(split_include, split_exclude,
+                                    list(adaptScan.getLocalNetworks()) + [f"{server_ip}/32"])
+    for network in split.routes(4):
+        subprocess.run([
+            "route", "add", str(network.network_address), "mask", str(network.netmask), random_ip
+        ])
 
     # UDP socket for communication with the server
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -205,6 +225,8 @@ def run():
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024*1024)
 
             stop_event = Event()
+            if metrics_port is not None:
+                metrics.serve(metrics_port)
 
             reader_thread = threading.Thread(
                 target=readPackets,
@@ -245,6 +267,7 @@ def run():
 # This function allows the user to choose what country to connect to
 # bridges.returnIP[0] = Server IP
 # bridges.returnIP[1] = Country Code
+# bridges.returnIP[2] = Server Port
 def chooseNetwork():
     bridges.loadDictionary()
     return bridges.returnIP()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# ----------------------------- tunnelCrypto.py --------------------------- #
+# This script is designed to encrypt and authenticate every datagram sent   #
+# to the relay. Each session derives its own pair of keys from a pre-shared #
+# key and a random 128 bit session id, one per direction, every datagram    #
+# carries a counter that doubles as its nonce, and a sliding window rejects #
+# replayed or forged datagrams before they reach the TUN device. Sealing    #
+# and opening write straight into pooled buffers or the slots of a batch    #
+# rather than new buffers. The batch loops seal after framing, so there a   #
+# coalesced burst costs one cipher call per datagram instead of one per     #
+# packet; the packet and async loops seal each packet as it goes out.       #
+#                                                                           #
+# This script is part of the PhaethonVPN project.          v0.0.2           #
+# --------------------------------- s3B-a --------------------------------- #
+
+import base64
+import bufferPool
+import os
+import struct
+
+MAGIC       = 0x02          # First byte of a sealed datagram, never an IP version nibble or framing.FRAME_MAGIC
+SESSION_ID  = 16            # Random bytes naming a session, the salt its keys are derived with
+HEADER      = struct.Struct(f'!B{SESSION_ID}sQ') # magic, session id, counter
+NONCE       = 12            # The header's last bytes: the end of the session id, fixed per key, and the counter
+TAG         = 16            # Authentication tag appended to the ciphertext
+OVERHEAD    = HEADER.size + TAG
+WINDOW      = 1024          # Counters behind the highest seen that may still arrive out of order
+REKEY_AFTER = 1 << 32       # Datagrams sealed under one session before switching to a new one
+KEY_SIZE    = 32
+CIPHERS     = ('aes-gcm', 'chacha20')
+
+# Returns the 32 byte pre-shared key stored in a file as hex, base64 or raw bytes
+def loadKey(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    text = data.strip()
+    for decode in (bytes.fromhex, base64.b64decode):
+        try:
+            key = decode(text.decode())
+        except (ValueError, UnicodeDecodeError):
+            continue
+        if len(key) == KEY_SIZE:
+            return key
+    if len(data) == KEY_SIZE:
+        return data
+    raise ValueError(f"{path}: expected a {KEY_SIZE} byte key as hex, base64 or raw bytes")
+
+# Returns the (send, receive) keys of a session, the initiator's send key being
+# the responder's receive key and the other way round
+def deriveKeys(psk, session, initiator=True):
+    # cryptography is an optional dependency, only needed with encryption on
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    keys = HKDF(hashes.SHA256(), 2 * KEY_SIZE, salt=session, info=b'PhaethonVPN session keys').derive(psk)
+    forward, backward = keys[:KEY_SIZE], keys[KEY_SIZE:]
+    return (forward, backward) if initiator else (backward, forward)
+
+# Returns an AEAD object of the named cipher for a key
+def makeAEAD(cipher, key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    if cipher == 'aes-gcm':
+        return AESGCM(key)
+    if cipher == 'chacha20':
+        return ChaCha20Poly1305(key)
+    raise ValueError(f"Unknown cipher: {cipher}")
+
+# Tracks the counters received so far, the way IPsec and WireGuard do
+# The bits of an int mark which of the last WINDOW counters have been seen
+class ReplayWindow:
+    __slots__ = ('highest', 'bits')
+
+    def __init__(self):
+        self.highest = -1
+        self.bits = 0
+
+    # Returns True if a counter is new and not too old, without recording it
+    def check(self, counter):
+        if counter > self.highest:
+            return True
+        behind = self.highest - counter
+        return behind < WINDOW and not (self.bits >> behind) & 1
+
+    # Records a counter whose datagram authenticated
+    def accept(self, counter):
+        if counter > self.highest:
+            shift = counter - self.highest
+            self.bits = ((self.bits << shift) | 1) & ((1 << WINDOW) - 1) if shift < WINDOW else 1
+            self.highest = counter
+        else:
+            self.bits |= 1 << (self.highest - counter)
+
+# Seals and opens the datagrams of one session
+# seal() and open() each reuse a pooled buffer of their own, taken on first use, so
+# at most one thread may seal and one open at a time, which is how the loops use them
+class SessionCipher:
+    def __init__(self, psk, session=None, initiator=True, cipher='aes-gcm', pool=None):
+        self.psk = psk
+        self.initiator = initiator
+        self.cipher = cipher
+        self.pool = pool or bufferPool.get_pool()
+        self.sealBuffer = None
+        self.openBuffer = None
+        self.siblings = {} # session id -> SessionCipher of the other processes of one tunnel
+        self.rejected = 0  # datagrams that failed to authenticate or weren't sealed
+        self.replayed = 0  # datagrams whose counter was seen before or fell behind the window
+        self.oversized = 0 # datagrams sealBatch dropped for not fitting a slot once sealed
+        self.rekeys = 0
+        self.setSession(session or os.urandom(SESSION_ID))
+
+    # Switches to a session, deriving its keys and starting its counters over
+    def setSession(self, session):
+        self.session = session
+        send_key, receive_key = deriveKeys(self.psk, session, self.initiator)
+        self.sealer = makeAEAD(self.cipher, send_key)
+        self.opener = makeAEAD(self.cipher, receive_key)
+        self.counter = 0
+        self.window = ReplayWindow()
+
+    # Starts over under a new random session once a key has sealed REKEY_AFTER datagrams
+    def rekey(self):
+        self.siblings.pop(self.session, None)
+        self.setSession(os.urandom(SESSION_ID))
+        self.siblings[self.session] = self
+        self.rekeys += 1
+
+    # Returns count ciphers sharing this one's pre-shared key for the processes of one
+    # tunnel, such as the queue workers: each seals under a session of its own, so no
+    # two ever use the same key and counter, and each opens datagrams of any of them
+    def split(self, count):
+        ciphers = [self] + [SessionCipher(self.psk, None, self.initiator, self.cipher, self.pool) for _ in range(count - 1)]
+        siblings = {cipher.session: cipher for cipher in ciphers}
+        for cipher in ciphers:
+            cipher.siblings = dict(siblings)
+        return ciphers
+
+    # Seals a datagram into out, a writable buffer at least OVERHEAD bytes larger,
+    # returning the sealed length
+    def sealInto(self, datagram, out):
+        if self.counter >= REKEY_AFTER and self.initiator:
+            self.rekey()
+        counter = self.counter
+        self.counter = counter + 1
+        # The header is authenticated as associated data and its last NONCE bytes are the nonce
+        header = HEADER.pack(MAGIC, self.session, counter)
+        out[:HEADER.size] = header
+        size = len(datagram)
+        self.sealer.encrypt_into(header[-NONCE:], datagram, header, out[HEADER.size:HEADER.size + size + TAG])
+        return HEADER.size + size + TAG
+
+    # Returns a view of the datagram sealed into this cipher's own buffer
+    def seal(self, datagram):
+        if self.sealBuffer is None:
+            self.sealBuffer = self.pool.acquire()
+        view = self.sealBuffer.view
+        return view[:self.sealInto(datagram, view)]
+
+    # Seals every datagram of a batchIO.PacketBatch into the slots of another,
+    # carrying over their destinations, and returns how many were sealed
+    # A datagram too large to fit a slot once sealed is skipped and counted as oversized
+    def sealBatch(self, batch, out):
+        out.clear()
+        if batch.destination is not None and out.destination != batch.destination:
+            out.setDestination(*batch.destination)
+        sealInto = self.sealInto
+        room = out.buffer_size - OVERHEAD
+        kept = 0
+        for i in range(batch.count):
+            if batch.lengths[i] > room:
+                self.oversized += 1
+                continue
+            out.lengths[kept] = sealInto(batch.packet(i), out.slots[kept])
+            out.targets[kept] = batch.targets[i]
+            kept += 1
+        out.count = kept
+        return kept
+
+    # Opens a sealed datagram into out, returning the opened length, or -1 if it isn't a
+    # datagram of this session or a sibling's, fails to authenticate or is a replay
+    def openInto(self, datagram, out):
+        size = len(datagram) - OVERHEAD
+        if size < 0 or datagram[0] != MAGIC:
+            self.rejected += 1
+            return -1
+        session = datagram[1:1 + SESSION_ID]
+        owner = self if session == self.session else self.siblings.get(bytes(session))
+        if owner is None:
+            self.rejected += 1
+            return -1
+        counter = int.from_bytes(datagram[1 + SESSION_ID:HEADER.size], 'big')
+        if not owner.window.check(counter):
+            self.replayed += 1
+            return -1
+        try:
+            owner.opener.decrypt_into(datagram[HEADER.size - NONCE:HEADER.size], datagram[HEADER.size:], datagram[:HEADER.size], out[:size])
+        except Exception: # cryptography.exceptions.InvalidTag, imported only with the package
+            self.rejected += 1
+            return -1
+        owner.window.accept(counter)
+        return size
+
+    # Returns a view of the datagram opened into this cipher's own buffer, or None
+    def open(self, datagram):
+        if self.openBuffer is None:
+            self.openBuffer = self.pool.acquire()
+        view = self.openBuffer.view
+        size = self.openInto(datagram, view)
+        return view[:size] if size >= 0 else None
+
+# Returns the session id a sealed datagram belongs to, or None if it isn't one
+def sessionOf(datagram):
+    if len(datagram) < OVERHEAD or datagram[0] != MAGIC:
+        return None
+    return bytes(datagram[1:1 + SESSION_ID])